@@ -0,0 +1,370 @@
+"""
+End-to-end throughput and latency benchmark of the streaming path: serial port -> SerialCom.read_stream ->
+decode_streaming_buffer -> detector -> data handler -> Broadcaster -> websocket clients.
+
+The frames go through the data handlers of main, so the presence history, the frame bus and the logging of the handlers
+are part of the measured cost. The log lines of the handlers are written to /dev/null.
+
+The serial source is a simulated XM132 on a pseudo-terminal in its own process, the clients are websocket connections
+from one or more other processes, so the CPU time measured in this process is the cost of the server alone. Every frame
+carries its frame number (in the distance of presence frames, in the first two samples of service frames) so the
+clients can match it with the time the simulator sent it.
+
+    python benchmark.py --modes presence,envelope --rates 10,100 --clients 1,10 --output results.json
+    python benchmark.py --baseline results.json
+
+Needs a platform with pseudo-terminals (Linux, macOS).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import struct
+import sys
+import time
+from array import array
+import websockets
+import main as server_main
+from broadcaster import Broadcaster
+from frame_bus import FrameBusWriter
+from presence_detector import PresenceDetector
+from service_detector import PowerBinsService, EnvelopeService, SparseService
+from simulator import SimulatedXM132
+from wire_format import StructEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DETECTOR_CLASSES = {cls.mode.lower(): cls
+                    for cls in (PresenceDetector, PowerBinsService, EnvelopeService, SparseService)}
+# frame number in the first two samples of service frames
+MARKER = struct.Struct('<I')
+# sensor id the frames of the simulated module are tagged with
+SENSOR_ID = 'benchmark'
+
+
+class BenchmarkXM132(SimulatedXM132):
+    """
+    Simulated module that puts the frame number in every frame and records when each frame was sent
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent_times = array('d')
+
+    def _frame_data(self):
+        index = self.frames_sent
+        mode = self.MODES[self.registers[self.MODE_SELECTION]]
+        if mode == 'presence':
+            # float32 holds the frame number exactly up to 2 ** 24
+            data = self.PRESENCE.pack(1, 1.0, float(index))
+        else:
+            data = bytearray(2 * max(self._sample_count(mode), 2))
+            MARKER.pack_into(data, 0, index)
+            data = bytes(data)
+        self.sent_times.append(time.perf_counter())
+        return data
+
+
+def frame_number(message, encoding):
+    """
+    Get the frame number of a stream frame received by a client
+    :param message:  websocket message
+    :param encoding:  wire format of the message
+    :return:  frame number set by BenchmarkXM132
+    """
+    if encoding == 'json':
+        frame = json.loads(message)
+        if frame['stream'] == 'presence':
+            return int(float(frame['data']['distance']))
+        samples = frame['data']['samples']
+        if isinstance(samples[0], list):
+            samples = samples[0]
+        return samples[0] | samples[1] << 16
+    if encoding == 'struct':
+        offset = StructEncoder.HEADER.size
+        if message[1] == StructEncoder.STREAM_IDS['presence']:
+            return int(StructEncoder.PRESENCE.unpack_from(message, offset)[2])
+        return MARKER.unpack_from(message, offset + StructEncoder.SHAPE.size)[0]
+    frame = msgpack.unpackb(message)
+    if frame['stream'] == 'presence':
+        return int(frame['data']['distance'])
+    return MARKER.unpack_from(frame['data']['samples'])[0]
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile
+    :param values:  sorted list
+    :param fraction:  0 to 1
+    :return:  value, None if values is empty
+    """
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+# simulator process
+
+def simulator_process(connection):
+    asyncio.run(serve_simulator(connection))
+
+
+async def serve_simulator(connection):
+    device = BenchmarkXM132()
+    connection.send(device.open_pty())
+    # serve until the benchmark asks for the send times
+    await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+    device.disconnect()
+    connection.send(device.sent_times)
+
+
+# client process
+
+def client_process(url, count, encoding, connection):
+    connection.send(asyncio.run(run_clients(url, count, encoding, connection)))
+
+
+async def run_clients(url, count, encoding, connection):
+    websockets_ = [await websockets.connect(url, max_size=None) for _ in range(count)]
+    connection.send('connected')
+    received = await asyncio.gather(*(receive(websocket, encoding) for websocket in websockets_))
+    # frame numbers and receive times of all clients
+    numbers = array('l')
+    times = array('d')
+    for client_numbers, client_times in received:
+        numbers.extend(client_numbers)
+        times.extend(client_times)
+    return numbers, times
+
+
+async def receive(websocket, encoding):
+    numbers = array('l')
+    times = array('d')
+    try:
+        async for message in websocket:
+            times.append(time.perf_counter())
+            numbers.append(frame_number(message, encoding))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    return numbers, times
+
+
+# server
+
+async def run_scenario(mode, update_rate, clients, encoding, duration, warmup, client_processes):
+    """
+    Stream from a simulated module to local websocket clients and measure the server
+    :param mode:  detector mode, key of DETECTOR_CLASSES
+    :param update_rate:  update rate of the module in Hz
+    :param clients:  number of websocket clients
+    :param encoding:  wire format used by the clients
+    :param duration:  seconds measured
+    :param warmup:  seconds streamed before the measurement starts
+    :param client_processes:  maximum number of processes the clients are spread over
+    :return:  dictionary with the results
+    """
+    loop = asyncio.get_running_loop()
+    context = multiprocessing.get_context('spawn')
+    simulator_connection, child_connection = context.Pipe()
+    simulator = context.Process(target=simulator_process, args=(child_connection,), daemon=True)
+    simulator.start()
+    port = await loop.run_in_executor(None, simulator_connection.recv)
+
+    detector = DETECTOR_CLASSES[mode]({'port': port, 'rtscts': False})
+    await detector.open()
+    # the handlers of main publish to its consumers and frame bus, every scenario starts with new ones
+    broadcaster = Broadcaster(server_main.SEND_QUEUE_SIZE, server_main.SLOW_CONSUMER_POLICY,
+                              server_main.REPLAY_BUFFER_SIZE)
+    server_main.consumers = broadcaster
+    server_main.frame_bus = FrameBusWriter(f'radar_frames_benchmark_{os.getpid()}')
+    server_main.histories = {}
+    server_main.detectors.add(SENSOR_ID, detector)
+
+    async def serve(websocket, path):
+        broadcaster.add(websocket)
+        broadcaster.set_encoding(websocket, encoding)
+        try:
+            await websocket.wait_closed()
+        finally:
+            broadcaster.remove(websocket)
+
+    server = await websockets.serve(serve, '127.0.0.1', 0, max_size=None)
+    url = f'ws://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+    processes = []
+    process_count = max(min(client_processes, clients), 1)
+    for number in range(process_count):
+        count = clients // process_count + (number < clients % process_count)
+        connection, child_connection = context.Pipe()
+        process = context.Process(target=client_process, args=(url, count, encoding, child_connection), daemon=True)
+        process.start()
+        processes.append((process, connection))
+    for process, connection in processes:
+        await loop.run_in_executor(None, connection.recv)
+
+    config = dict(detector.default_mod_config, update_rate=int(update_rate * 1000))
+    if not await detector.create_module(config) or not await detector.activate_module():
+        raise RuntimeError('Simulated module could not be started')
+    handler = server_main.data_handler_for(detector, SENSOR_ID)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        stream_task = asyncio.create_task(detector.start_stream(handler, warmup + duration + 60))
+
+        await asyncio.sleep(warmup)
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        start_frames = broadcaster.published_frames
+        await asyncio.sleep(duration)
+        end_time = time.perf_counter()
+        cpu = time.process_time() - start_cpu
+        frames = broadcaster.published_frames - start_frames
+        elapsed = end_time - start_time
+
+        stream_task.cancel()
+        await detector.stop_module()
+        dropped_serial_frames = detector.com.dropped_frames
+        dropped_client_frames = broadcaster.dropped_frames
+        framing_errors = detector.framing_errors
+        # give the queued frames a moment to reach the clients, then disconnect them
+        await asyncio.sleep(0.2)
+        server.close()
+        await server.wait_closed()
+        server_main.detectors.close(SENSOR_ID)
+        # the task can miss the cancellation while a frame arrives, it ends when the port is closed
+        await asyncio.gather(stream_task, return_exceptions=True)
+    server_main.frame_bus.close()
+    server_main.frame_bus = None
+
+    simulator_connection.send('stop')
+    sent_times = await loop.run_in_executor(None, simulator_connection.recv)
+    latencies = []
+    delivered = 0
+    for process, connection in processes:
+        numbers, times = await loop.run_in_executor(None, connection.recv)
+        process.join()
+        for number, received in zip(numbers, times):
+            sent = sent_times[number]
+            if start_time <= sent < end_time:
+                delivered += 1
+                latencies.append(received - sent)
+    simulator.join()
+    latencies.sort()
+    sent_frames = sum(1 for sent in sent_times if start_time <= sent < end_time)
+
+    return {
+        'mode': mode,
+        'update_rate': update_rate,
+        'clients': clients,
+        'encoding': encoding,
+        'duration': elapsed,
+        'sent_fps': sent_frames / elapsed,
+        'decoded_fps': frames / elapsed,
+        'delivered_fps_per_client': delivered / elapsed / clients,
+        'latency_ms': {name: None if value is None else value * 1000
+                       for name, value in (('p50', percentile(latencies, 0.5)),
+                                           ('p99', percentile(latencies, 0.99)),
+                                           ('max', percentile(latencies, 1)))},
+        'cpu_us_per_frame': cpu / frames * 1e6 if frames else None,
+        'cpu_percent': cpu / elapsed * 100,
+        'dropped_serial_frames': dropped_serial_frames,
+        'dropped_client_frames': dropped_client_frames,
+        'framing_errors': framing_errors,
+    }
+
+
+def scenario_key(result):
+    return f"{result['mode']}/{result['update_rate']}Hz/{result['clients']}c/{result['encoding']}"
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change against a previous run
+    :param results:  list with the results of this run
+    :param baseline:  list with the results of the previous run
+    :param tolerance:  relative change in frames/s or p99 latency reported as a regression
+    :return:  number of regressions
+    """
+    previous = {scenario_key(result): result for result in baseline}
+    regressions = 0
+    for result in results:
+        key = scenario_key(result)
+        if key not in previous:
+            print(f'{key}: not in baseline')
+            continue
+        old = previous[key]
+        fps_change = result['decoded_fps'] / old['decoded_fps'] - 1 if old['decoded_fps'] else 0
+        old_p99, p99 = old['latency_ms']['p99'], result['latency_ms']['p99']
+        p99_change = p99 / old_p99 - 1 if old_p99 and p99 is not None else 0
+        regression = fps_change < -tolerance or p99_change > tolerance
+        regressions += regression
+        print(f'{key}: frames/s {fps_change:+.1%}, p99 latency {p99_change:+.1%}{" REGRESSION" if regression else ""}')
+    return regressions
+
+
+def csv(cast):
+    return lambda text: [cast(item) for item in text.split(',')]
+
+
+async def run(args):
+    results = []
+    for mode in args.modes:
+        for update_rate in args.rates:
+            for clients in args.clients:
+                for encoding in args.encodings:
+                    result = await run_scenario(mode, update_rate, clients, encoding, args.duration, args.warmup,
+                                                args.client_processes)
+                    latency = result['latency_ms']
+                    print(f"{scenario_key(result)}: {result['decoded_fps']:.1f} frames/s decoded, "
+                          f"{result['delivered_fps_per_client']:.1f} delivered per client, "
+                          f"latency p50 {latency['p50'] or 0:.2f} ms p99 {latency['p99'] or 0:.2f} ms, "
+                          f"{result['cpu_us_per_frame'] or 0:.0f} us CPU per frame", file=sys.stderr)
+                    results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the radar streaming path')
+    parser.add_argument('--modes', type=csv(str.lower), default=['presence'],
+                        help=f'comma separated detector modes: {", ".join(DETECTOR_CLASSES)}')
+    parser.add_argument('--rates', type=csv(float), default=[10.0, 50.0, 200.0], help='update rates in Hz')
+    parser.add_argument('--clients', type=csv(int), default=[1, 10], help='numbers of websocket clients')
+    parser.add_argument('--encodings', type=csv(str), default=['json'], help='wire formats: json, struct, msgpack')
+    parser.add_argument('--duration', type=float, default=5, help='seconds measured per scenario')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds streamed before measuring')
+    parser.add_argument('--client-processes', type=int, default=2, help='processes the clients are spread over')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+    for mode in args.modes:
+        if mode not in DETECTOR_CLASSES:
+            parser.error(f'Unknown mode {mode}')
+    if 'msgpack' in args.encodings and msgpack is None:
+        parser.error('The msgpack encoding needs the msgpack package')
+
+    results = asyncio.run(run(args))
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'settings': {'duration': args.duration, 'warmup': args.warmup, 'client_processes': args.client_processes},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
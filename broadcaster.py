@@ -0,0 +1,445 @@
+import asyncio
+import collections
+import time
+from websockets.exceptions import ConnectionClosed
+from wire_format import make_encoders
+from metrics import registry
+
+SEND_LATENCY = registry.histogram('send_seconds',
+                                  'Time from receiving a stream frame to handing it to the websocket of a client')
+
+
+class Subscriber:
+    """
+    A connected client with its own bounded send queue and writer task, so a slow client only delays itself. Frames
+    pass through the subscription of the client first: decimation, change detection, rate limiting with latest-value
+    coalescing or batching. Decimation and rate limiting apply to every stream of every sensor on its own.
+    """
+
+    def __init__(self, websocket, broadcaster, encoding='json'):
+        self.websocket = websocket
+        self.broadcaster = broadcaster
+        # wire format negotiated by the client
+        self.encoding = encoding
+        self.queue = asyncio.Queue(maxsize=broadcaster.queue_size)
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        # presence frames not sent because nothing changed
+        self.suppressed_frames = 0
+        # subscription: send every decimation'th frame, at most one message per min_interval seconds, frames
+        # collected for batch_window seconds are sent as one message
+        self.decimation = 1
+        self.min_interval = 0
+        self.batch_window = 0
+        # change-driven mode: presence frames are only sent when presence flips or score or distance move more than
+        # their dead-band from the last sent values, and at least every keyframe_interval seconds
+        self.change_only = False
+        self.score_deadband = 0.0
+        self.distance_deadband = 0.0
+        self.keyframe_interval = 10.0
+        # last sent (presence, score, distance, monotonic time) by sensor
+        self._last_values = {}
+        # sequence number of the first frame of every sensor passed to the client live
+        self.first_seq = {}
+        # live frames are held for the resume grace period of the broadcaster after connecting, so the frames a
+        # resuming client missed go out before them. Sensors in _released were resumed and are live already. Only
+        # the latest frames that fit in the send queue are kept, the others are in the replay buffer
+        self._held = collections.deque(maxlen=broadcaster.queue_size)
+        self._released = set()
+        self._hold_handle = None
+        if broadcaster.resume_grace:
+            self._hold_handle = asyncio.get_running_loop().call_later(broadcaster.resume_grace, self.release)
+        # by (sensor, stream): frames seen, monotonic time of the last frame sent, frame waiting for the end of the
+        # rate limit interval and the timer sending it
+        self._frame_count = collections.Counter()
+        self._last_sent = {}
+        self._pending = {}
+        self._pending_handles = {}
+        self._batch = []
+        self._batch_handle = None
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def subscribe(self, max_rate=0, decimation=1, batch_window=0, change_only=False, score_deadband=0.0,
+                  distance_deadband=0.0, keyframe_interval=10.0):
+        """
+        Change the subscription of the client
+        :param max_rate:  maximum number of messages per second, 0 for no limit. Frames in between are coalesced, only
+        the latest one is sent
+        :param decimation:  only every decimation'th frame is considered
+        :param batch_window:  seconds during which frames are collected and sent as one batch message, 0 to send
+        every frame on its own
+        :param change_only:  only send presence frames that differ from the last sent one
+        :param score_deadband:  smallest change of the score that counts as a change
+        :param distance_deadband:  smallest change of the distance in meters that counts as a change
+        :param keyframe_interval:  seconds after which a presence frame is sent even if nothing changed
+        :return:  None
+        """
+        if max_rate < 0 or batch_window < 0 or decimation < 1:
+            raise ValueError('max_rate and batch_window must be positive, decimation at least 1')
+        if score_deadband < 0 or distance_deadband < 0 or keyframe_interval <= 0:
+            raise ValueError('Dead-bands must be positive, keyframe_interval greater than 0')
+        self._cancel_flush()
+        self._pending = {}
+        self._batch = []
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.decimation = int(decimation)
+        self.batch_window = batch_window
+        self.change_only = change_only
+        self.score_deadband = score_deadband
+        self.distance_deadband = distance_deadband
+        self.keyframe_interval = keyframe_interval
+        # the next frame of every sensor is a keyframe
+        self._last_values = {}
+
+    def push(self, frame):
+        """
+        Pass a frame through the subscription
+        :param frame:  StreamFrame published by the broadcaster
+        :return:  None
+        """
+        if self._hold_handle is not None and frame.sensor not in self._released:
+            self._held.append(frame)
+            return
+        if frame.sensor not in self.first_seq:
+            self.first_seq[frame.sensor] = frame.seq
+        key = (frame.sensor, frame.stream)
+        self._frame_count[key] += 1
+        if self._frame_count[key] % self.decimation:
+            return
+        if self.change_only and frame.stream == 'presence' and not self._changed(frame):
+            self.suppressed_frames += 1
+            return
+        if self.batch_window:
+            self._batch.append(frame)
+            if self._batch_handle is None:
+                self._batch_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_batch)
+            return
+        if self.min_interval:
+            now = time.monotonic()
+            wait = self._last_sent.get(key, 0) + self.min_interval - now
+            if wait > 0:
+                # too early, keep only the latest frame of this sensor and stream and send it when the interval is over
+                self._pending[key] = frame
+                if key not in self._pending_handles:
+                    self._pending_handles[key] = asyncio.get_running_loop().call_later(wait, self._flush_pending, key)
+                return
+            self._last_sent[key] = now
+        self._send(self.broadcaster.encode(frame, self.encoding), frame.received)
+
+    def holding(self, sensor):
+        """
+        Check if the live frames of a sensor are still held for the resume grace period
+        :param sensor:  id of the sensor
+        :return:  bool
+        """
+        return self._hold_handle is not None and sensor not in self._released
+
+    def release(self, sensor=None):
+        """
+        Stop holding the live frames
+        :param sensor:  id of the resumed sensor, its held frames are dropped because the resume batch has them. None
+        at the end of the grace period, the held frames of all sensors are passed on in order, the client starts with
+        them
+        :return:  None
+        """
+        if self._hold_handle is None:
+            return
+        if sensor is not None:
+            self._released.add(sensor)
+            self._held = collections.deque((frame for frame in self._held if frame.sensor != sensor),
+                                           maxlen=self._held.maxlen)
+            return
+        self._hold_handle.cancel()
+        self._hold_handle = None
+        held = list(self._held)
+        self._held.clear()
+        for frame in held:
+            self.push(frame)
+
+    def _changed(self, frame):
+        """
+        Check if a presence frame has to be sent in change-driven mode, and remember it if so
+        """
+        data = frame.data
+        presence = bool(data['presence'])
+        last = self._last_values.get(frame.sensor)
+        if (last is not None and presence == last[0]
+                and abs(data['score'] - last[1]) <= self.score_deadband
+                and abs(data['distance'] - last[2]) <= self.distance_deadband
+                and frame.received - last[3] < self.keyframe_interval):
+            return False
+        self._last_values[frame.sensor] = (presence, data['score'], data['distance'], frame.received)
+        return True
+
+    def send_batch(self, frames):
+        """
+        Queue frames as one batch message, bypassing the subscription
+        :param frames:  list of StreamFrame
+        :return:  None
+        """
+        self._send(self.broadcaster.encode_batch(frames, self.encoding), frames[0].received)
+
+    def offer(self, payload, received, drop_oldest=True) -> bool:
+        """
+        Queue an encoded frame for sending without waiting
+        :param payload:  encoded frame
+        :param received:  monotonic time the (oldest) frame in payload was received from the module
+        :param drop_oldest:  make room by dropping the oldest queued frame when the queue is full
+        :return:  False if the queue is full and the frame was not queued
+        """
+        if self.queue.full():
+            if not drop_oldest:
+                return False
+            self.queue.get_nowait()
+            self.dropped_frames += 1
+        self.queue.put_nowait((payload, received))
+        return True
+
+    def close(self):
+        """
+        Stop the writer task, frames still queued or held are discarded
+        """
+        if self._hold_handle is not None:
+            self._hold_handle.cancel()
+            self._hold_handle = None
+            self._held.clear()
+        self._cancel_flush()
+        self._writer_task.cancel()
+
+    def _send(self, payload, received):
+        if not self.offer(payload, received, self.broadcaster.slow_consumer_policy == Broadcaster.DROP_OLDEST):
+            self.broadcaster.drop_client(self.websocket)
+
+    def _flush_batch(self):
+        self._batch_handle = None
+        if self._batch:
+            frames, self._batch = self._batch, []
+            self._send(self.broadcaster.encode_batch(frames, self.encoding), frames[0].received)
+
+    def _flush_pending(self, key):
+        del self._pending_handles[key]
+        frame = self._pending.pop(key, None)
+        if frame is not None:
+            self._last_sent[key] = time.monotonic()
+            self._send(self.broadcaster.encode(frame, self.encoding), frame.received)
+
+    def _cancel_flush(self):
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        for handle in self._pending_handles.values():
+            handle.cancel()
+        self._pending_handles = {}
+
+    async def _writer(self):
+        while True:
+            payload, received = await self.queue.get()
+            try:
+                await self.websocket.send(payload)
+            except ConnectionClosed:
+                return
+            SEND_LATENCY.since(received)
+            self.sent_frames += 1
+
+
+class Broadcaster:
+    """
+    Fan-out of stream frames to all connected clients. Every frame is encoded at most once per wire format in use and
+    put in the send queue of each subscriber, publishing never waits for a client. The latest frames of every sensor
+    are kept so a reconnecting client can get the frames it missed, before any live frame.
+    """
+
+    # what to do with a client whose send queue is full
+    DROP_OLDEST = 'drop_oldest'
+    DROP_CLIENT = 'drop_client'
+
+    def __init__(self, queue_size=16, slow_consumer_policy=DROP_OLDEST, replay_size=256, epoch=None,
+                 resume_grace=0.5):
+        """
+        :param queue_size:  frames queued per client before the slow consumer policy kicks in
+        :param slow_consumer_policy:  DROP_OLDEST or DROP_CLIENT
+        :param replay_size:  frames kept per sensor for clients resuming their stream
+        :param epoch:  epoch of the sequence numbers, now if None. Fan-out workers take the one of the acquisition
+        process
+        :param resume_grace:  seconds the live frames of a new client are held for its resume, 0 to send them right
+        away
+        """
+        if slow_consumer_policy not in (self.DROP_OLDEST, self.DROP_CLIENT):
+            raise ValueError(f'Unknown slow consumer policy {slow_consumer_policy}')
+        self.queue_size = queue_size
+        self.replay_size = replay_size
+        self.resume_grace = resume_grace
+        # sequence numbers start over when the server restarts, a different epoch tells the clients
+        self.epoch = int(time.time() * 1000) if epoch is None else epoch
+        # latest frames by sensor
+        self._replay = {}
+        self.slow_consumer_policy = slow_consumer_policy
+        self.subscribers = {}
+        self.encoders = make_encoders()
+        self.published_frames = 0
+        # next sequence number by sensor
+        self._next_seq = {}
+        self.dropped_clients = 0
+        # frames dropped and suppressed by subscribers that are gone, the live ones keep their own count
+        self._dropped_frames_closed = 0
+        self._suppressed_frames_closed = 0
+
+    def __contains__(self, websocket):
+        return websocket in self.subscribers
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    @property
+    def dropped_frames(self):
+        """
+        Number of frames dropped for slow clients
+        """
+        return self._dropped_frames_closed + sum(s.dropped_frames for s in self.subscribers.values())
+
+    @property
+    def suppressed_frames(self):
+        """
+        Number of unchanged presence frames not sent to clients in change-driven mode
+        """
+        return self._suppressed_frames_closed + sum(s.suppressed_frames for s in self.subscribers.values())
+
+    def add(self, websocket):
+        """
+        Start sending stream frames to websocket
+        :param websocket:  websocket of the client
+        :return:  Subscriber of the client
+        """
+        subscriber = Subscriber(websocket, self)
+        self.subscribers[websocket] = subscriber
+        return subscriber
+
+    def remove(self, websocket):
+        """
+        Stop sending stream frames to websocket
+        :param websocket:  websocket of the client
+        :return:  None
+        """
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is not None:
+            subscriber.close()
+            self._dropped_frames_closed += subscriber.dropped_frames
+            self._suppressed_frames_closed += subscriber.suppressed_frames
+
+    def drop_client(self, websocket):
+        """
+        Disconnect a client that can't keep up
+        :param websocket:  websocket of the client
+        :return:  None
+        """
+        print("Dropping slow client")
+        self.dropped_clients += 1
+        self.remove(websocket)
+        asyncio.create_task(websocket.close(code=1013, reason='Client too slow'))
+
+    def set_encoding(self, websocket, encoding):
+        """
+        Change the wire format of the stream frames sent to websocket
+        :param websocket:  websocket of the client
+        :param encoding:  name of the wire format
+        :return:  None
+        """
+        if encoding not in self.encoders:
+            raise ValueError(f'Unknown encoding {encoding}, available: {", ".join(self.encoders)}')
+        self.subscribers[websocket].encoding = encoding
+
+    def subscribe(self, websocket, **subscription):
+        """
+        Change the subscription of a client, see Subscriber.subscribe
+        """
+        self.subscribers[websocket].subscribe(**subscription)
+
+    def encode(self, frame, encoding):
+        """
+        Encode frame in the given wire format, the result is kept with the frame so every format is encoded once
+        :param frame:  StreamFrame to encode
+        :param encoding:  name of the wire format
+        :return:  encoded frame
+        """
+        payload = frame.encoded.get(encoding)
+        if payload is None:
+            payload = frame.encoded[encoding] = self.encoders[encoding].encode(frame)
+        return payload
+
+    def encode_batch(self, frames, encoding):
+        """
+        Encode several frames as one batch message
+        :param frames:  list of StreamFrame
+        :param encoding:  name of the wire format
+        :return:  encoded batch
+        """
+        return self.encoders[encoding].encode_batch([self.encode(frame, encoding) for frame in frames])
+
+    def publish(self, frame, assign_seq=True):
+        """
+        Assign the next sequence number of its sensor to frame and pass it to every subscriber
+        :param frame:  StreamFrame to send
+        :param assign_seq:  False to keep the sequence number of the frame, for frames numbered by another process
+        :return:  None
+        """
+        if assign_seq:
+            frame.seq = self._next_seq.get(frame.sensor, 0)
+        self._next_seq[frame.sensor] = frame.seq + 1
+        self.published_frames += 1
+        replay = self._replay.get(frame.sensor)
+        if replay is None:
+            replay = self._replay[frame.sensor] = collections.deque(maxlen=self.replay_size)
+        replay.append(frame)
+        # iterate over a copy, subscribers can be removed while publishing
+        for subscriber in list(self.subscribers.values()):
+            subscriber.push(frame)
+
+    def next_seq(self, sensor):
+        """
+        Sequence number the next frame of a sensor will get
+        :param sensor:  id of the sensor
+        :return:  int
+        """
+        return self._next_seq.get(sensor, 0)
+
+    def resume(self, websocket, sensor, last_seq, epoch=None):
+        """
+        Send a reconnected client the frames of a sensor it missed, as one batch message in its wire format, then
+        switch the sensor to live. Within the resume grace period the client hasn't been sent a live frame of the
+        sensor yet, the batch holds every frame up to now and goes out first. After it, frames the client already
+        got live are not repeated and the batch comes after them.
+        :param websocket:  websocket of the client
+        :param sensor:  id of the sensor
+        :param last_seq:  sequence number of the last frame the client received, -1 for none
+        :param epoch:  epoch of last_seq, see self.epoch. None to skip the check
+        :return:  dictionary with the number of frames replayed and the number of missed frames that are no longer
+        kept
+        :raises ValueError:  if the server restarted since last_seq, the sequence numbers have started over
+        """
+        if epoch is not None and epoch != self.epoch:
+            raise ValueError(f'The stream restarted, epoch is now {self.epoch}')
+        subscriber = self.subscribers[websocket]
+        if subscriber.holding(sensor):
+            until = self.next_seq(sensor)
+        else:
+            until = subscriber.first_seq.get(sensor, self.next_seq(sensor))
+        frames = [frame for frame in self._replay.get(sensor, ()) if last_seq < frame.seq < until]
+        if frames:
+            subscriber.send_batch(frames)
+        subscriber.release(sensor)
+        first_replayed = frames[0].seq if frames else until
+        return {'replayed': len(frames), 'lost': max(first_replayed - last_seq - 1, 0)}
+
+    def stats(self):
+        """
+        Counters of the fan-out
+        :return:  dictionary with the counters
+        """
+        return {
+            'clients': len(self.subscribers),
+            'published_frames': self.published_frames,
+            'dropped_frames': self.dropped_frames,
+            'suppressed_frames': self.suppressed_frames,
+            'dropped_clients': self.dropped_clients,
+            'encodings': {name: encoder.stats() for name, encoder in self.encoders.items()},
+        }
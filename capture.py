@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+
+
+class CaptureError(Exception):
+    """
+    A capture file is missing, truncated or has an unknown format
+    """
+
+
+class CaptureWriter:
+    """
+    Records raw stream frames to a capture file with a side index.
+
+    Capture file: magic b'RCAP', version (uint8), metadata length (uint32), metadata (JSON), then one record per frame:
+    monotonic timestamp in seconds (float64), payload length (uint32), payload as received from the module.
+    Index file: magic b'RIDX', version (uint8), then one entry per frame: timestamp (float64), offset of the record in
+    the capture file (uint64). The fixed size entries let a reader binary search the mmapped index.
+
+    Records are buffered in memory and written in batches, the files are never fsynced.
+    """
+
+    MAGIC = b'RCAP'
+    INDEX_MAGIC = b'RIDX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBI')
+    INDEX_HEADER = struct.Struct('<4sB')
+    RECORD = struct.Struct('<dI')
+    INDEX_ENTRY = struct.Struct('<dQ')
+
+    def __init__(self, path, metadata=None, batch_size=64, flush_interval=1.0):
+        """
+        :param path:  path of the capture file, the index is written next to it with the extension .idx
+        :param metadata:  dictionary stored in the header, e.g. the mode and registers needed to decode the frames
+        :param batch_size:  number of frames buffered before they are written
+        :param flush_interval:  maximum number of seconds a frame stays in the buffer
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.frames = 0
+        metadata = json.dumps(metadata or {}).encode()
+        self._file = open(path, 'wb')
+        self._index_file = open(index_path(path), 'wb')
+        self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(metadata)) + metadata)
+        self._index_file.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, self.VERSION))
+        # the headers go out right away so the capture can be read while it is being written
+        self._file.flush()
+        self._index_file.flush()
+        self._offset = self.HEADER.size + len(metadata)
+        self._records = bytearray()
+        self._index = bytearray()
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, payload, timestamp=None):
+        """
+        Add a raw stream frame to the capture
+        :param payload:  stream payload as returned by SerialCom.read_stream
+        :param timestamp:  monotonic time the frame was received, now if None
+        :return:  None
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._index.extend(self.INDEX_ENTRY.pack(timestamp, self._offset))
+        self._records.extend(self.RECORD.pack(timestamp, len(payload)))
+        self._records.extend(payload)
+        self._offset += self.RECORD.size + len(payload)
+        self._buffered += 1
+        self.frames += 1
+        if self._buffered >= self.batch_size or timestamp - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered frames to the files. The records are written before the index, so a reader never finds an
+        index entry without its record.
+        :return:  None
+        """
+        if self._records:
+            self._file.write(self._records)
+            self._file.flush()
+            self._index_file.write(self._index)
+            self._index_file.flush()
+            self._records.clear()
+            self._index.clear()
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Write the buffered frames and close the files
+        :return:  None
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        self._index_file.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture file written by CaptureWriter. Both files are mmapped, seeking to a time uses a binary search on the
+    index so the frames are never scanned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path(path), 'rb') as file:
+            self._index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, metadata_length = CaptureWriter.HEADER.unpack_from(self._data, 0)
+            index_magic, index_version = CaptureWriter.INDEX_HEADER.unpack_from(self._index, 0)
+        except struct.error:
+            raise CaptureError(f'{path} is too short to be a capture')
+        if magic != CaptureWriter.MAGIC or index_magic != CaptureWriter.INDEX_MAGIC:
+            raise CaptureError(f'{path} is not a capture file')
+        if version != CaptureWriter.VERSION or index_version != CaptureWriter.VERSION:
+            raise CaptureError(f'Unsupported capture version {version}')
+        start = CaptureWriter.HEADER.size
+        self.metadata = json.loads(self._data[start:start + metadata_length])
+        # a capture that is still being written can end with an incomplete index entry
+        self._count = (len(self._index) - CaptureWriter.INDEX_HEADER.size) // CaptureWriter.INDEX_ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        """
+        Get a frame by position
+        :param position:  number of the frame in the capture
+        :return:  (timestamp, payload) with payload a memoryview into the mmapped file
+        """
+        if not 0 <= position < self._count:
+            raise IndexError('Frame position out of range')
+        _timestamp, offset = self._entry(position)
+        timestamp, length = CaptureWriter.RECORD.unpack_from(self._data, offset)
+        offset += CaptureWriter.RECORD.size
+        return timestamp, memoryview(self._data)[offset:offset + length]
+
+    def timestamp(self, position):
+        """
+        Get the timestamp of a frame without reading the frame
+        :param position:  number of the frame in the capture
+        :return:  monotonic timestamp of the frame
+        """
+        return self._entry(position)[0]
+
+    def find(self, timestamp):
+        """
+        Find the first frame received at or after timestamp
+        :param timestamp:  monotonic time
+        :return:  position of the frame, len(self) if all frames are older
+        """
+        return bisect.bisect_left(range(self._count), timestamp, key=self.timestamp)
+
+    def frames(self, start=None, end=None):
+        """
+        Iterate over the frames in a time range
+        :param start:  monotonic time of the first frame, the start of the capture if None
+        :param end:  monotonic time after the last frame, the end of the capture if None
+        :return:  iterator of (timestamp, payload)
+        """
+        first = 0 if start is None else self.find(start)
+        last = self._count if end is None else self.find(end)
+        for position in range(first, last):
+            yield self[position]
+
+    def close(self):
+        """
+        Unmap the files
+        :return:  None
+        """
+        self._data.close()
+        self._index.close()
+
+    def _entry(self, position):
+        return CaptureWriter.INDEX_ENTRY.unpack_from(
+            self._index, CaptureWriter.INDEX_HEADER.size + position * CaptureWriter.INDEX_ENTRY.size)
+
+
+def capture_path(directory, name):
+    """
+    Path of a capture file in the capture directory, for names sent by clients
+    :param directory:  directory the captures are kept in
+    :param name:  bare file name with the extension .cap
+    :return:  path of the capture file
+    :raises ValueError:  if the name is not a bare .cap file name, e.g. contains a path separator or ..
+    """
+    if (not name or name != os.path.basename(name) or '\\' in name or '..' in name
+            or not name.endswith('.cap') or name == '.cap'):
+        raise ValueError(f'Invalid capture name {name!r}, expected a file name like capture.cap')
+    return os.path.join(directory, name)
+
+
+def index_path(path):
+    """
+    Path of the index file of a capture
+    :param path:  path of the capture file
+    :return:  path of the index file
+    """
+    return os.path.splitext(path)[0] + '.idx'
+
+
+async def replay(reader, detector, data_handler_func=None, speed=1.0, start=None, end=None):
+    """
+    Feed the frames of a capture through the decode path of a detector, as if they came from the module
+    :param reader:  CaptureReader
+    :param detector:  detector whose process_stream decodes the frames
+    :param data_handler_func:  coroutine function called with every decoded frame, like for a live stream
+    :param speed:  1 for the original timing, 2 for twice as fast, 0 as fast as possible
+    :param start:  monotonic time of the first frame to replay, the start of the capture if None
+    :param end:  monotonic time after the last frame to replay, the end of the capture if None
+    :return:  number of frames replayed
+    """
+    replayed = 0
+    first_timestamp = None
+    replay_start = time.monotonic()
+    for timestamp, payload in reader.frames(start, end):
+        # decoded frames can outlive the mmap (queued for slow clients), so they get their own copy. The view is
+        # released right away, the reader can't be closed while one exists, e.g. when the replay is cancelled
+        with payload:
+            stream = bytes(payload)
+        if speed:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.monotonic() - replay_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # let the other tasks run between frames
+            await asyncio.sleep(0)
+        await detector.process_stream(stream, data_handler_func)
+        replayed += 1
+    return replayed
@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import functools
+import json
+
+# id of the request being handled, every request runs in its own task with its own value
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+async def respond(websocket, message):
+    """
+    Send a response to a request, tagged with the id of the request if it had one
+    :param websocket:  websocket of the client
+    :param message:  dictionary with the response
+    :return:  None
+    """
+    rid = request_id.get()
+    if rid is not None:
+        message = dict(message, id=rid)
+    await websocket.send(json.dumps(message))
+
+
+def decode_message(payload):
+    """
+    Decode a message received from a client
+    :param payload:  JSON text of the message
+    :return:  dictionary with the message
+    :raises ValueError:  if the payload is not a JSON object
+    """
+    message = json.loads(payload)
+    if not isinstance(message, dict):
+        raise ValueError('Expected a JSON object')
+    return message
+
+
+class Field:
+    """
+    A field of the data of a command: how it is converted, and whether it is required or its default
+    """
+
+    __slots__ = ('converter', 'required', 'default')
+
+    def __init__(self, converter=None, required=True, default=None):
+        """
+        :param converter:  function converting the received value, e.g. int, None to take it as it is
+        :param required:  True if the command fails without the field
+        :param default:  value of an optional field that was not sent
+        """
+        self.converter = converter
+        self.required = required
+        self.default = default
+
+
+def optional(converter=None, default=None):
+    """
+    Field that is not required
+    :param converter:  see Field
+    :param default:  value if the field was not sent
+    :return:  Field
+    """
+    return Field(converter, required=False, default=default)
+
+
+class Command:
+    """
+    A request or command clients can send: its handler, the validation of its data, compiled when it is registered,
+    and whether it is serialized with the other serial commands of the same sensor
+    """
+
+    __slots__ = ('kind', 'name', 'handler', 'fields', 'serial')
+
+    def __init__(self, kind, name, handler, fields=None, serial=False):
+        """
+        :param kind:  'req' or 'cmd'
+        :param name:  name of the request or command
+        :param handler:  coroutine function called with the websocket and the validated data
+        :param fields:  dictionary with the field name as key and a Field or a converter (required field) as value,
+        None to pass the data on unchecked. Fields that are not listed are passed on as they are
+        :param serial:  True for commands that change the state of the module, they run one at a time per sensor
+        """
+        self.kind = kind
+        self.name = name
+        self.handler = handler
+        self.serial = serial
+        if fields is None:
+            self.fields = None
+        else:
+            # (name, converter, required, default) of every field
+            self.fields = tuple((name, field.converter, field.required, field.default)
+                                for name, field in ((name, field if isinstance(field, Field) else Field(field))
+                                                    for name, field in fields.items()))
+
+    def validate(self, data):
+        """
+        Check and convert the data of a message
+        :param data:  data of the message
+        :return:  dictionary with the converted fields
+        :raises ValueError:  if a required field is missing or a value can't be converted
+        """
+        if self.fields is None:
+            return data
+        data = dict(data) if isinstance(data, dict) else {}
+        for name, converter, required, default in self.fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise ValueError(f'{self.name}: {name} is missing')
+                data[name] = default
+            elif converter is not None:
+                try:
+                    data[name] = converter(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f'{self.name}: invalid {name} {value!r}') from None
+        return data
+
+    def bind(self, *args):
+        """
+        Copy of the command whose handler gets args before the websocket, e.g. the Broadcaster of the process
+        :return:  Command
+        """
+        command = Command(self.kind, self.name, functools.partial(self.handler, *args), serial=self.serial)
+        command.fields = self.fields
+        return command
+
+
+class CommandRegistry:
+    """
+    The requests and commands clients can send, registered with the command decorator where the handlers are
+    defined. Every message is handled in its own task, so a slow command doesn't hold up the other requests of the
+    client. Commands registered as serial (the ones reconfiguring a module) wait for each other per sensor, in the
+    order they arrived. Responses carry the id the request was sent with, see respond.
+
+    Message: {'cmd' or 'req': name, 'data': data, 'id': optional request id}
+    """
+
+    def __init__(self, serial_key=None):
+        """
+        :param serial_key:  function getting the sensor id from the data of a serial command
+        """
+        self.commands = {}
+        self.serial_key = serial_key
+        # lock by sensor id, asyncio locks are granted in the order they were asked for
+        self._locks = {}
+        self._tasks = set()
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def command(self, kind, name, fields=None, serial=False):
+        """
+        Decorator registering a handler, see Command. Can be stacked to register a handler under several names
+        """
+        def register(handler):
+            self.add(Command(kind, name, handler, fields, serial))
+            return handler
+        return register
+
+    def add(self, command):
+        """
+        Register a command, replacing one with the same kind and name
+        :param command:  Command
+        :return:  None
+        """
+        self.commands[command.kind, command.name] = command
+
+    def update(self, commands):
+        """
+        Register several commands
+        :param commands:  iterable of Command
+        :return:  None
+        """
+        for command in commands:
+            self.add(command)
+
+    def bound(self, *args):
+        """
+        The commands of this registry with handlers getting args before the websocket, see Command.bind
+        :return:  list of Command
+        """
+        return [command.bind(*args) for command in self]
+
+    def find(self, message):
+        """
+        Get the command of a message
+        :param message:  decoded message
+        :return:  Command, None if the command is unknown
+        """
+        kind = 'cmd' if 'cmd' in message else 'req'
+        return self.commands.get((kind, message.get(kind)))
+
+    def start(self, websocket, message):
+        """
+        Handle a message in a new task, returns right away
+        :param websocket:  websocket of the client
+        :param message:  decoded message
+        :return:  asyncio.Task
+        """
+        task = asyncio.create_task(self.handle(websocket, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def handle(self, websocket, message):
+        """
+        Validate a message and run its handler, errors are sent to the client as a failed ack
+        :param websocket:  websocket of the client
+        :param message:  decoded message
+        :return:  None
+        """
+        request_id.set(message.get('id'))
+        try:
+            command = self.find(message)
+            if command is None:
+                kind = 'cmd' if 'cmd' in message else 'req'
+                raise ValueError(f'Unknown {kind} {message.get(kind)}')
+            data = command.validate(message.get('data'))
+            if command.serial:
+                lock = self._locks.setdefault(self.serial_key(data), asyncio.Lock())
+                async with lock:
+                    await command.handler(websocket, data)
+            else:
+                await command.handler(websocket, data)
+        except Exception as e:
+            print(f"Request failed: {type(e).__name__}: {e}")
+            try:
+                await respond(websocket, {'ack': 'failed', 'data': {'comment': str(e)}})
+            except Exception:
+                # the client is gone
+                pass
@@ -1,5 +1,11 @@
+import asyncio
+import collections
+import struct
 import time
-import serial
+from metrics import registry
+
+REGISTER_ROUND_TRIP = registry.histogram('register_round_trip_seconds',
+                                         'Time from sending a register or buffer request to its reply')
 
 
 class ModuleError(Exception):
@@ -8,88 +14,424 @@ class ModuleError(Exception):
     """
 
 
+class FramingError(Exception):
+    """
+    A packet or stream buffer received from the module is malformed
+    """
+
+
+class PacketParser:
+    """
+    Incremental parser for the 0xCC ... 0xCD framed packets of the module. Received bytes are appended to one reusable
+    buffer and packets are handed out as memoryviews into it, so no intermediate copies are made. After a corrupted
+    packet the parser resynchronizes on the next 0xCC start marker and counts the bytes it had to skip.
+
+    A corrupted length must not make the parser wait for bytes that never come: the length of a packet type that is
+    not known or longer than its type allows is rejected right away. While the parser waits for the rest of a
+    stream frame or buffer reply, it looks ahead for a complete packet in the bytes received in the meantime, finding
+    one means the length was corrupted.
+    """
+
+    START_MARKER = 0xCC
+    END_MARKER = 0xCD
+    # start marker, payload length, packet type
+    HEADER = struct.Struct('<BHB')
+    # longest payload of every packet type the module sends, None for the variable length ones (max_payload_length):
+    # register write reply, register read reply, buffer read reply, stream frame
+    MAX_PAYLOAD_LENGTHS = {0xF5: 5, 0xF6: 5, 0xF7: None, 0xFE: None}
+
+    def __init__(self, max_payload_length=32768):
+        self.max_payload_length = max_payload_length
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self._buffer = bytearray()
+        # bytes after the start of an incomplete packet already looked ahead in
+        self._scanned = 0
+
+    def feed(self, data, packet_handler):
+        """
+        Add received bytes and call packet_handler(packet_type, payload) for every complete packet. payload is a
+        memoryview that is only valid during the call, copy it to keep it.
+        :param data:  bytes received from the module
+        :param packet_handler:  function called with the packet type and payload of each packet
+        :return:  None
+        """
+        buffer = self._buffer
+        buffer.extend(data)
+        offset = 0
+        with memoryview(buffer) as view:
+            while True:
+                start = buffer.find(self.START_MARKER, offset)
+                if start < 0:
+                    self._drop(len(buffer) - offset)
+                    offset = len(buffer)
+                    break
+                if start != offset:
+                    self._drop(start - offset)
+                    offset = start
+                if len(buffer) - offset < self.HEADER.size:
+                    break
+                _start, length, packet_type = self.HEADER.unpack_from(buffer, offset)
+                end = offset + self.HEADER.size + length
+                if not self._plausible(packet_type, length):
+                    # corrupted header, skip the start marker and resynchronize
+                    self._drop(1)
+                    offset += 1
+                    self._scanned = 0
+                    continue
+                if len(buffer) <= end:
+                    if self._packet_ahead(buffer, offset):
+                        self._drop(1)
+                        offset += 1
+                        self._scanned = 0
+                        continue
+                    break
+                self._scanned = 0
+                if buffer[end] != self.END_MARKER:
+                    self._drop(1)
+                    offset += 1
+                    continue
+                payload = view[offset + self.HEADER.size:end]
+                try:
+                    packet_handler(packet_type, payload)
+                finally:
+                    payload.release()
+                offset = end + 1
+        # compact once per chunk instead of once per packet
+        del buffer[:offset]
+
+    def _plausible(self, packet_type, length):
+        if packet_type not in self.MAX_PAYLOAD_LENGTHS:
+            return False
+        max_length = self.MAX_PAYLOAD_LENGTHS[packet_type]
+        return length <= (self.max_payload_length if max_length is None else max_length)
+
+    def _packet_ahead(self, buffer, offset):
+        """
+        Look for a complete packet after the header of the incomplete packet at offset
+        :return:  True if there is one, the length of the incomplete packet is corrupted then
+        """
+        position = offset + max(self._scanned, self.HEADER.size)
+        while True:
+            position = buffer.find(self.START_MARKER, position)
+            if position < 0 or len(buffer) - position < self.HEADER.size:
+                break
+            _start, length, packet_type = self.HEADER.unpack_from(buffer, position)
+            end = position + self.HEADER.size + length
+            if end >= len(buffer):
+                if self._plausible(packet_type, length):
+                    # can't tell yet, look again from here when more bytes arrived
+                    break
+            elif self._plausible(packet_type, length) and buffer[end] == self.END_MARKER:
+                return True
+            position += 1
+        self._scanned = (len(buffer) if position < 0 else position) - offset
+        return False
+
+    def _drop(self, count):
+        if count:
+            self.dropped_bytes += count
+            self.resyncs += 1
+
+
+class SerialProtocol(asyncio.Protocol):
+    """
+    asyncio protocol that owns the receiving side of the serial port. Every packet is parsed once and routed: stream
+    frames (0xFE) go into a bounded ring buffer, register and buffer replies resolve the pending request waiting for
+    that packet type and address.
+    """
+
+    # packet types of the replies that answer a request
+    REGISTER_WRITE_REPLY = 0xF5
+    REGISTER_READ_REPLY = 0xF6
+    BUFFER_READ_REPLY = 0xF7
+    STREAM = 0xFE
+
+    def __init__(self, stream_buffer_size=64):
+        self.transport = None
+        self.error = None
+        # ring buffer with (monotonic receive time, stream payload), the oldest frame is dropped when it is full
+        self.frames = collections.deque(maxlen=stream_buffer_size)
+        self.frame_ready = asyncio.Event()
+        # set when the connection is closed
+        self.closed = asyncio.Event()
+        self.received_frames = 0
+        self.dropped_frames = 0
+        # pending requests, (packet type, address) -> (future, monotonic send time) in the order the requests were sent
+        self._pending = {}
+        self.parser = PacketParser()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.parser.feed(data, self._route)
+
+    def connection_lost(self, exc):
+        # wake up everybody waiting for a packet
+        self.error = ConnectionError(f"Serial connection lost: {exc}")
+        for futures in self._pending.values():
+            for future, _sent in futures:
+                if not future.done():
+                    future.set_exception(self.error)
+        self._pending.clear()
+        self.frame_ready.set()
+        self.closed.set()
+
+    def expect(self, packet_type, address):
+        """
+        Register a request that waits for a reply of packet_type for address
+        :param packet_type:  packet type of the reply
+        :param address:  register address (or buffer id) in the first byte of the reply payload
+        :return:  future resolved with the reply payload
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.error is not None:
+            future.set_exception(self.error)
+        else:
+            self._pending.setdefault((packet_type, address), collections.deque()).append((future, time.monotonic()))
+        return future
+
+    def _route(self, packet_type, payload):
+        if packet_type == self.STREAM:
+            self.received_frames += 1
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped_frames += 1
+            # the only copy of a stream frame, the payload view is only valid during this call
+            self.frames.append((time.monotonic(), bytes(payload)))
+            self.frame_ready.set()
+            return
+
+        futures = self._pending.get((packet_type, payload[0] if payload else None))
+        # skip requests that were given up on (timed out or cancelled)
+        while futures:
+            future, sent = futures.popleft()
+            if not future.done():
+                future.set_result(bytes(payload))
+                REGISTER_ROUND_TRIP.since(sent)
+                return
+        print(f"Unexpected packet 0x{packet_type:02X} discarded")
+
+
 class SerialCom:
     """
     Simple class to communicate with the module software
     """
 
+    # 0xFD marker and length of the result info, 0xFE marker and length of the data
+    _STREAM_HEADER = struct.Struct('<BH')
+    # result info formats by number of entries, each entry is an address byte and a 4 byte value
+    _result_info_formats = {}
+
     @classmethod
     def decode_streaming_buffer(cls, stream):
         """
         Decode streaming buffer
         :param stream: streaming buffer
-        :return:  result_info, buffer (result_info is a dict with address as key and value as value)
+        :return:  result_info, buffer (result_info is a dict with address as key and value as value, buffer is a
+        memoryview into stream with the data)
+        :raises FramingError:  if the stream buffer is malformed
         """
-        # check if stream starts with 0xFD
-        assert stream[0] == 0xFD
-
-        # offset to start of result info
-        offset = 3
-        result_info = {}
+        try:
+            marker, info_length = cls._STREAM_HEADER.unpack_from(stream, 0)
+            if marker != 0xFD or info_length % 5:
+                raise FramingError(f"Invalid result info header 0x{marker:02X}, length {info_length}")
+            entries = info_length // 5
+            result_info_format = cls._result_info_formats.get(entries)
+            if result_info_format is None:
+                result_info_format = cls._result_info_formats[entries] = struct.Struct('<' + 'BI' * entries)
+            values = result_info_format.unpack_from(stream, 3)
 
-        # read result info until 0xFE is reached
-        while stream[offset] != 0xFE:
-            address = stream[offset]
-            offset += 1
-            value = int.from_bytes(stream[offset:offset + 4], byteorder='little')
-            offset += 4
-            result_info[address] = value
+            offset = 3 + info_length
+            marker, data_length = cls._STREAM_HEADER.unpack_from(stream, offset)
+        except struct.error as e:
+            raise FramingError(f"Stream buffer too short: {e}")
+        if marker != 0xFE:
+            raise FramingError(f"Invalid data header 0x{marker:02X}")
+        offset += cls._STREAM_HEADER.size
+        if len(stream) - offset != data_length:
+            raise FramingError(f"Data length {len(stream) - offset} does not match header {data_length}")
 
-        # read rest of buffer (contains data) and return it
-        buffer = stream[offset + 3:]
+        result_info = dict(zip(values[::2], values[1::2]))
+        buffer = memoryview(stream)[offset:]
         return result_info, buffer
 
-    def __init__(self, port, rtscts):
-        self._port = serial.Serial(port, 115200, rtscts=rtscts,
-                                   exclusive=True, timeout=2)
+    # UART speed of the module after power up
+    DEFAULT_BAUDRATE = 115200
 
-    def read_packet_type(self, packet_type):
+    def __init__(self, port, rtscts, timeout=2, connector=None, baudrate=DEFAULT_BAUDRATE):
+        self.port = port
+        self.rtscts = rtscts
+        self.timeout = timeout
+        self.baudrate = baudrate
+        # highest UART speed the link was verified at and the speeds that failed, see RadarModule.negotiate_baudrate
+        self.verified_baudrate = None
+        self.failed_baudrates = []
+        # coroutine function with the signature of create_serial_connection, e.g. to connect a simulated module. None
+        # for a real serial port, pyserial is imported when the first one is opened
+        self.connector = connector
+        self._transport = None
+        self._protocol = None
+
+    async def open(self):
         """
-        Read any packet of packet_type. Any packages received with
-        another type is discarded.
+        Open the serial port and start receiving packets in the background
         """
-        while True:
-            header, payload = self._read_packet()
-            if header[3] == packet_type:
-                break
-        return header, payload
+        if self.connector is None:
+            import serial_asyncio
+            self.connector = serial_asyncio.create_serial_connection
+        loop = asyncio.get_running_loop()
+        self._transport, self._protocol = await self.connector(
+            loop, SerialProtocol, self.port, baudrate=self.baudrate, rtscts=self.rtscts, exclusive=True)
 
-    def _read_packet(self):
-        header = self._port.read(4)
-        length = int.from_bytes(header[1:3], byteorder='little')
+    async def reopen(self, baudrate):
+        """
+        Close the serial port and open it again at another baud rate
+        :param baudrate:  new baud rate
+        :return:  None
+        """
+        protocol = self._protocol
+        self.close()
+        if protocol is not None:
+            # the port is released when the connection is lost
+            await asyncio.wait_for(protocol.closed.wait(), self.timeout)
+        self.baudrate = baudrate
+        await self.open()
 
-        data = self._port.read(length + 1)
-        assert data[-1] == 0xCD
-        payload = data[:-1]
-        return header, payload
+    def close(self):
+        """
+        Close the serial port
+        """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
 
-    def register_write(self, addr, value):
+    @property
+    def is_open(self):
         """
-        Write a register
+        True while the serial port is open
+        """
+        return self._transport is not None
+
+    @property
+    def received_frames(self):
+        """
+        Number of stream frames received from the module
+        """
+        return self._protocol.received_frames
+
+    @property
+    def dropped_frames(self):
+        """
+        Number of stream frames dropped because the ring buffer was full
+        """
+        return self._protocol.dropped_frames
+
+    @property
+    def dropped_bytes(self):
+        """
+        Number of received bytes skipped to resynchronize after corrupted packets
+        """
+        return self._protocol.parser.dropped_bytes
+
+    @property
+    def resyncs(self):
+        """
+        Number of times the packet parser had to resynchronize
+        """
+        return self._protocol.parser.resyncs
+
+    async def _request(self, data, packet_type, address):
+        """
+        Send a request and wait for the reply of packet_type for address. Stream frames received in the meantime are
+        kept in the ring buffer.
+        """
+        reply = self._protocol.expect(packet_type, address)
+        self._transport.write(data)
+        return await asyncio.wait_for(reply, self.timeout)
+
+    async def _request_many(self, requests, packet_type, timeout=None):
+        """
+        Send several requests back-to-back and collect the replies as they arrive
+        :param requests:  dictionary with address as key and request packet as value
+        :param packet_type:  packet type of the replies
+        :param timeout:  seconds to wait for the replies, the serial timeout if None
+        :return:  dictionary with address as key and the reply payload, or the exception for that request, as value
         """
+        if not requests:
+            return {}
+        replies = {addr: self._protocol.expect(packet_type, addr) for addr in requests}
+        self._transport.write(b''.join(requests.values()))
+        _done, pending = await asyncio.wait(replies.values(), timeout=self.timeout if timeout is None else timeout)
+        for reply in pending:
+            reply.cancel()
+        results = {}
+        for addr, reply in replies.items():
+            if reply.cancelled():
+                results[addr] = TimeoutError(f"No reply for register 0x{addr:02X}")
+            elif reply.exception() is not None:
+                results[addr] = reply.exception()
+            else:
+                results[addr] = reply.result()
+        return results
+
+    @staticmethod
+    def _register_write_packet(addr, value):
         data = bytearray()
         data.extend(b'\xcc\x05\x00\xf9')
         data.append(addr)
         data.extend(value.to_bytes(4, byteorder='little', signed=False))
         data.append(0xcd)
-        self._port.write(data)
-        _header, payload = self.read_packet_type(0xF5)
-        assert payload[0] == addr
+        return data
 
-    def register_read(self, addr):
-        """
-        Read a register
-        """
+    @staticmethod
+    def _register_read_packet(addr):
         data = bytearray()
         data.extend(b'\xcc\x01\x00\xf8')
         data.append(addr)
         data.append(0xcd)
-        self._port.write(data)
-        _header, payload = self.read_packet_type(0xF6)
-        assert payload[0] == addr
+        return data
+
+    async def register_write(self, addr, value):
+        """
+        Write a register
+        """
+        data = self._register_write_packet(addr, value)
+        await self._request(data, SerialProtocol.REGISTER_WRITE_REPLY, addr)
+
+    async def register_read(self, addr):
+        """
+        Read a register
+        """
+        data = self._register_read_packet(addr)
+        payload = await self._request(data, SerialProtocol.REGISTER_READ_REPLY, addr)
         return int.from_bytes(payload[1:5], byteorder='little', signed=False)
 
-    def buffer_read(self, offset):
+    async def register_write_many(self, values, timeout=None):
+        """
+        Write several registers without waiting for each acknowledgement before sending the next write
+        :param values:  dictionary with address as key and value as value, written in this order
+        :param timeout:  seconds to wait for the acknowledgements, the serial timeout if None
+        :return:  dictionary with address as key and None, or the exception if the write failed, as value
+        """
+        requests = {addr: self._register_write_packet(addr, value) for addr, value in values.items()}
+        results = await self._request_many(requests, SerialProtocol.REGISTER_WRITE_REPLY, timeout)
+        return {addr: result if isinstance(result, Exception) else None for addr, result in results.items()}
+
+    async def register_read_many(self, addresses, timeout=None):
+        """
+        Read several registers without waiting for each reply before sending the next read
+        :param addresses:  iterable with the addresses to read
+        :param timeout:  seconds to wait for the replies, the serial timeout if None
+        :return:  dictionary with address as key and value, or the exception if the read failed, as value
+        """
+        requests = {addr: self._register_read_packet(addr) for addr in addresses}
+        results = await self._request_many(requests, SerialProtocol.REGISTER_READ_REPLY, timeout)
+        return {addr: result if isinstance(result, Exception)
+                else int.from_bytes(result[1:5], byteorder='little', signed=False)
+                for addr, result in results.items()}
+
+    async def buffer_read(self, offset):
         """
         Read the buffer
         """
@@ -97,55 +439,87 @@ class SerialCom:
         data.extend(b'\xcc\x03\x00\xfa\xe8')
         data.extend(offset.to_bytes(2, byteorder='little', signed=False))
         data.append(0xcd)
-        self._port.write(data)
-
-        _header, payload = self.read_packet_type(0xF7)
-        assert payload[0] == 0xE8
+        payload = await self._request(data, SerialProtocol.BUFFER_READ_REPLY, 0xE8)
         return payload[1:]
 
-    def read_stream(self):
+    async def read_stream(self, timeout=None):
+        """
+        Read the oldest stream frame from the ring buffer, waiting for one if it is empty
+        :param timeout:  maximum number of seconds to wait for a frame, the serial timeout if None
+        :return:  monotonic time the frame was received, stream payload
+        """
+        protocol = self._protocol
+        while not protocol.frames:
+            if protocol.error is not None:
+                raise protocol.error
+            protocol.frame_ready.clear()
+            await asyncio.wait_for(protocol.frame_ready.wait(), self.timeout if timeout is None else timeout)
+        return protocol.frames.popleft()
+
+    def clear_stream(self):
         """
-        Read a stream of data
+        Discard the stream frames waiting in the ring buffer, e.g. the ones of a configuration that was just stopped
+        :return:  number of frames discarded
         """
-        _header, payload = self.read_packet_type(0xFE)
-        return payload
+        frames = self._protocol.frames
+        discarded = len(frames)
+        frames.clear()
+        return discarded
 
     @staticmethod
     def _check_error(status):
         ERROR_MASK = 0xFFFF0000
         if status & ERROR_MASK != 0:
-            ModuleError(f"Error in module, status: 0x{status:08X}")
+            raise ModuleError(f"Error in module, status: 0x{status:08X}")
 
-    @staticmethod
-    def _check_timeout(start, max_time):
-        if (time.monotonic() - start) > max_time:
-            raise TimeoutError()
+    async def wait_register(self, addr, predicate, timeout, first_interval=0.001, max_interval=0.05):
+        """
+        Poll a register until predicate(value) is true without blocking the event loop. The first reads follow each
+        other closely and the interval doubles up to max_interval, so a quick state change is seen within a few
+        milliseconds and a slow one doesn't flood the serial port.
+        :param addr:  address of the register
+        :param predicate:  function called with every value read, may raise to stop waiting
+        :param timeout:  maximum number of seconds to wait
+        :param first_interval:  seconds between the first two reads
+        :param max_interval:  maximum seconds between two reads
+        :return:  the value predicate accepted
+        :raises TimeoutError:  if predicate didn't accept a value within timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        interval = first_interval
+        while True:
+            value = await self.register_read(addr)
+            if predicate(value):
+                return value
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Register 0x{addr:02X} still 0x{value:08X} after {timeout} s")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
 
-    def _wait_status_set(self, wanted_bits, max_time):
+    async def _wait_status_set(self, wanted_bits, max_time):
         """
         Wait for wanted_bits bits to be set in status register
+        :return:  status
+        :raises ModuleError:  if an error bit is set
         """
-        start = time.monotonic()
-
-        while True:
-            status = self.register_read(0x6)
-            self._check_timeout(start, max_time)
+        def is_set(status):
             self._check_error(status)
+            return status & wanted_bits == wanted_bits
 
-            if status & wanted_bits == wanted_bits:
-                return
-            time.sleep(0.1)
+        return await self.wait_register(0x6, is_set, max_time)
 
-    def wait_start(self):
+    async def wait_start(self):
         """
         Poll status register until created and activated
         """
         ACTIVATED_AND_CREATED = 0x3
-        self._wait_status_set(ACTIVATED_AND_CREATED, 3)
+        await self._wait_status_set(ACTIVATED_AND_CREATED, 3)
 
-    def wait_for_data(self, max_time):
+    async def wait_for_data(self, max_time):
         """
         Poll status register until data is ready
         """
         DATA_READY = 0x00000100
-        self._wait_status_set(DATA_READY, max_time)
+        await self._wait_status_set(DATA_READY, max_time)
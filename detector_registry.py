@@ -0,0 +1,165 @@
+import asyncio
+from supervisor import AcquisitionSupervisor
+
+
+class DetectorRegistry:
+    """
+    Detectors by sensor id, one per serial port. Every sensor has its own acquisition task so several sensors stream
+    concurrently in one server process.
+    """
+
+    def __init__(self):
+        self.detectors = {}
+        self.supervisors = {}
+        self._tasks = {}
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self.detectors
+
+    def __iter__(self):
+        return iter(self.detectors)
+
+    def items(self):
+        return self.detectors.items()
+
+    def get(self, sensor_id):
+        """
+        Get the detector of a sensor
+        :param sensor_id:  id of the sensor
+        :return:  detector or None if the sensor is not open
+        """
+        return self.detectors.get(sensor_id)
+
+    def index(self, sensor_id):
+        """
+        Small number identifying the sensor in binary stream frames
+        :param sensor_id:  id of the sensor
+        :return:  int index of the sensor, in the order the sensors were opened
+        """
+        return list(self.detectors).index(sensor_id)
+
+    @property
+    def primary_id(self):
+        """
+        Id of the sensor opened first, None if no sensor is open
+        """
+        return next(iter(self.detectors), None)
+
+    async def open(self, sensor_id, detector_class, com_config):
+        """
+        Create a detector for a sensor and open its serial port. A detector already open for the sensor is stopped and
+        closed first.
+        :param sensor_id:  id of the sensor
+        :param detector_class:  class of the detector to create
+        :param com_config:  dictionary with the configuration for the serial communication
+        :return:  the new detector
+        """
+        for other_id, other in self.detectors.items():
+            if other_id != sensor_id and other.com_config['port'] == com_config['port']:
+                raise ValueError(f"Port {com_config['port']} is already used by sensor {other_id}")
+        previous = self.detectors.get(sensor_id)
+        if previous is not None:
+            self.stop_acquisition(sensor_id)
+            try:
+                await previous.stop_module()
+                await previous.clear_module()
+            except Exception as e:
+                print(f"Error while stopping sensor {sensor_id}: {e}")
+            self.close(sensor_id)
+        detector = detector_class(com_config)
+        await detector.open()
+        if 'baudrate' in com_config:
+            # the module starts at the default UART speed, the fastest one up to the requested one that works is used
+            try:
+                await detector.negotiate_baudrate(com_config['baudrate'])
+            except Exception:
+                detector.close()
+                raise
+        self.detectors[sensor_id] = detector
+        return detector
+
+    def add(self, sensor_id, detector):
+        """
+        Register a detector that is not connected to a serial port, e.g. one decoding a replayed capture
+        :param sensor_id:  id of the sensor
+        :param detector:  detector
+        :return:  None
+        """
+        if sensor_id in self.detectors:
+            raise ValueError(f'Sensor {sensor_id} is already open')
+        self.detectors[sensor_id] = detector
+
+    def replace(self, sensor_id, detector):
+        """
+        Replace the detector of a sensor, e.g. with a detector of another mode sharing the same serial connection
+        :param sensor_id:  id of the sensor
+        :param detector:  new detector
+        :return:  None
+        """
+        self.stop_acquisition(sensor_id)
+        self.detectors[sensor_id] = detector
+
+    def start_acquisition(self, sensor_id, coro):
+        """
+        Run the acquisition of a sensor as its own task, replacing the running one
+        :param sensor_id:  id of the sensor
+        :param coro:  acquisition coroutine, e.g. detector.start_stream(...)
+        :return:  the task
+        """
+        self.stop_acquisition(sensor_id)
+        task = self._tasks[sensor_id] = asyncio.create_task(coro)
+        task.add_done_callback(lambda done: self._acquisition_done(sensor_id, done))
+        return task
+
+    def supervise(self, sensor_id, data_handler_func, **kwargs):
+        """
+        Stream from a sensor until stopped, restarting the acquisition when it stalls or fails
+        :param sensor_id:  id of the sensor
+        :param data_handler_func:  coroutine function called with every decoded frame
+        :param kwargs:  arguments for AcquisitionSupervisor
+        :return:  AcquisitionSupervisor
+        """
+        supervisor = AcquisitionSupervisor(self.detectors[sensor_id], data_handler_func, **kwargs)
+        self.start_acquisition(sensor_id, supervisor.run())
+        self.supervisors[sensor_id] = supervisor
+        return supervisor
+
+    def _acquisition_done(self, sensor_id, task):
+        # nobody awaits the acquisition tasks, so their failures are reported here
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Acquisition of sensor {sensor_id} failed: {task.exception()!r}")
+
+    def stop_acquisition(self, sensor_id):
+        """
+        Stop the supervisor of a sensor and cancel its acquisition task
+        :param sensor_id:  id of the sensor
+        :return:  the cancelled task, None if there was none
+        """
+        supervisor = self.supervisors.pop(sensor_id, None)
+        if supervisor is not None:
+            # the cancellation alone can be lost, see AcquisitionSupervisor
+            supervisor.stop()
+        task = self._tasks.pop(sensor_id, None)
+        if task is not None:
+            task.cancel()
+        return task
+
+    def is_streaming(self, sensor_id):
+        """
+        Check if the acquisition task of a sensor is running
+        :param sensor_id:  id of the sensor
+        :return:  bool
+        """
+        task = self._tasks.get(sensor_id)
+        return task is not None and not task.done()
+
+    def close(self, sensor_id):
+        """
+        Stop the acquisition of a sensor, close its serial port and remove it
+        :param sensor_id:  id of the sensor
+        :return:  None
+        """
+        self.stop_acquisition(sensor_id)
+        detector = self.detectors.pop(sensor_id, None)
+        if detector is not None:
+            detector.close()
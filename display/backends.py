@@ -0,0 +1,42 @@
+import importlib
+
+# display back ends by name: 'module:class' of the back end, imported only when it is used, None for no display.
+# A back end is a class with a draw_text(text) method, created with the keyword arguments of create_display
+DISPLAY_BACKENDS = {
+    # SSD1306 OLED on I2C, needs board, busio, digitalio, adafruit_ssd1306 and PIL
+    'oled': 'display.display:Display',
+    'console': 'display.backends:ConsoleDisplay',
+    'none': None,
+}
+
+
+class ConsoleDisplay:
+    """
+    Prints the text instead of drawing it, for running without the OLED
+    """
+
+    def __init__(self, **kwargs):
+        self._shown_text = None
+
+    def draw_text(self, text):
+        if text == self._shown_text:
+            return
+        print(f'Display: {text}')
+        self._shown_text = text
+
+
+def create_display(backend, **kwargs):
+    """
+    Import and create a display back end
+    :param backend:  name of the back end in DISPLAY_BACKENDS
+    :param kwargs:  arguments of the back end, e.g. width, height and addr of the OLED
+    :return:  the display, None for 'none'
+    :raises ValueError:  if the back end is unknown
+    """
+    if backend not in DISPLAY_BACKENDS:
+        raise ValueError(f"Unknown display back end {backend}, available: {', '.join(DISPLAY_BACKENDS)}")
+    path = DISPLAY_BACKENDS[backend]
+    if path is None:
+        return None
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)(**kwargs)
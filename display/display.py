@@ -1,4 +1,3 @@
-import time
 import board
 import busio
 import digitalio
@@ -20,8 +19,13 @@ class Display:
         # Get drawing object to draw on image.
         self.draw = ImageDraw.Draw(self.image)
 
-        # Load the font
-        self.font = font = ImageFont.load_default()
+        # Load the fonts once, loading a truetype font takes longer than drawing a frame
+        self.font = ImageFont.truetype('PixelOperator.ttf', 50)
+        self.icon_font = ImageFont.truetype('lineawesome-webfont.ttf', 50)
+        # rendered glyph images and their advance width, by character
+        self._glyphs = {}
+        # text currently on the display
+        self._shown_text = None
 
         # Create the display
         self.oled = adafruit_ssd1306.SSD1306_I2C(width, height, busio.I2C(board.SCL, board.SDA), addr=addr,
@@ -32,14 +36,32 @@ class Display:
         # Clear display.
         self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
 
-    # Draw text on the display
+    # Render a character once and reuse the image
+    def _glyph(self, char):
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            advance = int(round(self.font.getlength(char)))
+            image = Image.new('1', (max(advance, 1), self.height))
+            ImageDraw.Draw(image).text((0, 0), char, font=self.font, fill=255)
+            glyph = self._glyphs[char] = (image, advance)
+        return glyph
+
+    # Draw text on the display, nothing is sent to the display if the text is already shown
     def draw_text(self, text):
-        self.font = ImageFont.truetype('PixelOperator.ttf', 50)
-        self.icon_font = ImageFont.truetype('lineawesome-webfont.ttf', 50)
+        if text == self._shown_text:
+            return
         self.clear_display()
-        self.draw.text((0, 0), text, font=self.font, fill=255)
+        x = 0
+        for char in text:
+            image, advance = self._glyph(char)
+            if x >= self.width:
+                break
+            self.image.paste(image, (x, 0))
+            x += advance
         self.oled.image(self.image)
         self.oled.show()
+        self._shown_text = text
+
 
 # # Test the display
 # if __name__ == '__main__':
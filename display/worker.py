@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class DisplayWorker(threading.Thread):
+    """
+    Draws on the display in a background thread, so the slow I2C transfer never delays the radar frames. Only the
+    latest text is drawn and the display is refreshed at most max_fps times per second.
+    """
+
+    def __init__(self, display, max_fps=2, draw_time=None):
+        super().__init__(name='display', daemon=True)
+        self.display = display
+        self.min_interval = 1 / max_fps
+        # histogram observing how long each refresh takes, optional
+        self.draw_time = draw_time
+        self._text = None
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+
+    # Set the text to show, returns immediately
+    def show(self, text):
+        with self._lock:
+            self._text = text
+        self._changed.set()
+
+    def run(self):
+        while True:
+            self._changed.wait()
+            with self._lock:
+                self._changed.clear()
+                text = self._text
+            start = time.monotonic()
+            try:
+                self.display.draw_text(text)
+            except Exception as e:
+                print(f"Error while drawing on the display: {e}")
+            if self.draw_time is not None:
+                self.draw_time.since(start)
+            # cap the refresh rate, texts set in the meantime are merged into the next refresh
+            time.sleep(max(0.0, self.min_interval - (time.monotonic() - start)))
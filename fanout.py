@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import http
+import itertools
+import json
+import os
+import sys
+import websockets
+from broadcaster import Broadcaster
+from frame_bus import FrameBusReader
+from command_registry import CommandRegistry, decode_message, respond
+from stream_commands import STREAM_COMMANDS
+
+# longest line on the control socket, replies like a history series can be large
+CONTROL_LINE_LIMIT = 2 ** 24
+
+
+class ForwardedClient:
+    """
+    Stands in for the websocket of a client of a fan-out worker in the acquisition process: what the handlers send
+    is passed back to the worker, which sends it to the client
+    """
+
+    def __init__(self, writer, client):
+        """
+        :param writer:  StreamWriter of the control connection of the worker
+        :param client:  id of the client in the worker
+        """
+        self.writer = writer
+        self.client = client
+
+    async def send(self, payload):
+        self.writer.write(json.dumps({'client': self.client, 'payload': payload}).encode() + b'\n')
+        await self.writer.drain()
+
+
+class ControlServer:
+    """
+    Unix socket of the acquisition process the fan-out workers forward the requests and commands of their clients to,
+    one JSON message per line. The messages are handled like the ones of the clients of the acquisition process
+    itself, see CommandRegistry.start.
+    """
+
+    def __init__(self, path, dispatch, prometheus):
+        """
+        :param path:  path of the Unix socket
+        :param dispatch:  function starting to handle a message, called with the ForwardedClient and the message
+        :param prometheus:  function returning the metrics in the Prometheus text format
+        """
+        self.path = path
+        self.dispatch = dispatch
+        self.prometheus = prometheus
+        self.server = None
+
+    async def start(self):
+        """
+        Start accepting worker connections, a socket left over from an earlier run is replaced
+        :return:  None
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve_worker, self.path, limit=CONTROL_LINE_LIMIT)
+
+    async def _serve_worker(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                client = ForwardedClient(writer, message['client'])
+                if 'prometheus' in message:
+                    await client.send(self.prometheus())
+                elif 'message' in message:
+                    self.dispatch(client, message['message'])
+        except ConnectionError:
+            pass
+        finally:
+            print("A fan-out worker disconnected")
+            writer.close()
+
+
+class FanoutWorker:
+    """
+    Process serving websocket clients on the shared port (SO_REUSEPORT, the kernel spreads the connections over the
+    workers). The frames come from the frame bus of the acquisition process and are fanned out by the Broadcaster of
+    the worker, the stream commands of its clients are handled here and everything else is forwarded to the
+    acquisition process, the single owner of the serial ports.
+    """
+
+    def __init__(self, address, port, frame_bus_name, control_path, epoch, queue_size=16,
+                 slow_consumer_policy=Broadcaster.DROP_OLDEST, replay_size=256, poll_interval=0.002,
+                 prometheus_path='/metrics'):
+        """
+        :param address:  address to accept the clients on
+        :param port:  port shared with the other workers
+        :param frame_bus_name:  name of the frame bus of the acquisition process
+        :param control_path:  path of the Unix socket of the ControlServer
+        :param epoch:  epoch of the sequence numbers of the acquisition process
+        :param queue_size:  see Broadcaster
+        :param slow_consumer_policy:  see Broadcaster
+        :param replay_size:  see Broadcaster
+        :param poll_interval:  seconds between reads of the frame bus, the latency added to every frame
+        :param prometheus_path:  path of the Prometheus text endpoint, answered by the acquisition process. Empty or
+        None to disable it
+        """
+        self.address = address
+        self.port = port
+        self.frame_bus_name = frame_bus_name
+        self.control_path = control_path
+        self.poll_interval = poll_interval
+        self.prometheus_path = prometheus_path
+        self.consumers = Broadcaster(queue_size, slow_consumer_policy, replay_size, epoch)
+        self.commands = CommandRegistry()
+        self.commands.update(STREAM_COMMANDS.bound(self.consumers))
+        self.frame_bus = None
+        self.control = None
+        # websocket by client id, and the futures of the pending Prometheus requests
+        self.clients = {}
+        self._client_ids = itertools.count()
+        self._metrics = {}
+        self._tasks = set()
+
+    async def run(self):
+        """
+        Serve clients until the acquisition process goes away
+        :return:  None
+        """
+        self.frame_bus = FrameBusReader(self.frame_bus_name)
+        control_reader, self.control = await asyncio.open_unix_connection(self.control_path,
+                                                                          limit=CONTROL_LINE_LIMIT)
+        await websockets.serve(self.serve_client, self.address, self.port, reuse_port=True,
+                               process_request=self.metrics_http_endpoint)
+        print(f"Fan-out worker {os.getpid()} listening on port {self.port}")
+        pump = asyncio.create_task(self._pump())
+        try:
+            await self._read_control(control_reader)
+        finally:
+            pump.cancel()
+            self.frame_bus.close()
+
+    async def serve_client(self, websocket, path):
+        client = next(self._client_ids)
+        self.clients[client] = websocket
+        self.consumers.add(websocket)
+        try:
+            async for payload in websocket:
+                try:
+                    message = decode_message(payload)
+                except ValueError as e:
+                    await respond(websocket, {'ack': 'failed', 'data': {'comment': f'Invalid message: {e}'}})
+                    continue
+                if self.commands.find(message) is not None:
+                    self.commands.start(websocket, message)
+                else:
+                    self._forward({'client': client, 'message': message})
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.consumers.remove(websocket)
+            del self.clients[client]
+
+    async def metrics_http_endpoint(self, path, request_headers):
+        """
+        Answer the Prometheus endpoint with the metrics of the acquisition process, see main.metrics_http_endpoint
+        """
+        if not self.prometheus_path or path != self.prometheus_path:
+            return None
+        client = next(self._client_ids)
+        future = self._metrics[client] = asyncio.get_running_loop().create_future()
+        self._forward({'client': client, 'prometheus': True})
+        try:
+            text = await asyncio.wait_for(future, 5)
+        finally:
+            self._metrics.pop(client, None)
+        return http.HTTPStatus.OK, [('Content-Type', 'text/plain; version=0.0.4')], text.encode()
+
+    def _forward(self, message):
+        self.control.write(json.dumps(message).encode() + b'\n')
+
+    async def _pump(self):
+        while True:
+            for frame in self.frame_bus.read():
+                self.consumers.publish(frame, assign_seq=False)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _read_control(self, reader):
+        while line := await reader.readline():
+            message = json.loads(line)
+            client = message['client']
+            future = self._metrics.get(client)
+            if future is not None:
+                future.set_result(message['payload'])
+                continue
+            websocket = self.clients.get(client)
+            if websocket is None:
+                continue
+            task = asyncio.create_task(self._reply(websocket, message['payload']))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        print("The acquisition process went away, stopping")
+
+    @staticmethod
+    async def _reply(websocket, payload):
+        try:
+            await websocket.send(payload)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+class WorkerPool:
+    """
+    Starts the fan-out workers as separate Python processes and restarts the ones that exit
+    """
+
+    def __init__(self, count, **worker_args):
+        """
+        :param count:  number of workers
+        :param worker_args:  arguments of FanoutWorker
+        """
+        self.count = count
+        self.worker_args = worker_args
+        self.processes = []
+        self.restarts = 0
+        self._tasks = []
+
+    def start(self):
+        """
+        Start the workers, returns right away
+        :return:  None
+        """
+        self._tasks = [asyncio.create_task(self._keep_running()) for _ in range(self.count)]
+
+    async def _keep_running(self):
+        args = [sys.executable, os.path.abspath(__file__)]
+        for key, value in self.worker_args.items():
+            args += [f"--{key.replace('_', '-')}", '' if value is None else str(value)]
+        while True:
+            process = await asyncio.create_subprocess_exec(*args)
+            self.processes.append(process)
+            code = await process.wait()
+            self.processes.remove(process)
+            print(f"Fan-out worker {process.pid} exited with code {code}, restarting")
+            self.restarts += 1
+            await asyncio.sleep(1)
+
+    def stop(self):
+        """
+        Stop the workers
+        :return:  None
+        """
+        for task in self._tasks:
+            task.cancel()
+        for process in self.processes:
+            process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Websocket fan-out worker of the radar server')
+    parser.add_argument('--address', required=True, help='address to accept the clients on')
+    parser.add_argument('--port', type=int, required=True, help='port shared with the other workers')
+    parser.add_argument('--frame-bus-name', required=True, help='name of the frame bus of the acquisition process')
+    parser.add_argument('--control-path', required=True, help='Unix socket of the acquisition process')
+    parser.add_argument('--epoch', type=int, required=True, help='epoch of the sequence numbers')
+    parser.add_argument('--queue-size', type=int, default=16, help='frames queued per client')
+    parser.add_argument('--slow-consumer-policy', default=Broadcaster.DROP_OLDEST, help='drop_oldest or drop_client')
+    parser.add_argument('--replay-size', type=int, default=256, help='frames kept per sensor for resuming clients')
+    parser.add_argument('--poll-interval', type=float, default=0.002, help='seconds between reads of the frame bus')
+    parser.add_argument('--prometheus-path', default='/metrics',
+                        help='path of the Prometheus text endpoint, empty to disable it')
+    args = parser.parse_args()
+    worker = FanoutWorker(**vars(args))
+    asyncio.run(worker.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import struct
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from wire_format import StreamFrame, StructEncoder
+
+
+class FrameBusLayout:
+    """
+    Layout of the frame bus, a ring of fixed-size records in a shared memory block, all little endian:
+    header: magic (4 bytes), version (uint16), result info entries per record (uint16), capacity (uint32), samples per
+    record (uint32), records written (uint64)
+    record: stamp (uint64), sequence number (uint64), timestamp in seconds (float64), stream id (uint8), sensor index
+    (uint8), result info entries (uint8), sweeps (uint16), samples per sweep (uint16), sensor id (32 bytes utf-8),
+    presence (uint8), score (float32), distance (float32), part (uint16), parts (uint16), result info (address uint8
+    and value uint32 each), samples (uint16 each)
+    A service frame with more samples than a record holds is split over parts consecutive records, every part
+    repeats the header fields and holds the next max_samples samples. The records written counter is only advanced
+    once all parts are written.
+    The stamp guards every record: it is 2 * n + 1 while record n is written and 2 * n + 2 when it is complete, a
+    reader copies a record and accepts it if the stamp was the complete one before and after the copy.
+    """
+
+    MAGIC = b'RFB1'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHHIIQ')
+    # offset of the records written counter in the header
+    WRITTEN_OFFSET = 16
+    WRITTEN = struct.Struct('<Q')
+    STAMP = struct.Struct('<Q')
+    RECORD = struct.Struct('<QQdBBBHH32sBffHH')
+    RESULT_INFO = struct.Struct('<BI')
+    SAMPLE = np.dtype('<u2')
+    STREAM_NAMES = {stream_id: stream for stream, stream_id in StructEncoder.STREAM_IDS.items()}
+
+    def __init__(self, capacity, max_samples, result_info_entries):
+        """
+        :param capacity:  number of records in the ring
+        :param max_samples:  samples a record holds, larger service frames are split over several records
+        :param result_info_entries:  result info entries a record holds
+        """
+        self.capacity = capacity
+        self.max_samples = max_samples
+        self.result_info_entries = result_info_entries
+        self.result_info_offset = self.RECORD.size
+        self.samples_offset = self.result_info_offset + self.RESULT_INFO.size * result_info_entries
+        # records start on 8 byte boundaries
+        self.record_size = (self.samples_offset + self.SAMPLE.itemsize * max_samples + 7) // 8 * 8
+        self.size = self.HEADER.size + self.record_size * capacity
+
+    def record_offset(self, n):
+        """
+        Offset of the record of the n-th frame written
+        :param n:  number of the frame since the bus was created
+        :return:  int
+        """
+        return self.HEADER.size + (n % self.capacity) * self.record_size
+
+
+class FrameBusWriter(FrameBusLayout):
+    """
+    Writes the decoded stream frames into a shared memory ring for local consumers, see FrameBusReader. There is a
+    single writer, the process that owns the sensors, and any number of readers. Writing never waits for the readers,
+    a reader that falls more than capacity records behind loses the oldest frames. A frame that needs more records than
+    the ring has is not written and counted in dropped_frames.
+    """
+
+    def __init__(self, name, capacity=1024, max_samples=2048, result_info_entries=8):
+        """
+        Create the shared memory block, a stale block with the same name from an earlier run is replaced
+        :param name:  name of the shared memory block the readers attach to
+        :param capacity:  number of records in the ring
+        :param max_samples:  samples a record holds, larger service frames are split over several records
+        :param result_info_entries:  result info entries a record holds
+        """
+        super().__init__(capacity, max_samples, result_info_entries)
+        self.name = name
+        try:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=self.size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name, create=True, size=self.size)
+        self.buffer = self.memory.buf
+        self.written = 0
+        # frames split over several records, and frames too large for the ring
+        self.split_frames = 0
+        self.dropped_frames = 0
+        self.buffer[:self.HEADER.size] = self.HEADER.pack(self.MAGIC, self.VERSION, result_info_entries, capacity,
+                                                          max_samples, 0)
+
+    def write(self, frame):
+        """
+        Write a frame into the next records
+        :param frame:  StreamFrame, after the broadcaster gave it its sequence number
+        :return:  None
+        """
+        data = frame.data
+        sensor = str(frame.sensor).encode()[:32]
+        if frame.stream == 'presence':
+            self._write_record(self.written, 0, 1, frame.seq, frame.timestamp, 1, frame.sensor_index, 0, 0, 0, sensor,
+                               data['presence'], data['score'], data['distance'])
+            self._advance(1)
+            return
+        samples = data['samples']
+        sweeps, length = samples.shape if samples.ndim == 2 else (1, samples.size)
+        samples = samples.reshape(-1)
+        parts = max(-(-samples.size // self.max_samples), 1)
+        if parts > self.capacity:
+            self.dropped_frames += 1
+            return
+        if parts > 1:
+            self.split_frames += 1
+        result_info = list(data['result_info'].items())[:self.result_info_entries]
+        stream_id = StructEncoder.STREAM_IDS[frame.stream]
+        for part in range(parts):
+            chunk = samples[part * self.max_samples:(part + 1) * self.max_samples]
+            self._write_record(self.written + part, part, parts, frame.seq, frame.timestamp, stream_id,
+                               frame.sensor_index, len(result_info), sweeps, length, sensor, 0, 0.0, 0.0,
+                               result_info, chunk)
+        self._advance(parts)
+
+    def _write_record(self, n, part, parts, seq, timestamp, stream_id, sensor_index, entries, sweeps, length, sensor,
+                      presence, score, distance, result_info=(), samples=None):
+        offset = self.record_offset(n)
+        buffer = self.buffer
+        self.STAMP.pack_into(buffer, offset, 2 * n + 1)
+        self.RECORD.pack_into(buffer, offset, 2 * n + 1, seq, timestamp, stream_id, sensor_index, entries, sweeps,
+                              length, sensor, presence, score, distance, part, parts)
+        for index, (address, value) in enumerate(result_info):
+            self.RESULT_INFO.pack_into(buffer, offset + self.result_info_offset + self.RESULT_INFO.size * index,
+                                       address, value)
+        if samples is not None:
+            start = offset + self.samples_offset
+            np.frombuffer(buffer, dtype=self.SAMPLE, count=samples.size, offset=start)[:] = samples
+        self.STAMP.pack_into(buffer, offset, 2 * n + 2)
+
+    def _advance(self, records):
+        self.written += records
+        self.WRITTEN.pack_into(self.buffer, self.WRITTEN_OFFSET, self.written)
+
+    def close(self):
+        """
+        Release and remove the shared memory block, attached readers keep their mapping until they close
+        :return:  None
+        """
+        self.buffer = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+class FrameBusReader(FrameBusLayout):
+    """
+    Reads the frames written by a FrameBusWriter in another process. Every reader keeps its own position, frames
+    that were overwritten before they were read are counted as lost (one per record for frames split over several
+    records).
+
+    Usage:
+        reader = FrameBusReader('radar_frames')
+        while True:
+            for frame in reader.read():
+                print(frame.sensor, frame.seq, frame.data)
+            time.sleep(0.05)
+    """
+
+    def __init__(self, name, from_start=False):
+        """
+        Attach to the shared memory block of a writer
+        :param name:  name of the shared memory block
+        :param from_start:  also return the frames still in the ring, only the frames written from now on if False
+        :raises FileNotFoundError:  if there is no writer with this name
+        :raises ValueError:  if the block is not a frame bus of this version
+        """
+        try:
+            memory = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13 every attached process unlinks the block at exit unless it is unregistered
+            from multiprocessing import resource_tracker
+            memory = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        self.memory = memory
+        self.buffer = memory.buf
+        magic, version, result_info_entries, capacity, max_samples, written = self.HEADER.unpack_from(self.buffer)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f'{name} is not a frame bus of version {self.VERSION}')
+        super().__init__(capacity, max_samples, result_info_entries)
+        self.name = name
+        # number of the next record to read
+        self.position = max(written - capacity, 0) if from_start else written
+        self.lost_frames = 0
+
+    @property
+    def written(self):
+        """
+        Number of records the writer has written since the bus was created
+        """
+        return self.WRITTEN.unpack_from(self.buffer, self.WRITTEN_OFFSET)[0]
+
+    def read(self, max_frames=None):
+        """
+        Read the frames written since the last read
+        :param max_frames:  maximum number of frames to return, all if None
+        :return:  list of StreamFrame, oldest first
+        """
+        written = self.written
+        if written - self.position > self.capacity:
+            self.lost_frames += written - self.capacity - self.position
+            self.position = written - self.capacity
+        frames = []
+        n = self.position
+        while n < written and (max_frames is None or len(frames) < max_frames):
+            frame, records = self._read_frame(n, written)
+            if frame is None:
+                self.lost_frames += 1
+            else:
+                frames.append(frame)
+            n += records
+        self.position = n
+        return frames
+
+    def latest(self, count=1):
+        """
+        The latest frames, independent of the position of the reader
+        :param count:  maximum number of frames
+        :return:  list of StreamFrame, oldest first
+        """
+        written = self.written
+        frames = []
+        n = max(written - self.capacity, 0)
+        while n < written:
+            frame, records = self._read_frame(n, written)
+            if frame is not None:
+                frames.append(frame)
+            n += records
+        return frames[-count:]
+
+    def wait(self, timeout=None, interval=0.005):
+        """
+        Wait until there are frames to read
+        :param timeout:  maximum seconds to wait, wait forever if None
+        :param interval:  seconds between checks
+        :return:  True if there are new frames, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.written == self.position:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def _read_frame(self, n, written):
+        """
+        Copy the frame starting at the n-th record
+        :param written:  records written, the end of the frames to read
+        :return:  StreamFrame or None if a record of it was overwritten or is a part of a frame that started before
+        n, and the number of records read
+        """
+        head = self._read_record(n)
+        if head is None:
+            return None, 1
+        header, result_info, samples = head
+        part, parts = header[-2:]
+        if part != 0:
+            # the first parts of the frame were overwritten
+            return None, parts - part
+        if parts > 1:
+            chunks = [samples]
+            # the parts repeat the header of the frame, only the stamp and the part differ
+            for index in range(1, parts):
+                record = self._read_record(n + index) if n + index < written else None
+                if record is None or record[0][1:-2] != header[1:-2] or record[0][-2] != index:
+                    return None, parts
+                chunks.append(record[2])
+            samples = np.concatenate(chunks)
+        (_, seq, timestamp, stream_id, sensor_index, _, sweeps, length, sensor, presence, score, distance, _,
+         _) = header
+        if stream_id == 1:
+            data = {'presence': presence, 'score': score, 'distance': distance}
+        else:
+            data = {'result_info': result_info, 'samples': samples.reshape(sweeps, length) if sweeps > 1 else samples}
+        return StreamFrame(self.STREAM_NAMES[stream_id], data, sensor=sensor.rstrip(b'\0').decode(),
+                           sensor_index=sensor_index, seq=seq, timestamp=timestamp), parts
+
+    def _read_record(self, n):
+        """
+        Copy the n-th record
+        :return:  header fields, result info and samples of the record, None if it was overwritten or is being
+        written
+        """
+        offset = self.record_offset(n)
+        buffer = self.buffer
+        complete = 2 * n + 2
+        if self.STAMP.unpack_from(buffer, offset)[0] != complete:
+            return None
+        header = self.RECORD.unpack_from(buffer, offset)
+        entries, sweeps, length, part = header[5], header[6], header[7], header[-2]
+        result_info = {}
+        samples = None
+        if header[3] != 1:
+            for index in range(entries):
+                address, value = self.RESULT_INFO.unpack_from(
+                    buffer, offset + self.result_info_offset + self.RESULT_INFO.size * index)
+                result_info[address] = value
+            count = min(sweeps * length - part * self.max_samples, self.max_samples)
+            start = offset + self.samples_offset
+            samples = np.frombuffer(buffer, dtype=self.SAMPLE, count=max(count, 0), offset=start).copy()
+        # the writer may have started on the record while it was copied
+        if self.STAMP.unpack_from(buffer, offset)[0] != complete:
+            return None
+        return header, result_info, samples
+
+    def close(self):
+        """
+        Detach from the shared memory block
+        :return:  None
+        """
+        self.buffer = None
+        self.memory.close()
@@ -0,0 +1,211 @@
+import math
+import numpy as np
+
+
+class AggregateRing:
+    """
+    Aggregates of the presence samples in fixed time buckets at one resolution, kept in a ring of NumPy arrays. Adding
+    a sample updates one bucket, a window is answered from the buckets it covers without looking at the samples.
+    """
+
+    def __init__(self, resolution, buckets):
+        """
+        :param resolution:  seconds per bucket
+        :param buckets:  number of buckets kept, the ring covers resolution * buckets seconds
+        """
+        self.resolution = resolution
+        self.buckets = buckets
+        # number of the bucket (time // resolution) each slot holds, -1 for never used
+        self.bucket = np.full(buckets, -1, dtype=np.int64)
+        self.count = np.zeros(buckets, dtype=np.int64)
+        self.present = np.zeros(buckets, dtype=np.int64)
+        self.transitions = np.zeros(buckets, dtype=np.int64)
+        self.score_sum = np.zeros(buckets, dtype=np.float64)
+        # distance of the samples with presence
+        self.distance_sum = np.zeros(buckets, dtype=np.float64)
+        self.distance_min = np.full(buckets, np.inf, dtype=np.float64)
+
+    @property
+    def span(self):
+        """
+        Seconds covered by the ring
+        """
+        return self.resolution * self.buckets
+
+    def add(self, timestamp, presence, score, distance, transition):
+        """
+        Add a sample to its bucket
+        :param timestamp:  time of the sample in seconds since the epoch
+        :param presence:  True if presence was detected
+        :param score:  presence score
+        :param distance:  distance in meters
+        :param transition:  True if presence changed since the previous sample
+        :return:  None
+        """
+        bucket = int(timestamp // self.resolution)
+        slot = bucket % self.buckets
+        if self.bucket[slot] != bucket:
+            # the slot still holds an old bucket, start over
+            self.bucket[slot] = bucket
+            self.count[slot] = self.present[slot] = self.transitions[slot] = 0
+            self.score_sum[slot] = self.distance_sum[slot] = 0.0
+            self.distance_min[slot] = np.inf
+        self.count[slot] += 1
+        self.score_sum[slot] += score
+        self.transitions[slot] += transition
+        if presence:
+            self.present[slot] += 1
+            self.distance_sum[slot] += distance
+            if distance < self.distance_min[slot]:
+                self.distance_min[slot] = distance
+
+    def slots(self, start, end):
+        """
+        Slots of the buckets between two times
+        :param start:  time in seconds since the epoch
+        :param end:  time in seconds since the epoch
+        :return:  bucket numbers and slots of the buckets that hold samples, oldest first
+        """
+        last = int(end // self.resolution)
+        first = max(int(start // self.resolution), last - self.buckets + 1)
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = buckets % self.buckets
+        valid = self.bucket[slots] == buckets
+        return buckets[valid], slots[valid]
+
+    def window(self, start, end, series=False):
+        """
+        Aggregate the buckets between two times
+        :param start:  time in seconds since the epoch
+        :param end:  time in seconds since the epoch
+        :param series:  also return the aggregates of every bucket
+        :return:  dictionary with the aggregates
+        """
+        buckets, slots = self.slots(start, end)
+        result = self._aggregate(slots)
+        if series:
+            columns = zip((buckets * self.resolution).tolist(), self.count[slots].tolist(),
+                          self.present[slots].tolist(), self.score_sum[slots].tolist(),
+                          self.distance_sum[slots].tolist(), self.distance_min[slots].tolist(),
+                          self.transitions[slots].tolist())
+            result['series'] = [{
+                'start': bucket_start,
+                'samples': count,
+                'occupancy': present / count,
+                'mean_score': score_sum / count,
+                'mean_distance': distance_sum / present if present else None,
+                'min_distance': distance_min if present else None,
+                'transitions': transitions,
+            } for bucket_start, count, present, score_sum, distance_sum, distance_min, transitions in columns]
+        return result
+
+    def _aggregate(self, slots):
+        count = int(self.count[slots].sum())
+        present = int(self.present[slots].sum())
+        distance_min = float(self.distance_min[slots].min()) if len(slots) else math.inf
+        return {
+            'samples': count,
+            'occupancy': present / count if count else None,
+            'mean_score': float(self.score_sum[slots].sum()) / count if count else None,
+            'mean_distance': float(self.distance_sum[slots].sum()) / present if present else None,
+            'min_distance': distance_min if present else None,
+            'transitions': int(self.transitions[slots].sum()),
+        }
+
+
+class PresenceHistory:
+    """
+    History of the presence samples of one sensor: the latest samples in a fixed-size ring of NumPy arrays, and
+    aggregates at several resolutions that are updated with every sample.
+    """
+
+    # (seconds per bucket, buckets): 1 s for an hour, 1 min for a day, 15 min for a week
+    DEFAULT_RESOLUTIONS = ((1, 3600), (60, 1440), (900, 672))
+
+    def __init__(self, capacity=36000, resolutions=DEFAULT_RESOLUTIONS):
+        """
+        :param capacity:  number of raw samples kept
+        :param resolutions:  (seconds per bucket, number of buckets) of every aggregate level
+        """
+        self.capacity = capacity
+        self.timestamp = np.zeros(capacity, dtype=np.float64)
+        self.presence = np.zeros(capacity, dtype=np.bool_)
+        self.score = np.zeros(capacity, dtype=np.float32)
+        self.distance = np.zeros(capacity, dtype=np.float32)
+        # total number of samples added, the next one goes to total % capacity
+        self.total = 0
+        self.levels = [AggregateRing(resolution, buckets) for resolution, buckets in sorted(resolutions)]
+        self._last_presence = None
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def add(self, timestamp, presence, score, distance):
+        """
+        Add a sample
+        :param timestamp:  time of the sample in seconds since the epoch
+        :param presence:  True if presence was detected
+        :param score:  presence score
+        :param distance:  distance in meters
+        :return:  None
+        """
+        position = self.total % self.capacity
+        self.timestamp[position] = timestamp
+        self.presence[position] = presence
+        self.score[position] = score
+        self.distance[position] = distance
+        self.total += 1
+        presence = bool(presence)
+        transition = self._last_presence is not None and presence != self._last_presence
+        self._last_presence = presence
+        for level in self.levels:
+            level.add(timestamp, presence, score, distance, transition)
+
+    def latest(self, count):
+        """
+        The latest raw samples
+        :param count:  maximum number of samples
+        :return:  dictionary with the lists timestamp, presence, score and distance, oldest first
+        """
+        count = min(count, len(self))
+        positions = np.arange(self.total - count, self.total) % self.capacity
+        return {
+            'timestamp': self.timestamp[positions].tolist(),
+            'presence': self.presence[positions].tolist(),
+            'score': self.score[positions].tolist(),
+            'distance': self.distance[positions].tolist(),
+        }
+
+    def level_for(self, window, resolution=None):
+        """
+        Aggregate level answering a window: the finest one covering it, or the one with the requested resolution
+        :param window:  seconds
+        :param resolution:  seconds per bucket, None to choose
+        :return:  AggregateRing
+        """
+        if resolution is not None:
+            for level in self.levels:
+                if level.resolution == resolution:
+                    return level
+            available = ', '.join(str(level.resolution) for level in self.levels)
+            raise ValueError(f'Unknown resolution {resolution}, available: {available}')
+        for level in self.levels:
+            if level.span >= window:
+                return level
+        return self.levels[-1]
+
+    def window(self, window, end, resolution=None, series=False):
+        """
+        Aggregates of the last window seconds
+        :param window:  seconds
+        :param end:  end of the window in seconds since the epoch, usually now
+        :param resolution:  seconds per bucket, the finest level covering the window if None
+        :param series:  also return the aggregates of every bucket
+        :return:  dictionary with the aggregates, the resolution used and the window actually covered
+        """
+        level = self.level_for(window, resolution)
+        window = min(window, level.span)
+        result = level.window(end - window, end, series)
+        result['resolution'] = level.resolution
+        result['window'] = window
+        return result
@@ -1,163 +1,577 @@
-from display.display import Display
+from display.backends import DISPLAY_BACKENDS, create_display
+from display.worker import DisplayWorker
 import websockets
 from presence_detector import PresenceDetector
+from service_detector import PowerBinsService, EnvelopeService, SparseService
+from broadcaster import Broadcaster
+from wire_format import StreamFrame
+from detector_registry import DetectorRegistry
+from capture import CaptureWriter, CaptureReader, capture_path, replay
+from simulator import SimulatedXM132
+from metrics import registry
+from history import PresenceHistory
+from stream_commands import STREAM_COMMANDS, sensor_id_of
+from command_registry import CommandRegistry, decode_message, optional, respond
+from fanout import ControlServer, WorkerPool
+from frame_bus import FrameBusWriter
+import argparse
 import asyncio
-import json
+import functools
+import http
+import os
+import signal
+import time
 
 # Global variables
-detector = None
-consumers = set()
+# detectors by sensor id, commands without a sensor_id address stream_commands.DEFAULT_SENSOR_ID
+detectors = DetectorRegistry()
+# frames queued per client before the slow consumer policy kicks in, 'drop_oldest' or 'drop_client'
+SEND_QUEUE_SIZE = 16
+SLOW_CONSUMER_POLICY = Broadcaster.DROP_OLDEST
+# frames kept per sensor for clients that reconnect and resume their stream
+REPLAY_BUFFER_SIZE = 256
+consumers = Broadcaster(SEND_QUEUE_SIZE, SLOW_CONSUMER_POLICY, REPLAY_BUFFER_SIZE)
+# requests and commands of the clients, the ones reconfiguring a module run one at a time per sensor
+commands = CommandRegistry(serial_key=sensor_id_of)
+commands.update(STREAM_COMMANDS.bound(consumers))
 producer = None
-display = Display(128, 64, 0x3C)
+# display back end, see display.backends.DISPLAY_BACKENDS: 'oled', 'console' or 'none' to run headless. It is
+# imported and opened after the server is listening, a display that can't be opened leaves the server headless
+DISPLAY_BACKEND = 'oled'
+DISPLAY_CONFIG = {'width': 128, 'height': 64, 'addr': 0x3C}
+# maximum number of display refreshes per second, independent of the radar update rate
+DISPLAY_MAX_FPS = 2
+# draws the presence of the primary sensor, None while there is no display
+display_worker = None
 address = "atom-radpi-01.local"
 PORT = 7890
+# processes accepting the websocket clients on PORT, each fanning out the frames of the frame bus to its own clients,
+# 0 to serve the clients in this process. Needs the frame bus
+FANOUT_WORKERS = 0
+# Unix socket the workers forward the commands of their clients to, this process owns the serial ports
+CONTROL_SOCKET = '/tmp/radar-control.sock'
+# path of the Prometheus text endpoint on the websocket port, None to disable it
+PROMETHEUS_PATH = '/metrics'
+# presence history by sensor id, kept for the 'history' request
+histories = {}
+# raw samples kept per sensor, one hour at 10 Hz
+HISTORY_CAPACITY = 36000
+# shared memory block the decoded frames are written to for local consumers (see frame_bus.FrameBusReader), None
+# to disable it
+FRAME_BUS_NAME = 'radar_frames'
+# created by main
+frame_bus = None
+# directory of the capture files, clients only name the files in it
+CAPTURE_DIRECTORY = 'captures'
+# detector class for each value of mode_selection
+DETECTOR_CLASSES = {cls.mode: cls for cls in (PresenceDetector, PowerBinsService, EnvelopeService, SparseService)}
 
 
-async def detector_data_handler(presence, score, distance):
+async def detector_data_handler(sensor_id, presence, score, distance, received=None):
+    # Send data to all connected consumers, the values are formatted by the wire format of each client
+    global detectors
+    frame = StreamFrame('presence', {"presence": presence, "score": score, "distance": distance},
+                        sensor=sensor_id, sensor_index=detectors.index(sensor_id), received=received)
+    await broadcast_stream(frame)
+    global histories
+    history = histories.get(sensor_id)
+    if history is None:
+        history = histories[sensor_id] = PresenceHistory(HISTORY_CAPACITY)
+    history.add(frame.timestamp, presence, score, distance)
+
     score = "{:.2f}".format(score)
-    global display
+    global display_worker
     distance = "{:.1f}".format(distance)
-    print(f'Presence: {"Person" if presence else "Empty"} || score={score} || distance={distance} meters')
-    # convert score to string
-    score = str(score)
+    print(f'{sensor_id}: Presence: {"Person" if presence else "Empty"} || score={score} || distance={distance} meters')
+    # the display worker draws in the background, it shows the sensor opened first
+    if display_worker is None or sensor_id != detectors.primary_id:
+        return
     if presence:
-        display.draw_text(score)
+        display_worker.show(score)
     else:
-        display.draw_text('Vacant')
-    display.clear_display()
+        display_worker.show('Vacant')
+
 
-    # Send data to all connected consumers
-    message = {'stream': 'presence', 'data': {"presence": presence, "score": score, "distance": distance}}
-    await broadcast_stream(message)
+async def service_data_handler(sensor_id, service, result_info, data, received=None):
+    """
+    Send the samples of a service frame to all connected consumers
+    :param sensor_id:  id of the sensor the frame came from
+    :param service:  name of the service stream
+    :param result_info:  dictionary with the result info of the frame
+    :param data:  NumPy array with the samples of the frame
+    :param received:  monotonic time the frame was received from the module
+    :return:
+    """
+    global detectors
+    frame = StreamFrame(service, {'result_info': result_info, 'samples': data},
+                        sensor=sensor_id, sensor_index=detectors.index(sensor_id), received=received)
+    await broadcast_stream(frame)
 
 
 async def message_router(websocket, path):
-    global consumers
+    global consumers, commands
     try:
         if websocket not in consumers:
             print("A new client has just connected")
             consumers.add(websocket)
         while True:
             payload = await websocket.recv()
-            message = json.loads(payload)
-            if next(iter(message.keys())) == 'req':
-                switcher = {
-                    'status': get_status_req,
-                }
-                # Get the function from switcher dictionary and call it passing the data dictionary as argument
-                await switcher[message['req']](websocket, message['data'])
-            elif next(iter(message.keys())) == 'cmd':
-                switcher = {
-                    'start_detector': start_detector_cmd,
-                    'stop_detector': stop_detector_cmd,
-                    'open_serial': open_serial_cmd,
-                    'request_status': get_status_req,
-                }
-                # Get the function from switcher dictionary and call it passing the data dictionary as argument
-                await switcher[message['cmd']](websocket, message['data'])
+            try:
+                message = decode_message(payload)
+            except ValueError as e:
+                await respond(websocket, {'ack': 'failed', 'data': {'comment': f'Invalid message: {e}'}})
+                continue
+            # every message is handled in its own task, the responses carry the id of the request
+            commands.start(websocket, message)
     except websockets.exceptions.ConnectionClosed as e:
         print("A client just disconnected")
     finally:
         consumers.remove(websocket)
 
 
+@commands.command('cmd', 'open_serial', fields={'port': str, 'baudrate': int, 'rtscts': bool, 'timeout': int},
+                  serial=True)
 async def open_serial_cmd(websocket, data):
+    """
+    Open the serial port of a sensor. The module starts at 115200 baud, the fastest UART speed up to baudrate that
+    the link carries is negotiated
+    """
     com_config = {
         'port': data['port'],
-        'baudrate': int(data['baudrate']),
-        'rtscts': bool(data['rtscts']),
-        'timeout': int(data['timeout'])
+        'baudrate': data['baudrate'],
+        'rtscts': data['rtscts'],
+        'timeout': data['timeout']
     }
 
-    global detector
-    if detector is not None:
-        await detector.stop_module()
-        await detector.clear_module()
-    detector = PresenceDetector(com_config)
-    print("detector instantiated & communicator configured with port:" + data['port'])
-    await asyncio.sleep(0.1)
-    await websocket.send(json.dumps({'ack': 'success', 'data': {'comment': 'Serial port opened'}}))
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = await detectors.open(sensor_id, PresenceDetector, com_config)
+    print(f"detector {sensor_id} instantiated & communicator configured with port:" + data['port'])
+    await respond(websocket, {'ack': 'success', 'data': {'comment': 'Serial port opened',
+                                                         'sensor_id': sensor_id,
+                                                         'baudrate': detector.com.baudrate}})
+
+
+@commands.command('cmd', 'open_simulator', fields={'noise': optional(float, 0.0),
+                                                  'corruption_rate': optional(float, 0.0)}, serial=True)
+async def open_simulator_cmd(websocket, data):
+    """
+    Open a simulated XM132 instead of a serial port, for testing without hardware. data may contain the noise and the
+    corruption_rate of the simulated stream
+    """
+    global detectors
+    sensor_id = sensor_id_of(data)
+    device = SimulatedXM132(noise=data['noise'], corruption_rate=data['corruption_rate'])
+    com_config = {
+        'port': f'sim://{sensor_id}',
+        'rtscts': False,
+        'timeout': 2,
+        'connector': device.connect,
+    }
+    await detectors.open(sensor_id, PresenceDetector, com_config)
+    print(f"detector {sensor_id} instantiated with a simulated module")
+    await respond(websocket, {'ack': 'success', 'data': {'comment': 'Simulated module opened',
+                                                         'sensor_id': sensor_id}})
 
 
+@commands.command('cmd', 'start_detector', fields={
+    'streaming_control': None,
+    'mode_selection': None,
+    'range_start': int,
+    'range_length': int,
+    'update_rate': int,
+    'profile_selection': None,
+}, serial=True)
 async def start_detector_cmd(websocket, data):
     mod_config = {
         'streaming_control': data['streaming_control'],
         'mode_selection': data['mode_selection'],
-        'range_start': int(data['range_start']),
-        'range_length': int(data['range_length']),
-        'update_rate': int(data['update_rate']),
+        'range_start': data['range_start'],
+        'range_length': data['range_length'],
+        'update_rate': data['update_rate'],
         'profile_selection': data['profile_selection'],
         'sensor_power_mode': 'active',
     }
-    global detector
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = detectors.get(sensor_id)
     if detector is not None:
+        # the supervisor of the running acquisition must not restart the module while it is reconfigured
+        task = detectors.stop_acquisition(sensor_id)
+        if task is not None:
+            await asyncio.wait({task}, timeout=detector.com.timeout)
+        # switch to the detector class of the requested mode, keeping the open serial connection
+        mode = mod_config['mode_selection']
+        mode = detector.mode_selection.options.get(mode, mode)
+        if mode not in DETECTOR_CLASSES:
+            raise ValueError(f'Unsupported mode {mode}')
+        if not isinstance(detector, DETECTOR_CLASSES[mode]):
+            detector = DETECTOR_CLASSES[mode](detector.com_config, com=detector.com,
+                                              shadow_registers=detector.shadow_registers)
+            detectors.replace(sensor_id, detector)
+        # registers specific to the mode, e.g. sweeps_per_frame for sparse
+        for key, value in data.items():
+            if key not in mod_config and key in getattr(detector, 'service_register_map', {}):
+                # option names are kept, numbers arrive as strings
+                mod_config[key] = value if getattr(detector, key).options and isinstance(value, str) else int(value)
+
         if await detector.create_module(mod_config):
             print("module created")
-            await asyncio.sleep(0.1)
-            await websocket.send(
-                json.dumps({'ack': 'success', 'data': {'comment': 'Module created, activating module'}}))
+            await respond(websocket, {'ack': 'success', 'data': {'comment': 'Module created, activating module'}})
 
             # activate module
             if await detector.activate_module():
                 print("module activated")
-                await asyncio.sleep(0.1)
-                await websocket.send(
-                    json.dumps({'ack': 'success', 'data': {'comment': 'Module activated, starting module'}}))
+                await respond(websocket, {'ack': 'success', 'data': {'comment': 'Module activated, starting module'}})
 
-                asyncio.create_task(detector.start_stream(detector_data_handler, 60))
+                # streams until stopped, stalls and serial errors are recovered from by the supervisor
+                detectors.supervise(sensor_id, data_handler_for(detector, sensor_id))
                 status, status_def = await detector.get_module_status()
-                await websocket.send(
-                    json.dumps({'resp': 'status',
-                                'data': {'status': status,
-                                         'status_def': status_def,
-                                         }
-                                }))
+                await respond(websocket, {'resp': 'status',
+                                          'data': {'status': status,
+                                                   'status_def': status_def,
+                                                   'sensor_id': sensor_id,
+                                                   }
+                                          })
             else:
                 status, status_def = await detector.get_module_status()
                 raise Exception(
                     f'Something went wrong, module not created & activated, detector status: {status} - {status_def}')
+        else:
+            status, status_def = await detector.get_module_status()
+            raise Exception(f'Something went wrong, module not created, detector status: {status} - {status_def}')
 
 
+@commands.command('cmd', 'stop_detector', fields={}, serial=True)
 async def stop_detector_cmd(websocket, data=None):
-    global detector
-    if detector is not None:
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = detectors.get(sensor_id)
+    if detector is not None and not detector.com.is_open:
+        # a replayed capture, there is no module to stop
+        detectors.close(sensor_id)
+        await respond(websocket, {'ack': 'success', 'data': {'comment': 'Replay stopped', 'sensor_id': sensor_id}})
+    elif detector is not None:
+        detectors.stop_acquisition(sensor_id)
         if await detector.stop_module():
-            await websocket.send(json.dumps({'ack': 'success', 'data': {'comment': 'Module stopped'}}))
-            detector = None
+            await respond(websocket, {'ack': 'success', 'data': {'comment': 'Module stopped',
+                                                                 'sensor_id': sensor_id}})
+            detectors.close(sensor_id)
         else:
             raise Exception('Failed to stop detector')
 
 
+@commands.command('req', 'status')
+@commands.command('cmd', 'request_status')
 async def get_status_req(websocket, data=None):
-    global detector
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = detectors.get(sensor_id)
+    time_to_first_frame = None
+    acquisition = None
+    baudrate = None
+    max_verified_baudrate = None
     if detector is None:
         status = 'null'
         status_def = 'No serial connection opened'
     else:
+        time_to_first_frame = detector.time_to_first_frame
+        baudrate = detector.com.baudrate
+        max_verified_baudrate = detector.com.verified_baudrate
+        supervisor = detectors.supervisors.get(sensor_id)
+        # state, number of restarts and the last gaps in the stream
+        acquisition = supervisor.stats() if supervisor is not None else None
         try:
             status, status_def = await detector.get_module_status()
         except Exception as e:
             status = 'null'
             status_def = f'Unknown error: {e}'
 
-    await websocket.send(json.dumps({'resp': 'status',
-                                     'data': {'status': status,
-                                              'status_def': status_def
-                                              }
-                                     }))
+    await respond(websocket, {'resp': 'status',
+                              'data': {'status': status,
+                                       'status_def': status_def,
+                                       'sensor_id': sensor_id,
+                                       # seconds from create to the first frame of the last start
+                                       'time_to_first_frame': time_to_first_frame,
+                                       'acquisition': acquisition,
+                                       # UART speed in use and the highest one verified with check_link
+                                       'baudrate': baudrate,
+                                       'max_verified_baudrate': max_verified_baudrate,
+                                       }
+                              })
 
 
-async def broadcast_stream(message):
+@commands.command('req', 'sensors')
+async def get_sensors_req(websocket, data=None):
     """
-    Broadcast a message to all connected consumer clients. This is for streaming data, not for responses to requests
-    :param message:
+    Send the open sensors with their index in binary stream frames, port, mode, whether they are streaming, and the
+    epoch and next sequence number of their stream
+    """
+    global detectors, consumers
+    sensors = [{'sensor_id': sensor_id,
+                'index': index,
+                'port': detector.com_config['port'],
+                'mode': detector.mode,
+                'streaming': detectors.is_streaming(sensor_id),
+                'epoch': consumers.epoch,
+                'next_seq': consumers.next_seq(sensor_id)}
+               for index, (sensor_id, detector) in enumerate(detectors.items())]
+    await respond(websocket, {'resp': 'sensors', 'data': sensors})
+
+
+def data_handler_for(detector, sensor_id):
+    """
+    Get the handler that sends the decoded frames of a detector to the clients
+    :param detector:  detector producing the frames
+    :param sensor_id:  id of the sensor the frames are tagged with
+    :return:  coroutine function taking the decoded frame as keyword arguments
+    """
+    if isinstance(detector, PresenceDetector):
+        return functools.partial(detector_data_handler, sensor_id)
+    return functools.partial(service_data_handler, sensor_id)
+
+
+@commands.command('cmd', 'start_capture', fields={'path': optional(str)})
+async def start_capture_cmd(websocket, data):
+    """
+    Record the raw stream frames of a sensor to a capture file in CAPTURE_DIRECTORY, data may contain the name of the
+    file (e.g. run1.cap, no directories)
+    """
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = detectors.get(sensor_id)
+    if detector is None:
+        raise ValueError(f'Sensor {sensor_id} is not open')
+    path = capture_path(CAPTURE_DIRECTORY, data.get('path') or f'capture-{sensor_id}-{int(time.time())}.cap')
+    os.makedirs(CAPTURE_DIRECTORY, exist_ok=True)
+    if detector.recorder is not None:
+        detector.recorder.close()
+    # everything needed to decode the frames again
+    metadata = {'sensor_id': sensor_id,
+                'mode': detector.mode,
+                'com_config': {key: value for key, value in detector.com_config.items() if key != 'connector'},
+                'registers': detector.shadow_registers,
+                'wall_time': time.time(),
+                'monotonic_time': time.monotonic()}
+    detector.recorder = CaptureWriter(path, metadata)
+    await respond(websocket, {'ack': 'success', 'data': {'comment': f'Capturing to {path}',
+                                                         'sensor_id': sensor_id}})
+
+
+@commands.command('cmd', 'stop_capture', fields={})
+async def stop_capture_cmd(websocket, data):
+    global detectors
+    sensor_id = sensor_id_of(data)
+    detector = detectors.get(sensor_id)
+    if detector is None or detector.recorder is None:
+        raise ValueError(f'Sensor {sensor_id} is not capturing')
+    recorder, detector.recorder = detector.recorder, None
+    recorder.close()
+    await respond(websocket, {'ack': 'success', 'data': {'comment': f'{recorder.frames} frames captured',
+                                                         'sensor_id': sensor_id}})
+
+
+@commands.command('cmd', 'replay_capture', fields={'path': str, 'speed': optional(float, 1.0),
+                                                  'sensor_id': optional(str, 'replay')})
+async def replay_capture_cmd(websocket, data):
+    """
+    Stream a capture file of CAPTURE_DIRECTORY to the clients as if it came from a sensor. data contains the path (the
+    file name), optionally the speed (1: original timing, 0: as fast as possible) and the sensor_id to tag the frames
+    with
+    """
+    global detectors
+    sensor_id = data['sensor_id']
+    speed = data['speed']
+    reader = CaptureReader(capture_path(CAPTURE_DIRECTORY, data['path']))
+    try:
+        metadata = reader.metadata
+        # a detector that is never connected, it only decodes the frames
+        detector = DETECTOR_CLASSES[metadata['mode']](metadata['com_config'])
+        detector.shadow_registers.update({int(address): value for address, value in metadata['registers'].items()})
+        detectors.add(sensor_id, detector)
+    except Exception:
+        reader.close()
+        raise
+
+    async def replay_capture():
+        try:
+            replayed = await replay(reader, detector, data_handler_for(detector, sensor_id), speed)
+            print(f"Replayed {replayed} frames from {data['path']}")
+        finally:
+            detectors.close(sensor_id)
+            reader.close()
+
+    detectors.start_acquisition(sensor_id, replay_capture())
+    await respond(websocket, {'ack': 'success', 'data': {'comment': f'Replaying {len(reader)} frames',
+                                                         'sensor_id': sensor_id}})
+
+
+@commands.command('req', 'history', fields={'window': optional(float, 3600.0), 'resolution': optional(int),
+                                           'series': optional(bool, False), 'raw': optional(int, 0)})
+async def get_history_req(websocket, data=None):
+    """
+    Send the presence aggregates of a sensor over the last window seconds: occupancy ratio, mean score, mean and
+    minimum distance while present and the number of presence transitions. data may contain
+    window: seconds (default 3600)
+    resolution: seconds per bucket (1, 60 or 900), by default the finest one covering the window
+    series: true to also get the aggregates of every bucket
+    raw: number of the latest raw samples to include (default 0)
+    """
+    global histories
+    sensor_id = sensor_id_of(data)
+    history = histories.get(sensor_id)
+    if history is None:
+        await respond(websocket, {'ack': 'failed', 'data': {'comment': f'No history for sensor {sensor_id}',
+                                                            'sensor_id': sensor_id}})
+        return
+    try:
+        result = history.window(data['window'], time.time(), resolution=data['resolution'], series=data['series'])
+    except ValueError as e:
+        await respond(websocket, {'ack': 'failed', 'data': {'comment': str(e), 'sensor_id': sensor_id}})
+        return
+    result['sensor_id'] = sensor_id
+    if data['raw']:
+        result['raw'] = history.latest(data['raw'])
+    await respond(websocket, {'resp': 'history', 'data': result})
+
+
+@commands.command('req', 'metrics')
+async def get_metrics_req(websocket, data=None):
+    """
+    Send the rolling latency percentiles of every stage (decode, handler, send, display, register round trip) and the
+    counters of the sensors and the fan-out
+    """
+    await respond(websocket, {'resp': 'metrics', 'data': registry.snapshot()})
+
+
+def collect_counters():
+    """
+    Counters kept by the sensors and the fan-out, read when the metrics are requested
+    :return:  list of (name, description, type, values by sensor id)
+    """
+    global detectors, consumers
+    # replayed captures have no serial connection
+    connected = [(sensor_id, detector) for sensor_id, detector in detectors.items() if detector.com.is_open]
+    return [
+        ('frames_received_total', 'Stream frames received from the module', 'counter',
+         {sensor_id: detector.com.received_frames for sensor_id, detector in connected}),
+        ('frames_dropped_total', 'Stream frames dropped because the ring buffer was full', 'counter',
+         {sensor_id: detector.com.dropped_frames for sensor_id, detector in connected}),
+        ('resyncs_total', 'Times the packet parser resynchronized after corrupted bytes', 'counter',
+         {sensor_id: detector.com.resyncs for sensor_id, detector in connected}),
+        ('dropped_bytes_total', 'Bytes skipped to resynchronize', 'counter',
+         {sensor_id: detector.com.dropped_bytes for sensor_id, detector in connected}),
+        ('framing_errors_total', 'Stream frames that could not be decoded', 'counter',
+         {sensor_id: detector.framing_errors for sensor_id, detector in detectors.items()}),
+        ('stream_restarts_total', 'Restart attempts after the stream stalled or failed', 'counter',
+         {sensor_id: supervisor.restarts for sensor_id, supervisor in detectors.supervisors.items()}),
+        ('published_frames_total', 'Frames published to the clients', 'counter', {None: consumers.published_frames}),
+        ('client_dropped_frames_total', 'Frames dropped for slow clients', 'counter', {None: consumers.dropped_frames}),
+        ('suppressed_frames_total', 'Unchanged presence frames not sent in change-driven mode', 'counter',
+         {None: consumers.suppressed_frames}),
+        ('dropped_clients_total', 'Clients disconnected for being too slow', 'counter',
+         {None: consumers.dropped_clients}),
+        ('clients', 'Connected clients', 'gauge', {None: len(consumers)}),
+    ] + ([('frame_bus_records_total', 'Records written to the shared memory frame bus', 'counter',
+           {None: frame_bus.written}),
+          ('frame_bus_split_frames_total', 'Service frames split over several frame bus records', 'counter',
+           {None: frame_bus.split_frames}),
+          ('frame_bus_dropped_frames_total', 'Frames too large for the frame bus, not written', 'counter',
+           {None: frame_bus.dropped_frames})] if frame_bus is not None else [])
+
+
+registry.add_collector(collect_counters)
+
+
+async def metrics_http_endpoint(path, request_headers):
+    """
+    Answer plain HTTP requests for PROMETHEUS_PATH with the metrics in the Prometheus text format, every other request
+    is handled as a websocket connection
+    """
+    if PROMETHEUS_PATH is None or path != PROMETHEUS_PATH:
+        return None
+    return http.HTTPStatus.OK, [('Content-Type', 'text/plain; version=0.0.4')], registry.prometheus().encode()
+
+
+async def broadcast_stream(frame):
+    """
+    Broadcast a frame to all connected consumer clients. This is for streaming data, not for responses to requests.
+    The frame is encoded once per wire format in use and queued for every client, slow clients are handled by
+    SLOW_CONSUMER_POLICY. Local consumers read it from the frame bus
+    :param frame: StreamFrame to send
     :return:
     """
-    global consumers
-    for consumer in consumers:
-        await consumer.send(json.dumps(message))
+    global consumers, frame_bus
+    consumers.publish(frame)
+    if frame_bus is not None:
+        frame_bus.write(frame)
+
+
+def start_display(backend):
+    """
+    Import and open the display back end and start drawing on it. Opening the OLED is slow (I2C), this runs in a
+    thread after the server is listening
+    :param backend:  name of the display back end
+    :return:  None
+    """
+    global display_worker
+    try:
+        display = create_display(backend, **DISPLAY_CONFIG)
+    except Exception as e:
+        # e.g. the OLED libraries are not installed or there is no OLED on the I2C bus
+        print(f"Display {backend} not available, running headless: {type(e).__name__}: {e}")
+        return
+    if display is None:
+        return
+    worker = DisplayWorker(display, DISPLAY_MAX_FPS,
+                           registry.histogram('display_draw_seconds', 'Time to draw a refresh on the display'))
+    worker.start()
+    display_worker = worker
+    print(f"Display {backend} started")
+
+
+def main():
+    global address, PORT, FRAME_BUS_NAME, CAPTURE_DIRECTORY, frame_bus
+    started = time.perf_counter()
+    parser = argparse.ArgumentParser(description='Websocket server of the radar modules')
+    parser.add_argument('--address', default=address, help='address to accept the clients on')
+    parser.add_argument('--port', type=int, default=PORT, help='websocket port')
+    parser.add_argument('--display', choices=list(DISPLAY_BACKENDS), default=DISPLAY_BACKEND,
+                        help='display back end')
+    parser.add_argument('--headless', action='store_const', const='none', dest='display',
+                        help='run without a display, same as --display none')
+    parser.add_argument('--frame-bus-name', default=FRAME_BUS_NAME,
+                        help='shared memory block of the frame bus, empty to disable it')
+    parser.add_argument('--capture-directory', default=CAPTURE_DIRECTORY, help='directory of the capture files')
+    args = parser.parse_args()
+    address, PORT, FRAME_BUS_NAME = args.address, args.port, args.frame_bus_name or None
+    CAPTURE_DIRECTORY = args.capture_directory
+
+    frame_bus = FrameBusWriter(FRAME_BUS_NAME) if FRAME_BUS_NAME is not None else None
+    loop = asyncio.get_event_loop()
+    if FANOUT_WORKERS:
+        if frame_bus is None:
+            raise ValueError('The fan-out workers read the frames from the frame bus, FRAME_BUS_NAME must be set')
+        control_server = ControlServer(CONTROL_SOCKET, commands.start, registry.prometheus)
+        loop.run_until_complete(control_server.start())
+        workers = WorkerPool(FANOUT_WORKERS, address=address, port=PORT, frame_bus_name=FRAME_BUS_NAME,
+                             control_path=CONTROL_SOCKET, epoch=consumers.epoch, queue_size=SEND_QUEUE_SIZE,
+                             slow_consumer_policy=SLOW_CONSUMER_POLICY, replay_size=REPLAY_BUFFER_SIZE,
+                             prometheus_path=PROMETHEUS_PATH)
+        loop.call_soon(workers.start)
+    else:
+        start_server = websockets.serve(message_router, address, PORT, process_request=metrics_http_endpoint)
+        loop.run_until_complete(start_server)
+    print(f"Server started on {address}:{PORT}, {(time.perf_counter() - started) * 1000:.0f} ms after the imports")
+    loop.run_in_executor(None, start_display, args.display)
+    # stopped by a service manager, the frame bus is removed on the way out
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        if frame_bus is not None:
+            frame_bus.close()
 
 
-start_server = websockets.serve(message_router, address, PORT)
-asyncio.get_event_loop().run_until_complete(start_server)
-asyncio.get_event_loop().run_forever()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import bisect
+import time
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. Keeps the counts since the start, for Prometheus, and the counts of the last
+    window seconds in a ring of slots, for the rolling percentiles. Observing a value is a binary search over the
+    bucket bounds and a few increments.
+    """
+
+    # upper bounds in seconds, 10 us to about 10 s in powers of two
+    DEFAULT_BOUNDS = tuple(0.00001 * 2 ** i for i in range(21))
+
+    def __init__(self, name, description, bounds=DEFAULT_BOUNDS, window=60, slots=6):
+        """
+        :param name:  name of the metric
+        :param description:  help text of the metric
+        :param bounds:  sorted upper bounds of the buckets, values above the last one go into an overflow bucket
+        :param window:  seconds covered by the rolling counts
+        :param slots:  number of slots the window is divided in, older values are forgotten one slot at a time
+        """
+        self.name = name
+        self.description = description
+        self.bounds = bounds
+        self.window = window
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._slot_length = window / slots
+        self._slots = [[0] * (len(bounds) + 1) for _ in range(slots)]
+        # time each slot was started
+        self._slot_starts = [float('-inf')] * slots
+        self._slot = 0
+        self._slot_end = float('-inf')
+
+    def observe(self, value, now=None):
+        """
+        Add a value
+        :param value:  value in seconds
+        :param now:  monotonic time of the observation, now if None
+        :return:  None
+        """
+        bucket = bisect.bisect_left(self.bounds, value)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.sum += value
+        if now is None:
+            now = time.monotonic()
+        if now >= self._slot_end:
+            self._rotate(now)
+        self._slots[self._slot][bucket] += 1
+
+    def since(self, start, now=None):
+        """
+        Observe the time elapsed since start
+        :param start:  monotonic time
+        :param now:  monotonic time of the end, now if None
+        :return:  None
+        """
+        if now is None:
+            now = time.monotonic()
+        self.observe(now - start, now)
+
+    def rolling_counts(self, now=None):
+        """
+        Bucket counts of the last window seconds
+        :param now:  monotonic time, now if None
+        :return:  list with the count of every bucket
+        """
+        if now is None:
+            now = time.monotonic()
+        oldest = now - self.window
+        counts = [0] * len(self.counts)
+        for start, slot in zip(self._slot_starts, self._slots):
+            if start > oldest:
+                for bucket, count in enumerate(slot):
+                    counts[bucket] += count
+        return counts
+
+    def quantile(self, fraction, counts=None):
+        """
+        Estimate a quantile, interpolating linearly inside the bucket it falls in
+        :param fraction:  0 to 1
+        :param counts:  bucket counts, the rolling counts if None
+        :return:  value in seconds, None without observations
+        """
+        if counts is None:
+            counts = self.rolling_counts()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[bucket - 1] if bucket else 0.0
+                # the overflow bucket has no upper bound, report its lower bound
+                upper = self.bounds[bucket] if bucket < len(self.bounds) else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def summary(self):
+        """
+        Rolling percentiles and totals
+        :return:  dictionary with the number of values in the window, p50, p90, p99 in milliseconds, and the total count
+        and mean since the start
+        """
+        counts = self.rolling_counts()
+        summary = {'window_count': sum(counts)}
+        for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+            value = self.quantile(fraction, counts)
+            summary[name] = None if value is None else value * 1000
+        summary['count'] = self.count
+        summary['mean_ms'] = self.sum / self.count * 1000 if self.count else None
+        return summary
+
+    def _rotate(self, now):
+        self._slot = (self._slot + 1) % len(self._slots)
+        slot = self._slots[self._slot]
+        for bucket in range(len(slot)):
+            slot[bucket] = 0
+        self._slot_starts[self._slot] = now
+        self._slot_end = now + self._slot_length
+
+
+class Metrics:
+    """
+    In-process metrics: latency histograms that the code observes into, and collectors that read the counters the
+    objects keep anyway (frames, drops, resyncs) when the metrics are requested.
+    """
+
+    def __init__(self, prefix='radar_'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.collectors = []
+
+    def histogram(self, name, description, **kwargs):
+        """
+        Get a histogram, creating it on first use
+        :param name:  name of the histogram
+        :param description:  help text
+        :param kwargs:  arguments for Histogram
+        :return:  Histogram
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(name, description, **kwargs)
+        return histogram
+
+    def add_collector(self, collector):
+        """
+        Add a function called when the metrics are read
+        :param collector:  function returning a list of (name, description, type, values) with type 'counter' or
+        'gauge' and values a dictionary with a sensor id (or None) as key and the number as value
+        :return:  None
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        """
+        Read all collectors
+        :return:  list of (name, description, type, values)
+        """
+        return [metric for collector in self.collectors for metric in collector()]
+
+    def snapshot(self):
+        """
+        Current metrics for the 'metrics' request
+        :return:  dictionary with the histogram summaries and the counters, by sensor id for per sensor counters
+        """
+        return {
+            'latency': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            'counters': {name: values[None] if list(values) == [None] else values
+                         for name, _description, _kind, values in self.collect()},
+        }
+
+    def prometheus(self):
+        """
+        Current metrics in the Prometheus text exposition format
+        :return:  str
+        """
+        lines = []
+        for name, histogram in self.histograms.items():
+            name = self.prefix + name
+            lines.append(f'# HELP {name} {histogram.description}')
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum {histogram.sum}')
+            lines.append(f'{name}_count {histogram.count}')
+        for name, description, kind, values in self.collect():
+            name = self.prefix + name
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sensor_id, value in values.items():
+                labels = '' if sensor_id is None else f'{{sensor="{sensor_id}"}}'
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of the process
+registry = Metrics()
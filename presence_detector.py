@@ -1,8 +1,5 @@
 from radar_module import RadarModule
-import time
 import struct
-from communicator import SerialCom
-import websockets
 
 
 # detector class extends xm_module
@@ -11,14 +8,22 @@ class PresenceDetector(RadarModule):
     Class for the presence detector module. Inherits from the RadarModule class
     """
 
-    def __init__(self, com_config):
+    stream_name = 'presence'
+    mode = 'presence'
+
+    # presence detected, score, distance
+    RESULT = struct.Struct("<bff")
+
+    def __init__(self, com_config, com=None, shadow_registers=None):
         """
         Initialize the presence detector module
         :param com_config:  dictionary with the configuration for the serial communication. Should contain the port and
         rtscts settings (True or False)
+        :param com:  SerialCom object of an already opened connection to reuse, a new one is created if None
+        :param shadow_registers:  shadow copy of the register map that belongs to com
         """
         self.streaming = False
-        super().__init__(com_config)
+        super().__init__(com_config, com=com, shadow_registers=shadow_registers)
         # validate the configuration
         # create properties for each register
         self.presence_register_map = {
@@ -76,19 +81,15 @@ class PresenceDetector(RadarModule):
         }
         # set default configuration
 
-    async def start_stream(self, data_handler_func=None, duration=60):
-        print("Starting detector")
-        start = time.monotonic()
-
-        while time.monotonic() - start < duration:
-
-            stream = self.com.read_stream()
-            _result_info, buffer = SerialCom.decode_streaming_buffer(stream)
-
-            (presence, score, distance) = struct.unpack("<bff", buffer)
-
-            if data_handler_func:
-                await data_handler_func(presence=presence, score=score, distance=distance)
+    def decode_frame(self, result_info, buffer):
+        """
+        Decode the presence result of a stream frame
+        :param result_info:  dictionary with the result info of the frame
+        :param buffer:  data of the frame
+        :return:  dictionary with presence, score and distance
+        """
+        (presence, score, distance) = self.RESULT.unpack(buffer)
+        return {'presence': presence, 'score': score, 'distance': distance}
 
     @staticmethod
     def _validate_mod_config(mod_config):
@@ -1,11 +1,56 @@
+import struct
 import time
-from register import Register
-from communicator import SerialCom
+from register import Register, RegisterWriteError
+from communicator import SerialCom, FramingError, ModuleError
+from metrics import registry
+
+DECODE_LATENCY = registry.histogram('decode_seconds',
+                                    'Time from receiving a stream frame to decoding it, including the wait in the ring '
+                                    'buffer')
+HANDLER_TIME = registry.histogram('handler_seconds', 'Time spent in the data handler of a decoded frame')
+TIME_TO_FIRST_FRAME = registry.histogram('time_to_first_frame_seconds',
+                                         'Time from the start of create_module to the first stream frame')
 
 
 class RadarModule:
-    def __init__(self, com_config):
-        self.com = SerialCom(port=com_config['port'], rtscts=com_config['rtscts'])
+    # name of the stream sent to the clients, set by the detector classes
+    stream_name = None
+
+    # bits of the status register
+    STATUS_CREATED = 0x00000001
+    STATUS_ACTIVATED = 0x00000002
+    STATUS_ERROR_MASK = 0xFFFF0000
+
+    # UART speeds of the module software, tried from the highest
+    UART_BAUDRATES = (3000000, 2000000, 1000000, 921600, 460800, 230400, 115200)
+    # rounds of back-to-back register reads that must all succeed at a new UART speed
+    LINK_CHECK_ROUNDS = 4
+    # seconds to wait for the replies of a link check round
+    LINK_CHECK_TIMEOUT = 0.2
+    # writes of the previous UART speed at a speed that failed, each one confirmed with a link check at the previous
+    # speed
+    BAUDRATE_FALLBACK_ATTEMPTS = 8
+    # single reads of the UART speed at a speed that failed, one correct reply finds the module there
+    BAUDRATE_PROBES = 16
+
+    def __init__(self, com_config, com=None, shadow_registers=None):
+        self.com_config = com_config
+        if com is None:
+            com = SerialCom(port=com_config['port'], rtscts=com_config['rtscts'],
+                            timeout=com_config.get('timeout', 2), connector=com_config.get('connector'))
+        self.com = com
+        # shadow copy of the register map of the module, address -> last written/read value
+        self.shadow_registers = shadow_registers if shadow_registers is not None else {}
+        self.framing_errors = 0
+        # CaptureWriter that records the raw stream frames, None when not recording
+        self.recorder = None
+        # seconds from the start of create_module to the first stream frame of the last start, None until measured
+        self.time_to_first_frame = None
+        self._create_started = None
+        # monotonic time the last activation was sent, frames received before it are left over from before the create
+        self._activate_started = None
+        # configuration of the last create_module, re-applied when the acquisition is restarted
+        self.config = None
 
         self.general_register_map = {
             'mode_selection': {
@@ -22,6 +67,7 @@ class RadarModule:
             'main_control': {
                 'address': 0x3,
                 'rw': (False, True),
+                'volatile': True,
                 'options': {
                     0: 'stop',
                     1: 'create',
@@ -33,6 +79,7 @@ class RadarModule:
             'status': {
                 'address': 0x6,
                 'rw': (True, False),
+                'volatile': True,
                 'options': {
                     0: "No bits set",
                     0x000000FF: "Bits can't be cleared with clear_status",
@@ -68,11 +115,231 @@ class RadarModule:
                     0: 'streaming_disabled',
                     1: 'streaming_enabled'
                 }
+            },
+            'uart_baudrate': {
+                'address': 0x07,
+                'rw': (True, True)
             }
         }
 
         self._make_registers(self, self.general_register_map)
 
+    async def open(self):
+        """
+        Open the serial connection to the module
+        :return:  None
+        """
+        await self.com.open()
+
+    def close(self):
+        """
+        Close the serial connection to the module
+        :return:  None
+        """
+        self.com.close()
+
+    async def check_link(self):
+        """
+        Check that the module answers correctly at the current UART speed: LINK_CHECK_ROUNDS rounds of back-to-back
+        reads of the product identification and the UART speed, every reply must arrive and match
+        :return:  True if every read succeeded
+        """
+        addresses = (self.product_identification.address, self.uart_baudrate.address)
+        for _ in range(self.LINK_CHECK_ROUNDS):
+            values = await self.com.register_read_many(addresses, self.LINK_CHECK_TIMEOUT)
+            if values[self.product_identification.address] not in self.product_identification.options:
+                return False
+            if values[self.uart_baudrate.address] != self.com.baudrate:
+                return False
+        self.shadow_registers[self.uart_baudrate.address] = self.com.baudrate
+        if self.com.verified_baudrate is None or self.com.baudrate > self.com.verified_baudrate:
+            self.com.verified_baudrate = self.com.baudrate
+        return True
+
+    async def negotiate_baudrate(self, max_baudrate):
+        """
+        Raise the UART speed to the highest one the link carries, up to max_baudrate. The speeds are tried one step at
+        a time from the current one: the speed is written to the module over the verified link (it acknowledges at
+        the old speed and switches), the port is reopened at the new speed and check_link verifies it. The first
+        speed that fails ends the negotiation and the module is brought back to the speed that worked.
+
+        A new speed is only written over a link that just passed check_link. Bringing the module back has to write
+        over the link that failed, the write is repeated until check_link passes at the previous speed, and if it
+        went astray the module is looked for at every speed.
+        :param max_baudrate:  highest speed to try, e.g. the one requested by the client
+        :return:  the UART speed in use
+        :raises ModuleError:  if the module can't be reached at a speed that works
+        """
+        if not await self.check_link():
+            await self._recover_baudrate(self.com.DEFAULT_BAUDRATE)
+        for baudrate in sorted(self.UART_BAUDRATES):
+            if baudrate <= self.com.baudrate or baudrate in self.com.failed_baudrates:
+                continue
+            if baudrate > max_baudrate:
+                break
+            previous = self.com.baudrate
+            if await self._switch_baudrate(baudrate):
+                print(f"UART speed raised to {baudrate} baud")
+                continue
+            self.com.failed_baudrates.append(baudrate)
+            print(f"UART speed {baudrate} baud failed, staying at {previous} baud")
+            # the port is still at the previous speed unless the module switched
+            if self.com.baudrate != previous and not await self._switch_back(baudrate, previous):
+                await self._recover_baudrate(previous)
+            break
+        return self.com.baudrate
+
+    async def find_baudrate(self):
+        """
+        Find the UART speed the module is at, e.g. after the server restarted without a power cycle of the module.
+        Only reads are sent, the speed of the module is not changed. At the speeds that failed check_link can't pass,
+        one correct reply of BAUDRATE_PROBES reads is enough there
+        :return:  the UART speed found
+        :raises ModuleError:  if the module doesn't answer at any speed
+        """
+        # the current speed, then the one after a power up, then the others from the highest, the ones that failed last
+        candidates = dict.fromkeys((self.com.baudrate, self.com.DEFAULT_BAUDRATE, *self.UART_BAUDRATES))
+        candidates = sorted(candidates, key=lambda baudrate: baudrate in self.com.failed_baudrates)
+        for baudrate in candidates:
+            await self.com.reopen(baudrate)
+            if baudrate in self.com.failed_baudrates:
+                if await self._probe_baudrate():
+                    return baudrate
+            elif await self.check_link():
+                return baudrate
+        raise ModuleError('The module does not answer at any UART speed')
+
+    async def _probe_baudrate(self):
+        """
+        Look for the module at the current speed of the port over a link too bad for check_link
+        :return:  True if a read of the UART speed returned the speed of the port
+        """
+        for _ in range(self.BAUDRATE_PROBES):
+            values = await self.com.register_read_many((self.uart_baudrate.address,), self.LINK_CHECK_TIMEOUT)
+            if values[self.uart_baudrate.address] == self.com.baudrate:
+                return True
+        return False
+
+    async def _recover_baudrate(self, baudrate):
+        """
+        Find the module and bring it back to baudrate if it is at a speed that failed
+        :param baudrate:  speed that works to bring the module back to
+        :return:  None
+        :raises ModuleError:  if the module can't be reached at a speed that works
+        """
+        found = await self.find_baudrate()
+        if found in self.com.failed_baudrates and not await self._switch_back(found, baudrate):
+            raise ModuleError(f'The module is at {found} baud and could not be brought back to {baudrate} baud')
+
+    async def _switch_baudrate(self, baudrate):
+        """
+        Switch the verified link to another speed. The port is opened at the new speed first, a speed the serial
+        adapter can't do is given up before the module is told to switch
+        :return:  True if the link works at the new speed
+        """
+        previous = self.com.baudrate
+        try:
+            await self.com.reopen(baudrate)
+        except (OSError, ValueError) as e:
+            print(f"The serial port can't be opened at {baudrate} baud: {e}")
+            await self.com.reopen(previous)
+            return False
+        await self.com.reopen(previous)
+        if not await self.check_link():
+            return False
+        results = await self.com.register_write_many({self.uart_baudrate.address: baudrate})
+        if results[self.uart_baudrate.address] is not None and await self.check_link():
+            # not acknowledged and still answering at the old speed, the write didn't arrive
+            return False
+        await self.com.reopen(baudrate)
+        return await self.check_link()
+
+    async def _switch_back(self, baudrate, previous):
+        """
+        Bring the module from baudrate, where check_link failed, back to previous. The write goes over the link that
+        failed, so it is repeated until check_link passes at previous. The acknowledgement is not waited for, it
+        comes back at the speed that failed
+        :return:  True if the module answers at previous
+        """
+        for _ in range(self.BAUDRATE_FALLBACK_ATTEMPTS):
+            await self.com.reopen(baudrate)
+            await self.com.register_write_many({self.uart_baudrate.address: previous}, self.LINK_CHECK_TIMEOUT)
+            await self.com.reopen(previous)
+            if await self.check_link():
+                return True
+        return False
+
+    def decode_frame(self, result_info, buffer):
+        """
+        Decode the data of a stream frame, implemented by the detector classes
+        :param result_info:  dictionary with the result info of the frame
+        :param buffer:  data of the frame
+        :return:  dictionary with the keyword arguments for the data handler
+        """
+        raise NotImplementedError
+
+    async def start_stream(self, data_handler_func=None, duration=None, stall_timeout=None, stopped=None):
+        """
+        Read stream frames from the module, decode them and pass them to data_handler_func
+        :param data_handler_func:  coroutine function called with the decoded frame as keyword arguments
+        :param duration:  number of seconds to stream, None to stream until cancelled
+        :param stall_timeout:  seconds without a frame after which the stream is considered stalled, the serial timeout
+        if None
+        :param stopped:  function returning True when streaming has to end, checked around every read. Cancelling the
+        task alone is not enough, the cancellation can be lost in the wait for a frame (Python < 3.12)
+        :return:  None
+        :raises TimeoutError:  if the stream stalls
+        :raises ConnectionError:  if the serial connection is lost
+        """
+        print("Starting detector")
+        start = time.monotonic()
+
+        while duration is None or time.monotonic() - start < duration:
+
+            if stopped is not None and stopped():
+                return
+            received, stream = await self.com.read_stream(stall_timeout)
+            if stopped is not None and stopped():
+                # the frame may already belong to the detector taking over the port
+                return
+            if self._create_started is not None:
+                if self._activate_started is None or received < self._activate_started:
+                    continue
+                self.time_to_first_frame = received - self._create_started
+                self._create_started = None
+                TIME_TO_FIRST_FRAME.observe(self.time_to_first_frame)
+                print(f"First frame {self.time_to_first_frame * 1000:.1f} ms after create")
+            if self.recorder is not None:
+                self.recorder.write(stream, received)
+            await self.process_stream(stream, data_handler_func, received)
+
+    async def process_stream(self, stream, data_handler_func=None, received=None):
+        """
+        Decode a raw stream frame and pass it to data_handler_func. Used for live and replayed frames
+        :param stream:  stream payload as received from the module
+        :param data_handler_func:  coroutine function called with the decoded frame and the receive time (received)
+        as keyword arguments
+        :param received:  monotonic time the frame was received from the module, now if None
+        :return:  True if the frame was decoded, False if it was corrupted
+        """
+        if received is None:
+            received = time.monotonic()
+        try:
+            result_info, buffer = SerialCom.decode_streaming_buffer(stream)
+            frame = self.decode_frame(result_info, buffer)
+        except (FramingError, ValueError, struct.error) as e:
+            # skip the corrupted frame and keep streaming
+            self.framing_errors += 1
+            print(f"Discarding stream frame: {e}")
+            return False
+
+        decoded = time.monotonic()
+        DECODE_LATENCY.observe(decoded - received, decoded)
+        if data_handler_func:
+            await data_handler_func(received=received, **frame)
+            HANDLER_TIME.since(decoded)
+        return True
+
     async def get_module_info(self):
         """
         Get module identification and version
@@ -89,9 +356,47 @@ class RadarModule:
         :return:  status as int
         """
         status = await self.status.get_value()
-        s_definition = await self.status.get_value_with_definition()
+        s_definition = await self.status.get_value_with_definition(status)
         return status, s_definition
 
+    async def wait_status(self, bits, timeout=2):
+        """
+        Wait until all bits are set in the status register. The register is polled with short intervals at first,
+        growing up to 50 ms, and the event loop is never blocked.
+        :param bits:  status bits to wait for, e.g. STATUS_CREATED | STATUS_ACTIVATED
+        :param timeout:  maximum number of seconds to wait
+        :return:  status
+        :raises ModuleError:  if an error bit is set in the meantime, waiting longer would not help
+        :raises TimeoutError:  if the bits are not set within timeout
+        """
+        def is_set(status):
+            if status & self.STATUS_ERROR_MASK:
+                raise ModuleError(f"Error in module, status: 0x{status:08X}")
+            return status & bits == bits
+
+        return await self.status.wait_for(is_set, timeout)
+
+    def stall_timeout(self, periods=5, minimum=0.5):
+        """
+        Time without stream frames after which the stream is considered stalled
+        :param periods:  number of update periods
+        :param minimum:  lower limit in seconds
+        :return:  seconds, None if the update rate is unknown
+        """
+        update_rate = getattr(self, 'update_rate', None)
+        if update_rate is None or not update_rate.cached_value:
+            return None
+        # update rate in mHz
+        return max(periods * 1000 / update_rate.cached_value, minimum)
+
+    def invalidate_shadow(self):
+        """
+        Forget the shadow copy of the register map, e.g. when the module may have been reset. The next reads go to
+        the module and the next configuration writes every register.
+        :return:  None
+        """
+        self.shadow_registers.clear()
+
     @staticmethod
     def _validate_com_config(com_config):
         """
@@ -104,11 +409,12 @@ class RadarModule:
             raise ValueError("Port not set")
         if 'rtscts' not in com_config:
             raise ValueError("rtscts not set")
-        # check that port is a string in format 'COMx' or '/dev/ttyUSBx'
+        # check that port is a string in format 'COMx' or '/dev/ttyUSBx', or '/dev/pts/x' or 'sim://x' for a simulated
+        # module
         if not isinstance(com_config['port'], str):
             raise ValueError("Port must be a string")
-        if not (com_config['port'].startswith('COM') or com_config['port'].startswith('/dev/ttyUSB')):
-            raise ValueError("Port must be in format 'COMx' or '/dev/ttyUSBx'")
+        if not com_config['port'].startswith(('COM', '/dev/ttyUSB', '/dev/pts/', 'sim://')):
+            raise ValueError("Port must be in format 'COMx', '/dev/ttyUSBx', '/dev/pts/x' or 'sim://x'")
         if not isinstance(com_config['rtscts'], bool):
             raise ValueError("rtscts must be a bool")
 
@@ -121,13 +427,14 @@ class RadarModule:
         :return:  None
         """
         for key, value in register_map.items():
-            setattr(self, key, Register.from_dict(value, self.com))
+            setattr(self, key, Register.from_dict(value, self.com, self.shadow_registers))
             print(f"Register {key} created")
 
     @staticmethod
     async def _configure_module(self, config) -> None:
         """
-        Configure detector with config parameters in config dictionary
+        Configure detector with config parameters in config dictionary. Only registers whose value differs from the
+        shadow copy are written.
         :param self:  instance of the class
         :param config:  dictionary with the configuration parameters. Requires keys: range_start, range_length,
         update_rate,
@@ -136,16 +443,92 @@ class RadarModule:
         if config is None:
             return
         print("Configuring Module")
-        for key, value in config.items():
+        written = await self.write_registers(config)
+        for key in config:
             # get register from instance of the class by name (key)
             register = getattr(self, key)
-            # set value of current register
-            if isinstance(value, int):
-                await register.set_value(value)
-                print(f"-{key} set to: {await register.get_value()}")
-            elif isinstance(value, str):
-                await register.set_by_definition(value)
-                print(f"-{key} set to: {await register.get_value_with_definition()}")
+            state = 'set to' if key in written else 'unchanged'
+            if register.options:
+                print(f"-{key} {state}: {await register.get_value_with_definition(register.cached_value)}")
+            else:
+                print(f"-{key} {state}: {register.cached_value}")
+
+    async def write_registers(self, values, only_changed=True, verify=True):
+        """
+        Write several registers in one batch. All writes are sent back-to-back, the acknowledgements are collected as
+        they arrive and the written registers are read back once at the end to verify them.
+        :param values:  dictionary with register name as key and int value or option name as value, written in this
+        order
+        :param only_changed:  skip registers whose value in the shadow copy already matches
+        :param verify:  read back the written registers after all writes are acknowledged
+        :return:  list with the names of the registers that were written
+        :raises RegisterWriteError:  with the error of every register that could not be written or verified
+        """
+        errors = {}
+        to_write = {}
+        for key, value in values.items():
+            register = getattr(self, key, None)
+            if not isinstance(register, Register):
+                errors[key] = 'Unknown register'
+                continue
+            try:
+                value = register.to_value(value)
+            except ValueError as e:
+                errors[key] = str(e)
+                continue
+            if only_changed and not register.differs(value):
+                continue
+            to_write[key] = (register, value)
+        if errors:
+            raise RegisterWriteError(errors)
+
+        results = await self.com.register_write_many(
+            {register.address: value for register, value in to_write.values()})
+        to_verify = {}
+        for key, (register, value) in to_write.items():
+            error = results[register.address]
+            if error is not None:
+                # the register may or may not have been written
+                self.shadow_registers.pop(register.address, None)
+                errors[key] = f'Write failed: {error!r}'
+                continue
+            self.shadow_registers[register.address] = value
+            if verify and register.read and not register.volatile:
+                to_verify[register.address] = (key, value)
+
+        read_back = await self.com.register_read_many(to_verify)
+        for address, (key, value) in to_verify.items():
+            result = read_back[address]
+            if isinstance(result, Exception):
+                errors[key] = f'Verification read failed: {result!r}'
+                continue
+            self.shadow_registers[address] = result
+            if result != value:
+                errors[key] = f'Reads back {result}, expected {value}'
+
+        if errors:
+            raise RegisterWriteError(errors)
+        return list(to_write)
+
+    async def read_registers(self, names):
+        """
+        Read several registers in one batch, all reads are sent back-to-back. Non-volatile values refresh the shadow
+        copy.
+        :param names:  iterable with register names, registers that can't be read are skipped
+        :return:  dictionary with register name as key and value as value, registers whose read failed are left out
+        """
+        registers = {name: getattr(self, name) for name in names}
+        values = await self.com.register_read_many({register.address for register in registers.values()
+                                                    if register.read})
+        result = {}
+        for name, register in registers.items():
+            value = values.get(register.address)
+            if value is None or isinstance(value, Exception):
+                continue
+            if not register.volatile:
+                self.shadow_registers[register.address] = value
+            result[name] = value
+        return result
 
     async def create_module(self, config=None):
         """
@@ -154,16 +537,23 @@ class RadarModule:
         :param config:  dictionary with the configuration parameters. Requires keys: range_start, range_length,
         :return:  bool: True if successful, False if not
         """
+        self.config = config
         try:
+            self._create_started = time.monotonic()
+            self._activate_started = None
             await self.stop_module()
             await self.clear_module()
+            # frames of the stopped configuration must not be decoded with the new one
+            discarded = self.com.clear_stream()
+            if discarded:
+                print(f"Discarded {discarded} stream frames of the previous configuration")
             await self._configure_module(self, config)
             await self.main_control.set_value(1)
-            status, status_def = await self.get_module_status()
-            print(f'Sensor status: {status} : {status_def}')
+            status = await self.wait_status(self.STATUS_CREATED)
+            print(f'Sensor status: {status} : {await self.status.get_value_with_definition(status)}')
 
-            if status != 1:
-                print(f"Unexpected status: {status_def}")
+            if status & self.STATUS_ACTIVATED:
+                print("Unexpected status: already activated")
                 return False
             return True
         except Exception as e:
@@ -172,17 +562,19 @@ class RadarModule:
 
     async def activate_module(self):
         print("Activating module")
-        if await Register.value_matches(self.status, 1):
-            try:
-                await self.main_control.set_value(2)
-                status, status_def = await self.get_module_status()
-                print(f'Sensor status: {status} : {status_def}')
-                return await Register.value_matches(self.status, 3)
-            except Exception as e:
-                print(f"Error while activating module: {e}")
-                return False
-        else:
+        try:
+            await self.wait_status(self.STATUS_CREATED)
+        except (ModuleError, TimeoutError):
             raise ValueError("Module not in correct state")
+        try:
+            self._activate_started = time.monotonic()
+            await self.main_control.set_value(2)
+            status = await self.wait_status(self.STATUS_CREATED | self.STATUS_ACTIVATED)
+            print(f'Sensor status: {status} : {await self.status.get_value_with_definition(status)}')
+            return True
+        except Exception as e:
+            print(f"Error while activating module: {e}")
+            return False
 
     async def stop_module(self):
         """
@@ -1,6 +1,14 @@
 from communicator import SerialCom
-import asyncio
-import time
+
+
+class RegisterWriteError(Exception):
+    """
+    One or more registers could not be written. errors holds the register name as key and the reason as value
+    """
+
+    def __init__(self, errors: dict):
+        self.errors = errors
+        super().__init__('; '.join(f'{name}: {error}' for name, error in errors.items()))
 
 
 class Register:
@@ -9,89 +17,117 @@ class Register:
     """
 
     @classmethod
-    def from_dict(cls, register_dict: dict, com: SerialCom) -> 'Register':
+    def from_dict(cls, register_dict: dict, com: SerialCom, shadow: dict = None) -> 'Register':
         """
         Create a register from a dictionary, the dictionary should contain the "address", the "rw" read/write
         permissions, a SerialCom object to communicate with the module and an optional "options" dictionary.
+        Registers whose value can change in the module by itself are marked with "volatile" and are never served
+        from the shadow copy.
         :param register_dict: dictionary with the register information
         :param com: SerialCom object to communicate with the module
-        :param options:  dictionary with options for the register
+        :param shadow:  dictionary with the shadow copy of the register map of the module (address as key)
         :return: Register object
         """
         if 'options' in register_dict:
             options = register_dict['options']
         else:
             options = None
-        return cls(address=register_dict['address'], rw=register_dict['rw'], com=com, options=options)
+        return cls(address=register_dict['address'], rw=register_dict['rw'], com=com, options=options,
+                   volatile=register_dict.get('volatile', False), shadow=shadow)
 
     @classmethod
-    async def definition_matches_value(cls, register, wanted_definition) -> bool:
+    async def definition_matches_value(cls, register, wanted_definition, timeout=2) -> bool:
         """
-        Check if the value of the register matches the wanted definition
+        Wait until the value of the register matches the wanted definition
         :param register:  Register object
         :param wanted_definition:  string definition to check the register against
+        :param timeout:  maximum number of seconds to wait
         :return:  True if the definition matches, False if not
         """
-        cur_value = await register.get_value()
-        duration = time.monotonic()
-        while time.monotonic() - duration < 2:
-            if cur_value == register.definitions[wanted_definition]:
-                return True
-            await asyncio.sleep(0.1)
-        return False
+        return await cls.value_matches(register, register.definitions[wanted_definition], timeout)
 
     @classmethod
-    async def value_matches(cls, register, wanted_value) -> bool:
+    async def value_matches(cls, register, wanted_value, timeout=2) -> bool:
         """
-        Check if the value of the register matches the wanted value
+        Wait until the value of the register matches the wanted value
         :param register:  Register object
         :param wanted_value:  int value to check the register against
+        :param timeout:  maximum number of seconds to wait
         :return:  True if the value matches, False if not
         """
-        cur_value = await register.get_value()
-        duration = time.monotonic()
-        while time.monotonic() - duration < 2:
-            if cur_value == wanted_value:
-                return True
-            await asyncio.sleep(0.1)
-        return False
+        try:
+            await register.wait_for(lambda value: value == wanted_value, timeout)
+        except TimeoutError:
+            return False
+        return True
 
-    def __init__(self, address: int, rw: tuple, com: SerialCom, options=None) -> None:
+    def __init__(self, address: int, rw: tuple, com: SerialCom, options=None, volatile=False, shadow=None) -> None:
         self.address = address
         self.write = rw[1]
         self.read = rw[0]
         self.com = com
         self.options = options
+        self.volatile = volatile
+        # shadow copy of the register map with the last written/read values, shared by all registers of a module
+        self.shadow = shadow if shadow is not None else {}
         # reverse the options dictionary to get a dictionary with the values as keys and the keys as values
         if self.options:
             self.definitions = {v: k for k, v in self.options.items()}
         else:
             self.definitions = None
 
-    async def get_value(self):
+    @property
+    def cached_value(self):
+        """
+        Last value written to or read from the register, None if unknown
+        """
+        return self.shadow.get(self.address)
+
+    def differs(self, value: int) -> bool:
         """
-        Get the value of the register
+        Check if writing value would change the register, based on the shadow copy
+        :param value:  int value to compare against
+        :return:  True if the value is unknown or different, False if the register already holds value
+        """
+        return self.volatile or self.cached_value != value
+
+    async def get_value(self, cached=True):
+        """
+        Get the value of the register. Non-volatile registers are served from the shadow copy when known.
+        :param cached:  False to always read the value from the module
         :return: a byte array with the value of the register
         """
+        if cached and not self.volatile and self.address in self.shadow:
+            return self.shadow[self.address]
         if self.read:
-            value = self.com.register_read(self.address)
-            # check if there is a value every 0.1 seconds for 2 seconds
-            duration = time.monotonic()
-            while time.monotonic() - duration < 2:
-                if value:
-                    return value
-                await asyncio.sleep(0.1)
-
+            value = await self.com.register_read(self.address)
+            self.shadow[self.address] = value
+            return value
         else:
             return
 
-    async def get_value_with_definition(self):
+    async def wait_for(self, predicate, timeout=2):
+        """
+        Read the register from the module until predicate(value) is true, see SerialCom.wait_register
+        :param predicate:  function called with every value read
+        :param timeout:  maximum number of seconds to wait
+        :return:  the value predicate accepted
+        :raises TimeoutError:  if predicate didn't accept a value within timeout
+        """
+        value = await self.com.wait_register(self.address, predicate, timeout)
+        if not self.volatile:
+            self.shadow[self.address] = value
+        return value
+
+    async def get_value_with_definition(self, value=None):
         """
         Get the value of the register and return the definition of the value
+        :param value:  value already read from the register, read from the module if None
         :return: string with the definition of the value
         """
         if self.options:
-            value = await self.get_value()
+            if value is None:
+                value = await self.get_value()
             if value in self.options:
                 return self.options[value]
             else:
@@ -99,23 +135,40 @@ class Register:
         else:
             raise ValueError('This register does not have options')
 
-    async def set_value(self, value: int):
+    def to_value(self, value) -> int:
         """
-        Set the value of the register
-        :param value: int value to set the register to
-        :return: None
+        Check that value can be written to the register, option names are translated to their value
+        :param value:  int value or string with the option name
+        :return:  int value to write to the register
         """
+        if isinstance(value, str):
+            if self.options is None:
+                raise ValueError('This register does not have options')
+            if value not in self.definitions:
+                raise ValueError('Invalid option')
+            value = self.definitions[value]
         if self.options:
             if value not in self.options:
                 raise ValueError('Invalid value for register')
-        if self.write:
-            if value < 0 or value > 4294967295:
-                raise ValueError('Invalid value for register')
-            else:
-                self.com.register_write(self.address, value)
-                await Register.value_matches(self, value)
-        else:
+        if not self.write:
             raise ValueError('Register is not writable')
+        if value < 0 or value > 4294967295:
+            raise ValueError('Invalid value for register')
+        return value
+
+    async def set_value(self, value: int):
+        """
+        Set the value of the register
+        :param value: int value to set the register to
+        :return: None
+        """
+        value = self.to_value(value)
+        await self.com.register_write(self.address, value)
+        self.shadow[self.address] = value
+        if self.read and not self.volatile:
+            # read back once to make sure the module accepted the value
+            if await self.get_value(cached=False) != value:
+                print(f"Register 0x{self.address:02X} reads back {self.cached_value}, expected {value}")
 
     async def set_by_definition(self, definition: str):
         """
@@ -0,0 +1,203 @@
+from radar_module import RadarModule
+import numpy as np
+
+
+class ServiceDetector(RadarModule):
+    """
+    Base class for the service modes (power bins, envelope and sparse). Inherits from the RadarModule class. The
+    samples of a stream frame are decoded into a NumPy array with a single np.frombuffer call.
+    """
+
+    # value of mode_selection, set by the service classes
+    mode = None
+    # every sample is a little endian unsigned 16 bit integer
+    sample_dtype = np.dtype('<u2')
+
+    def __init__(self, com_config, com=None, shadow_registers=None):
+        """
+        Initialize the service module
+        :param com_config:  dictionary with the configuration for the serial communication. Should contain the port and
+        rtscts settings (True or False)
+        :param com:  SerialCom object of an already opened connection to reuse, a new one is created if None
+        :param shadow_registers:  shadow copy of the register map that belongs to com
+        """
+        super().__init__(com_config, com=com, shadow_registers=shadow_registers)
+        # registers shared by all services
+        self.service_register_map = {
+            'range_start': {
+                'address': 0x20,
+                'rw': (True, True)
+            },
+            'range_length': {
+                'address': 0x21,
+                'rw': (True, True)
+            },
+            'update_rate': {
+                'address': 0x23,
+                'rw': (True, True)
+            },
+            'gain': {
+                'address': 0x24,
+                'rw': (True, True)
+            },
+            'sensor_power_mode': {
+                'address': 0x25,
+                'rw': (True, True),
+                'options': {
+                    0: 'off',
+                    1: 'sleep',
+                    2: 'ready',
+                    3: 'active',
+                    4: 'hibernate'
+                }
+            },
+            'profile_selection': {
+                'address': 0x28,
+                'rw': (True, True),
+                'options': {
+                    1: 'profile_1',
+                    2: 'profile_2',
+                    3: 'profile_3',
+                    4: 'profile_4',
+                    5: 'profile_5',
+                }
+            },
+            'downsampling_factor': {
+                'address': 0x29,
+                'rw': (True, True)
+            },
+            'hw_accelerated_average_samples': {
+                'address': 0x30,
+                'rw': (True, True)
+            },
+        }
+        self.service_register_map.update(self._service_registers())
+
+        # validate the communication configuration
+        super()._validate_com_config(com_config)
+
+        # create properties for each register in the service register map
+        super()._make_registers(self, self.service_register_map)
+
+        # service configuration
+        self.default_mod_config = {
+            'streaming_control': 0x1,
+            'mode_selection': self.mode,
+            'range_start': 200,
+            'range_length': 1000,
+            'update_rate': 10000,
+            'profile_selection': 2,
+            'sensor_power_mode': 3
+        }
+
+    @staticmethod
+    def _service_registers():
+        """
+        Registers specific to the service
+        :return:  dictionary with the register map of the service
+        """
+        return {}
+
+    def _frame_shape(self, sample_count):
+        """
+        Shape of the sample array of a frame
+        :param sample_count:  number of samples in the frame
+        :return:  tuple with the shape
+        """
+        return (sample_count,)
+
+    def decode_frame(self, result_info, buffer):
+        """
+        Decode the samples of a stream frame without copying them
+        :param result_info:  dictionary with the result info of the frame
+        :param buffer:  data of the frame
+        :return:  dictionary with the service name, result info and the samples as a read-only NumPy array
+        """
+        data = np.frombuffer(buffer, dtype=self.sample_dtype)
+        data = data.reshape(self._frame_shape(data.size))
+        return {'service': self.stream_name, 'result_info': result_info, 'data': data}
+
+
+class PowerBinsService(ServiceDetector):
+    """
+    Power bins service, one amplitude per bin
+    """
+
+    stream_name = 'power_bins'
+    mode = 'power_bins'
+
+    @staticmethod
+    def _service_registers():
+        return {
+            'requested_bin_count': {
+                'address': 0x40,
+                'rw': (True, True)
+            },
+        }
+
+
+class EnvelopeService(ServiceDetector):
+    """
+    Envelope service, one amplitude per distance step in the range
+    """
+
+    stream_name = 'envelope'
+    mode = 'Envelope'
+
+    @staticmethod
+    def _service_registers():
+        return {
+            'running_average_factor': {
+                'address': 0x40,
+                'rw': (True, True)
+            },
+        }
+
+
+class SparseService(ServiceDetector):
+    """
+    Sparse service, every frame holds sweeps_per_frame sweeps of the range
+    """
+
+    stream_name = 'sparse'
+    mode = 'sparse'
+
+    @staticmethod
+    def _service_registers():
+        return {
+            'sweeps_per_frame': {
+                'address': 0x40,
+                'rw': (True, True)
+            },
+            'sweep_rate': {
+                'address': 0x41,
+                'rw': (True, True)
+            },
+            'sampling_mode': {
+                'address': 0x42,
+                'rw': (True, True),
+                'options': {
+                    0: 'sampling_mode_a',
+                    1: 'sampling_mode_b'
+                }
+            },
+        }
+
+    async def create_module(self, config=None):
+        """
+        Create the module and read sweeps_per_frame from it, the frames are decoded with the value in the shadow copy
+        and the configuration may not set it
+        :param config:  dictionary with the configuration parameters
+        :return:  bool: True if successful, False if not
+        """
+        if not await super().create_module(config):
+            return False
+        await self.read_registers(['sweeps_per_frame'])
+        return True
+
+    def _frame_shape(self, sample_count):
+        # the frame holds sweeps_per_frame sweeps, the shadow copy has the value of the module
+        sweeps_per_frame = self.sweeps_per_frame.cached_value or 1
+        if sample_count % sweeps_per_frame:
+            raise ValueError(f"{sample_count} samples can't be split into {sweeps_per_frame} sweeps")
+        return sweeps_per_frame, sample_count // sweeps_per_frame
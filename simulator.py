@@ -0,0 +1,405 @@
+import asyncio
+import math
+import os
+import random
+import struct
+import sys
+import tty
+
+
+class SimulatedXM132:
+    """
+    Software stand-in for an XM132 running the module software. It speaks the 0xCC ... 0xCD framed register protocol:
+    register reads (0xF8 -> 0xF6), register writes (0xF9 -> 0xF5), buffer reads (0xFA -> 0xF7), the status bits for
+    stop/create/activate/clear_status, and it streams 0xFE frames while activated with streaming enabled.
+
+    Connect it in-process with the connect coroutine (pass it as 'connector' in the com_config) or through a
+    pseudo-terminal with open_pty, which gives a port that pyserial can open like the real device.
+
+    In-process, the UART speed is simulated too: nothing gets through while the host and the module use different
+    speeds, and above max_baudrate the link flips bits like a cable that is too long for the speed.
+    """
+
+    MODE_SELECTION = 0x02
+    MAIN_CONTROL = 0x03
+    STREAMING_CONTROL = 0x05
+    STATUS = 0x06
+    UART_BAUDRATE = 0x07
+    RANGE_START = 0x20
+    RANGE_LENGTH = 0x21
+    UPDATE_RATE = 0x23
+    BIN_COUNT = 0x40
+    SWEEPS_PER_FRAME = 0x40
+
+    CREATED = 0x1
+    ACTIVATED = 0x2
+    DATA_READY = 0x100
+    ERROR_INVALID_COMMAND = 0x00020000
+    ERROR_INVALID_MODE = 0x00040000
+    ERROR_WRONG_STATE = 0x00200000
+    CLEARABLE = 0xFFFFFF00
+
+    MODES = {0x1: 'power_bins', 0x2: 'Envelope', 0x4: 'sparse', 0x400: 'presence'}
+    # UART speeds of the module software, other values written to UART_BAUDRATE are rejected
+    UART_BAUDRATES = (3000000, 2000000, 1000000, 921600, 460800, 230400, 115200)
+    READ_ONLY = (STATUS, 0x10, 0x11)
+
+    PRESENCE = struct.Struct('<bff')
+    RESULT_INFO_ENTRY = struct.Struct('<BI')
+    # result info address of the data saturated flag
+    DATA_SATURATED = 0x9F
+    # payload length of the register read and write requests and the buffer read request, packets with another
+    # length are rejected and a longer length isn't waited for
+    PAYLOAD_LENGTHS = {0xF8: 1, 0xF9: 5, 0xFA: 1}
+    MAX_PAYLOAD_LENGTH = max(PAYLOAD_LENGTHS.values())
+    # probability that a byte is flipped on a link above max_baudrate
+    LINK_ERROR_RATE = 0.1
+
+    def __init__(self, noise=0.0, corruption_rate=0.0, seed=None, max_baudrate=None):
+        """
+        :param noise:  standard deviation of the noise added to the presence score and distance, relative to the
+        service sample amplitude for the service modes
+        :param corruption_rate:  probability that a byte of an outgoing stream frame is flipped
+        :param seed:  seed of the random generator, for repeatable runs
+        :param max_baudrate:  highest UART speed the simulated link carries without errors, None for no limit
+        """
+        self.noise = noise
+        self.corruption_rate = corruption_rate
+        self.max_baudrate = max_baudrate
+        # UART speed the host opened the port at, None for a pseudo-terminal
+        self.host_baudrate = None
+        self.random = random.Random(seed)
+        self.registers = {
+            self.MODE_SELECTION: 0x400,
+            self.STREAMING_CONTROL: 0,
+            self.STATUS: 0,
+            self.UART_BAUDRATE: 115200,
+            0x10: 0xACC2,
+            0x11: 0x00020000,
+            self.RANGE_START: 500,
+            self.RANGE_LENGTH: 5000,
+            self.UPDATE_RATE: 1000,
+            0x25: 3,
+            0x28: 5,
+            self.BIN_COUNT: 5,
+        }
+        self.frames_sent = 0
+        self._input = bytearray()
+        self._output = None
+        self._stream_task = None
+        self._data = b''
+        self._pty = None
+
+    # connection
+
+    async def connect(self, loop, protocol_factory, *args, baudrate=115200, **kwargs):
+        """
+        Connect the simulator to a protocol in-process, with the signature of create_serial_connection
+        :param loop:  event loop
+        :param protocol_factory:  callable returning the protocol
+        :param baudrate:  UART speed of the host
+        :return:  (transport, protocol)
+        """
+        self.host_baudrate = baudrate
+        # a partial packet is dropped after the idle gap of reopening the port
+        self._input.clear()
+        protocol = protocol_factory()
+        transport = SimulatedTransport(self, protocol, loop)
+        self._output = lambda data: loop.call_soon(transport.deliver, data)
+        protocol.connection_made(transport)
+        self._resume_stream()
+        return transport, protocol
+
+    def open_pty(self):
+        """
+        Serve the simulator on a pseudo-terminal
+        :return:  path of the port to open, e.g. /dev/pts/3
+        """
+        master, slave = os.openpty()
+        self.host_baudrate = None
+        tty.setraw(master)
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(master, lambda: self.receive(os.read(master, 4096)))
+        self._output = lambda data: self._write_pty(master, data)
+        self._pty = (master, slave)
+        self._resume_stream()
+        return os.ttyname(slave)
+
+    def _write_pty(self, master, data):
+        try:
+            os.write(master, data)
+        except BlockingIOError:
+            # nobody is reading the port, like the real UART the data is lost
+            pass
+
+    def disconnect(self):
+        """
+        Stop streaming and forget the connection
+        :return:  None
+        """
+        self._stop_stream()
+        self._output = None
+        if self._pty is not None:
+            asyncio.get_running_loop().remove_reader(self._pty[0])
+            for fd in self._pty:
+                os.close(fd)
+            self._pty = None
+
+    # protocol
+
+    def receive(self, data):
+        """
+        Handle bytes sent to the module
+        :param data:  bytes written by the host
+        :return:  None
+        """
+        data = self._through_link(data)
+        if data is None:
+            return
+        buffer = self._input
+        buffer.extend(data)
+        while True:
+            start = buffer.find(0xCC)
+            if start < 0:
+                buffer.clear()
+                return
+            del buffer[:start]
+            if len(buffer) < 4:
+                return
+            length = int.from_bytes(buffer[1:3], byteorder='little')
+            if length > self.MAX_PAYLOAD_LENGTH:
+                # corrupted length, waiting for it would swallow the next requests
+                del buffer[:1]
+                continue
+            if len(buffer) < length + 5:
+                return
+            if buffer[length + 4] != 0xCD:
+                del buffer[:1]
+                continue
+            packet_type = buffer[3]
+            payload = bytes(buffer[4:length + 4])
+            del buffer[:length + 5]
+            self._handle(packet_type, payload)
+
+    def _handle(self, packet_type, payload):
+        if len(payload) != self.PAYLOAD_LENGTHS.get(packet_type, len(payload)):
+            # e.g. a read turned into a write by a flipped bit
+            self.registers[self.STATUS] |= self.ERROR_INVALID_COMMAND
+        elif packet_type == 0xF8:
+            address = payload[0]
+            self._send(0xF6, bytes([address]) + self.registers.get(address, 0).to_bytes(4, byteorder='little'))
+        elif packet_type == 0xF9:
+            address = payload[0]
+            value = int.from_bytes(payload[1:5], byteorder='little')
+            if address == self.UART_BAUDRATE:
+                if value not in self.UART_BAUDRATES:
+                    # e.g. a speed corrupted on the way, the module stays at its speed
+                    self.registers[self.STATUS] |= self.ERROR_INVALID_COMMAND
+                    return
+                # acknowledged at the old speed, the new one is used from the next byte
+                self._send(0xF5, bytes([address]))
+                self.registers[address] = value
+                return
+            self._write_register(address, value)
+            self._send(0xF5, bytes([address]))
+        elif packet_type == 0xFA:
+            self._send(0xF7, b'\xe8' + self._data)
+        else:
+            self.registers[self.STATUS] |= self.ERROR_INVALID_COMMAND
+
+    def _write_register(self, address, value):
+        status = self.registers[self.STATUS]
+        if address in self.READ_ONLY:
+            self.registers[self.STATUS] = status | self.ERROR_INVALID_COMMAND
+        elif address == self.MAIN_CONTROL:
+            self._main_control(value)
+        elif address >= self.RANGE_START and status & (self.CREATED | self.ACTIVATED):
+            # configuration can only change while the detector is stopped
+            self.registers[self.STATUS] = status | self.ERROR_WRONG_STATE
+        else:
+            self.registers[address] = value
+
+    def _main_control(self, command):
+        status = self.registers[self.STATUS]
+        if command == 0:
+            self._stop_stream()
+            status &= ~(self.CREATED | self.ACTIVATED)
+        elif command == 4:
+            status &= ~self.CLEARABLE
+        elif command in (1, 3):
+            if self.registers[self.MODE_SELECTION] not in self.MODES:
+                status |= self.ERROR_INVALID_MODE
+            else:
+                status |= self.CREATED
+                if command == 3:
+                    status |= self.ACTIVATED
+        elif command == 2:
+            if status & self.CREATED:
+                status |= self.ACTIVATED
+            else:
+                status |= self.ERROR_WRONG_STATE
+        else:
+            status |= self.ERROR_INVALID_COMMAND
+        self.registers[self.STATUS] = status
+        self._resume_stream()
+
+    def _resume_stream(self):
+        # an activated module streams again as soon as it is connected
+        if self.registers[self.STATUS] & self.ACTIVATED and self._stream_task is None:
+            self._stream_task = asyncio.get_running_loop().create_task(self._measure())
+
+    def _send(self, packet_type, payload, corrupt=False):
+        if self._output is None:
+            return
+        packet = bytearray(b'\xcc')
+        packet.extend(len(payload).to_bytes(2, byteorder='little'))
+        packet.append(packet_type)
+        packet.extend(payload)
+        packet.append(0xCD)
+        if corrupt and self.corruption_rate:
+            for position in range(len(packet)):
+                if self.random.random() < self.corruption_rate:
+                    packet[position] ^= 1 << self.random.randrange(8)
+        packet = self._through_link(packet)
+        if packet is not None:
+            self._output(bytes(packet))
+
+    def _through_link(self, data):
+        """
+        What arrives of data at the other end of the UART
+        :return:  the bytes, with flipped bits above max_baudrate, None if the speeds of the two ends differ
+        """
+        if self.host_baudrate is None:
+            return data
+        if self.host_baudrate != self.registers[self.UART_BAUDRATE]:
+            return None
+        if self.max_baudrate is not None and self.host_baudrate > self.max_baudrate:
+            data = bytearray(data)
+            for position in range(len(data)):
+                if self.random.random() < self.LINK_ERROR_RATE:
+                    data[position] ^= 1 << self.random.randrange(8)
+        return data
+
+    # measurements
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+        try:
+            while True:
+                # update rate in mHz
+                period = 1000 / max(self.registers.get(self.UPDATE_RATE, 1000), 1)
+                next_frame += period
+                delay = next_frame - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    # running behind, don't try to catch up with a burst
+                    next_frame = loop.time()
+                    await asyncio.sleep(0)
+                self._data = self._frame_data()
+                if self.registers[self.STREAMING_CONTROL]:
+                    self._send(0xFE, self._stream_payload(self._data), corrupt=True)
+                    self.frames_sent += 1
+                else:
+                    self.registers[self.STATUS] |= self.DATA_READY
+        except asyncio.CancelledError:
+            pass
+
+    def _stop_stream(self):
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+            self._stream_task = None
+
+    def _stream_payload(self, data):
+        result_info = self.RESULT_INFO_ENTRY.pack(self.DATA_SATURATED, 0)
+        return (b'\xfd' + len(result_info).to_bytes(2, byteorder='little') + result_info +
+                b'\xfe' + len(data).to_bytes(2, byteorder='little') + data)
+
+    def _frame_data(self):
+        mode = self.MODES[self.registers[self.MODE_SELECTION]]
+        if mode == 'presence':
+            return self._presence_data()
+        return self._service_data(mode)
+
+    def _presence_data(self):
+        # a person walking back and forth through the range, present two thirds of the time
+        t = self.frames_sent / 10
+        start = self.registers[self.RANGE_START] / 1000
+        length = self.registers[self.RANGE_LENGTH] / 1000
+        presence = math.sin(t / 5) > -0.5
+        distance = start + length * (0.5 + 0.5 * math.sin(t / 7))
+        score = (2.0 + math.sin(t)) if presence else 0.2
+        if self.noise:
+            score = max(0.0, score + self.random.gauss(0, self.noise))
+            distance = max(0.0, distance + self.random.gauss(0, self.noise))
+        return self.PRESENCE.pack(presence, score, distance if presence else 0.0)
+
+    def _sample_count(self, mode):
+        range_length = self.registers[self.RANGE_LENGTH]
+        if mode == 'power_bins':
+            return max(self.registers.get(self.BIN_COUNT, 5), 1)
+        if mode == 'Envelope':
+            # about one sample every 0.5 mm
+            return max(range_length * 2, 1)
+        # about one sample every 6 cm in every sweep
+        return (range_length // 60 + 1) * max(self.registers.get(self.SWEEPS_PER_FRAME, 1), 1)
+
+    def _service_data(self, mode):
+        count = self._sample_count(mode)
+        peak = count // 2 + int(count / 4 * math.sin(self.frames_sent / 20))
+        samples = bytearray()
+        for i in range(count):
+            value = 1000 + 8000 * math.exp(-((i - peak) / (count / 20 + 1)) ** 2)
+            if self.noise:
+                value += self.random.gauss(0, self.noise * 1000)
+            samples.extend(struct.pack('<H', min(max(int(value), 0), 0xFFFF)))
+        return bytes(samples)
+
+
+class SimulatedTransport(asyncio.Transport):
+    """
+    In-process transport between a protocol and a SimulatedXM132
+    """
+
+    def __init__(self, device, protocol, loop):
+        super().__init__()
+        self._device = device
+        self._protocol = protocol
+        self._loop = loop
+        self._closing = False
+
+    def write(self, data):
+        if not self._closing:
+            self._loop.call_soon(self._device.receive, bytes(data))
+
+    def deliver(self, data):
+        """
+        Pass bytes sent by the device to the protocol
+        """
+        if not self._closing:
+            self._protocol.data_received(data)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._device.disconnect()
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+
+async def serve_pty(noise, corruption_rate):
+    device = SimulatedXM132(noise=noise, corruption_rate=corruption_rate)
+    print(f"Simulated XM132 on {device.open_pty()}")
+    await asyncio.Event().wait()
+
+
+# Serve a simulated module on a pseudo-terminal: python simulator.py [noise] [corruption_rate]
+if __name__ == '__main__':
+    arguments = [float(argument) for argument in sys.argv[1:3]]
+    asyncio.run(serve_pty(*arguments, *[0.0] * (2 - len(arguments))))
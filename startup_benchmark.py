@@ -0,0 +1,181 @@
+"""
+Startup benchmark of the radar server: how long importing main takes, which modules the time goes to, and how long
+it takes from starting the server process until it is listening and answers a request.
+
+Every run starts a fresh Python process, so nothing is cached between runs except by the operating system.
+
+    python startup_benchmark.py --runs 10 --output startup.json
+    python startup_benchmark.py --display oled --baseline startup.json
+
+Runs headless by default, pass --display to include opening a display back end.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import time
+import websockets
+from benchmark import percentile
+from display.backends import DISPLAY_BACKENDS
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# line of the -X importtime output: self and cumulative microseconds, indentation (two spaces per level), name. The
+# imports of a module are printed before the module
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+# code run in the measured process, prints the seconds it took to import main
+IMPORT_MAIN = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+
+
+def measure_import():
+    """
+    Import main in a new process
+    :return:  seconds the import took, dictionary with the cumulative microseconds of every module main imports
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_MAIN], cwd=DIRECTORY,
+                             capture_output=True, text=True, check=True)
+    modules = {}
+    children = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        _, cumulative, indentation, name = match.groups()
+        if indentation == '  ':
+            children[name] = int(cumulative)
+        elif not indentation:
+            if name == 'main':
+                modules = children
+            children = {}
+    return float(process.stdout.split()[-1]), modules
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def measure_server(display, timeout=30):
+    """
+    Start the server in a new process and wait until it answers a request
+    :param display:  display back end of the server
+    :param timeout:  seconds to wait for the server
+    :return:  seconds until it accepted a websocket connection, seconds until it answered the 'sensors' request
+    """
+    port = free_port()
+    args = [sys.executable, 'main.py', '--address', '127.0.0.1', '--port', str(port), '--display', display,
+            '--frame-bus-name', f'radar_frames_startup_{os.getpid()}']
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*args, cwd=DIRECTORY, stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f'The server did not start within {timeout} s')
+            if process.returncode is not None:
+                raise RuntimeError(f'The server exited with code {process.returncode}')
+            try:
+                websocket = await websockets.connect(f'ws://127.0.0.1:{port}')
+                break
+            except OSError:
+                await asyncio.sleep(0.005)
+        listening = time.perf_counter() - start
+        try:
+            await websocket.send(json.dumps({'req': 'sensors', 'id': 1}))
+            await websocket.recv()
+        finally:
+            await websocket.close()
+        answered = time.perf_counter() - start
+    finally:
+        process.terminate()
+        await process.wait()
+    return listening, answered
+
+
+def summary(values):
+    values = sorted(values)
+    return {
+        'min': values[0] * 1000,
+        'p50': percentile(values, 0.5) * 1000,
+        'max': values[-1] * 1000,
+    }
+
+
+def run(args):
+    imports, listening, answered = [], [], []
+    modules = {}
+    for _ in range(args.runs):
+        seconds, run_modules = measure_import()
+        imports.append(seconds)
+        for name, microseconds in run_modules.items():
+            modules.setdefault(name, []).append(microseconds)
+        listen, answer = asyncio.run(measure_server(args.display))
+        listening.append(listen)
+        answered.append(answer)
+    slowest = sorted(modules.items(), key=lambda item: -percentile(sorted(item[1]), 0.5))[:args.top]
+    return {
+        'import_main_ms': summary(imports),
+        'time_to_listen_ms': summary(listening),
+        'time_to_first_response_ms': summary(answered),
+        'slowest_imports_ms': {name: percentile(sorted(values), 0.5) / 1000 for name, values in slowest},
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Print the change of the median times against a previous run
+    :param result:  results of this run
+    :param baseline:  results of the previous run
+    :param tolerance:  relative change reported as a regression
+    :return:  number of regressions
+    """
+    regressions = 0
+    for key in ('import_main_ms', 'time_to_listen_ms', 'time_to_first_response_ms'):
+        old, new = baseline[key]['p50'], result[key]['p50']
+        change = new / old - 1 if old else 0
+        regression = change > tolerance
+        regressions += regression
+        print(f'{key}: {old:.1f} -> {new:.1f} ms ({change:+.1%}){" REGRESSION" if regression else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import and startup time of the radar server')
+    parser.add_argument('--runs', type=int, default=5, help='server processes started')
+    parser.add_argument('--display', choices=list(DISPLAY_BACKENDS), default='none',
+                        help='display back end of the server')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports of main reported')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"import main {result['import_main_ms']['p50']:.1f} ms, listening after "
+          f"{result['time_to_listen_ms']['p50']:.1f} ms, first response after "
+          f"{result['time_to_first_response_ms']['p50']:.1f} ms (medians of {args.runs} runs)", file=sys.stderr)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'settings': {'runs': args.runs, 'display': args.display},
+        'results': result,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+from command_registry import CommandRegistry, optional, respond
+
+# sensor addressed by commands without a sensor_id
+DEFAULT_SENSOR_ID = 'default'
+
+
+def sensor_id_of(data):
+    """
+    Get the sensor a command is addressed to
+    :param data:  data of the command
+    :return:  sensor id, DEFAULT_SENSOR_ID if the command has none
+    """
+    if isinstance(data, dict):
+        return str(data.get('sensor_id', DEFAULT_SENSOR_ID))
+    return DEFAULT_SENSOR_ID
+
+
+# Commands that only change the stream frames a client receives. They are handled by the process holding the
+# connection, the acquisition process or a fan-out worker, bound to the Broadcaster of that process (see
+# CommandRegistry.bound).
+STREAM_COMMANDS = CommandRegistry()
+
+
+@STREAM_COMMANDS.command('cmd', 'set_encoding', fields={'encoding': str})
+async def set_encoding_cmd(consumers, websocket, data):
+    """
+    Negotiate the wire format of the stream frames sent to this client: 'json' (default), 'struct' or 'msgpack'.
+    Binary formats are sent as binary websocket messages, see wire_format for the layouts
+    """
+    consumers.set_encoding(websocket, data['encoding'])
+    await respond(websocket, {'ack': 'success', 'data': {'comment': f"Stream encoding set to {data['encoding']}"}})
+
+
+@STREAM_COMMANDS.command('cmd', 'subscribe', fields={
+    'max_rate': optional(float, 0.0),
+    'decimation': optional(int, 1),
+    'batch_window': optional(float, 0.0),
+    'change_only': optional(bool, False),
+    'score_deadband': optional(float, 0.0),
+    'distance_deadband': optional(float, 0.0),
+    'keyframe_interval': optional(float, 10.0),
+})
+async def subscribe_cmd(consumers, websocket, data):
+    """
+    Change which stream frames this client receives:
+    max_rate: maximum messages per second, frames in between are coalesced to the latest one (0: no limit)
+    decimation: only every n'th frame is sent (1: every frame)
+    batch_window: frames are collected for this many seconds and sent as one batch message (0: no batching)
+    change_only: only send presence frames when presence flips or score or distance move beyond their dead-band
+    score_deadband, distance_deadband: smallest change that counts, in score units and meters (default 0)
+    keyframe_interval: seconds after which a presence frame is sent even if nothing changed (default 10)
+    """
+    consumers.subscribe(websocket, max_rate=data['max_rate'], decimation=data['decimation'],
+                        batch_window=data['batch_window'], change_only=data['change_only'],
+                        score_deadband=data['score_deadband'], distance_deadband=data['distance_deadband'],
+                        keyframe_interval=data['keyframe_interval'])
+    await respond(websocket, {'ack': 'success', 'data': {'comment': 'Subscription updated'}})
+
+
+@STREAM_COMMANDS.command('cmd', 'resume', fields={'last_seq': int, 'epoch': optional(int)})
+async def resume_cmd(consumers, websocket, data):
+    """
+    Resume the stream of a sensor after reconnecting: the frames published after last_seq that are still kept are
+    sent as one batch message, then the stream continues live. data contains sensor_id, last_seq (sequence number of
+    the last frame received) and optionally the epoch of the stream the client saw, a different epoch means the server
+    restarted and the client has to start over
+    """
+    sensor_id = sensor_id_of(data)
+    try:
+        result = consumers.resume(websocket, sensor_id, data['last_seq'], data['epoch'])
+    except ValueError as e:
+        # the client needs the new epoch to start over
+        await respond(websocket, {'ack': 'failed', 'data': {'comment': str(e), 'sensor_id': sensor_id,
+                                                            'epoch': consumers.epoch}})
+        return
+    await respond(websocket, {'ack': 'success', 'data': dict(result, comment='Stream resumed', sensor_id=sensor_id,
+                                                             epoch=consumers.epoch)})
+
+
+@STREAM_COMMANDS.command('req', 'encoding_stats')
+async def get_encoding_stats_req(consumers, websocket, data=None):
+    """
+    Send the measured bytes per frame and encode time of the wire formats in use
+    """
+    await respond(websocket, {'resp': 'encoding_stats', 'data': consumers.stats()['encodings']})
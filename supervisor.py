@@ -0,0 +1,167 @@
+import asyncio
+import collections
+import time
+from communicator import ModuleError
+from metrics import registry
+
+STREAM_GAP = registry.histogram('stream_gap_seconds',
+                                'Time between the last frame before a stream failure and the first frame after the '
+                                'restart')
+
+
+class AcquisitionSupervisor:
+    """
+    Streams from a detector until cancelled. When the stream stalls (no frame within a few update periods) or the
+    serial connection fails, the port is reopened and the last configuration re-applied. If the module kept running
+    with the same configuration nothing is written, otherwise only the registers that differ from the module are.
+    Every interruption is reported as a gap: the time between the last frame before and the first frame after it.
+    Errors of the data handler are reported and the frame skipped, they are not failures of the stream.
+
+    Call stop before cancelling the task: a cancellation can be lost in a wait_for of the serial communication
+    (Python < 3.12), the stopped flag makes sure a stopped acquisition is never restarted.
+    """
+
+    STREAMING = 'streaming'
+    RECOVERING = 'recovering'
+
+    def __init__(self, detector, data_handler_func, stall_periods=5, min_stall_timeout=0.5, retry_interval=0.1,
+                 max_retry_interval=5.0, gap_history=16):
+        """
+        :param detector:  opened and activated detector
+        :param data_handler_func:  coroutine function called with every decoded frame, see RadarModule.start_stream
+        :param stall_periods:  number of update periods without a frame after which the stream is stalled
+        :param min_stall_timeout:  lower limit of the stall timeout in seconds
+        :param retry_interval:  seconds before the second restart attempt, doubled after every failed attempt
+        :param max_retry_interval:  maximum seconds between restart attempts
+        :param gap_history:  number of gaps kept for the status
+        """
+        self.detector = detector
+        self.data_handler_func = data_handler_func
+        self.stall_periods = stall_periods
+        self.min_stall_timeout = min_stall_timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.state = self.STREAMING
+        self.stopped = False
+        self.restarts = 0
+        self.handler_errors = 0
+        self.gaps = collections.deque(maxlen=gap_history)
+        # monotonic time of the last frame, and of the last frame before the running interruption
+        self.last_frame = None
+        self._gap_start = None
+        self._gap_reason = None
+
+    async def run(self):
+        """
+        Stream until stopped, restarting the acquisition whenever it fails
+        :return:  None, when stopped
+        """
+        while not self.stopped:
+            try:
+                stall_timeout = self.detector.stall_timeout(self.stall_periods, self.min_stall_timeout)
+                await self.detector.start_stream(self._handle_frame, stall_timeout=stall_timeout,
+                                                 stopped=lambda: self.stopped)
+            except Exception as e:
+                if self.stopped:
+                    # the port was closed under the stream
+                    return
+                stalled = isinstance(e, (TimeoutError, asyncio.TimeoutError))
+                reason = 'stalled' if stalled else f'{type(e).__name__}: {e}'
+                print(f"Stream interrupted ({reason}), restarting")
+                if self._gap_start is None:
+                    self._gap_start = self.last_frame if self.last_frame is not None else time.monotonic()
+                    self._gap_reason = reason
+                await self._restart()
+
+    async def _handle_frame(self, received=None, **frame):
+        if self._gap_start is not None:
+            self._end_gap(received)
+        self.last_frame = received
+        try:
+            await self.data_handler_func(received=received, **frame)
+        except Exception as e:
+            self.handler_errors += 1
+            print(f"Error in the data handler: {type(e).__name__}: {e}")
+
+    def stop(self):
+        """
+        Stop streaming and restarting, the task should be cancelled too to stop a read in progress
+        :return:  None
+        """
+        self.stopped = True
+
+    def _end_gap(self, received):
+        duration = received - self._gap_start
+        STREAM_GAP.observe(duration)
+        self.gaps.append({'time': time.time() - (time.monotonic() - self._gap_start),
+                          'duration': duration,
+                          'reason': self._gap_reason})
+        print(f"Stream resumed after a gap of {duration * 1000:.0f} ms")
+        self._gap_start = None
+        self._gap_reason = None
+
+    async def _restart(self):
+        """
+        Reopen the port and restart the module, retrying with a growing interval until it works
+        """
+        self.state = self.RECOVERING
+        interval = 0
+        while not self.stopped:
+            if interval:
+                await asyncio.sleep(interval)
+                if self.stopped:
+                    return
+            self.restarts += 1
+            try:
+                await self._reopen()
+                if self.stopped:
+                    # stopped while reopening, leave the port closed
+                    self.detector.close()
+                    return
+                self.state = self.STREAMING
+                return
+            except Exception as e:
+                print(f"Restart failed: {e}")
+            interval = min(max(interval * 2, self.retry_interval), self.max_retry_interval)
+
+    async def _reopen(self):
+        detector = self.detector
+        detector.close()
+        await detector.open()
+        if self.stopped:
+            return
+        com = detector.com
+        if com.baudrate != com.DEFAULT_BAUDRATE and not await detector.check_link():
+            # the module was reset to the default UART speed, negotiate the one that worked again
+            if await detector.find_baudrate() == com.DEFAULT_BAUDRATE:
+                # a reset module lost its configuration, the shadow copy no longer matches it
+                detector.invalidate_shadow()
+            await detector.negotiate_baudrate(com.verified_baudrate)
+        config = detector.config or {}
+        readable = [key for key in config if getattr(detector, key).read]
+        # the state and the configuration of the module in one batch of reads
+        values = await detector.read_registers(['status', *readable])
+        status = values.pop('status', 0)
+        running = detector.STATUS_CREATED | detector.STATUS_ACTIVATED
+        same_config = len(values) == len(readable) and not any(
+            getattr(detector, key).differs(getattr(detector, key).to_value(config[key])) for key in readable)
+        if status & running == running and not status & detector.STATUS_ERROR_MASK and same_config:
+            print("Module still running with the same configuration")
+            return
+        if self.stopped:
+            return
+        # the shadow copy now holds what the module has, create_module only writes what differs
+        if not await detector.create_module(config) or not await detector.activate_module():
+            raise ModuleError('Module could not be created and activated')
+
+    def stats(self):
+        """
+        State of the acquisition
+        :return:  dictionary with the state, number of restarts, data handler errors and the last gaps
+        """
+        return {
+            'state': self.state,
+            'restarts': self.restarts,
+            'handler_errors': self.handler_errors,
+            'gaps': list(self.gaps),
+        }
@@ -0,0 +1,193 @@
+import json
+import struct
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class StreamFrame:
+    """
+    A decoded stream frame on its way to the clients, encoded by the encoding each client negotiated
+    """
+
+    __slots__ = ('stream', 'sensor', 'sensor_index', 'seq', 'timestamp', 'received', 'data', 'encoded')
+
+    def __init__(self, stream, data, sensor=None, sensor_index=0, seq=0, timestamp=None, received=None):
+        """
+        :param stream:  name of the stream, 'presence' or the service name
+        :param data:  dictionary with the decoded values. presence: presence, score, distance. services: result_info
+        and samples (NumPy array)
+        :param sensor:  id of the sensor the frame came from
+        :param sensor_index:  small number identifying the sensor in binary frames
+        :param seq:  sequence number of the frame
+        :param timestamp:  time the frame was received in seconds since the epoch, derived from received if None
+        :param received:  monotonic time the frame was received from the module, for the latency metrics
+        """
+        self.stream = stream
+        self.sensor = sensor
+        self.sensor_index = sensor_index
+        self.data = data
+        self.seq = seq
+        now = time.monotonic()
+        self.received = now if received is None else received
+        # wall clock time of the serial receive
+        self.timestamp = time.time() - (now - self.received) if timestamp is None else timestamp
+        # encoded frame by wire format name
+        self.encoded = {}
+
+
+class FrameEncoder:
+    """
+    Base class for the wire formats. Keeps the number of encoded frames, bytes and encode time
+    """
+
+    name = None
+    # websocket frames with this encoding are binary
+    binary = False
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.encode_ns = 0
+
+    def encode(self, frame):
+        """
+        Encode a frame
+        :param frame:  StreamFrame to encode
+        :return:  str for text encodings, bytes for binary encodings
+        """
+        start = time.perf_counter_ns()
+        payload = self._encode(frame)
+        self.encode_ns += time.perf_counter_ns() - start
+        self.frames += 1
+        self.bytes += len(payload)
+        return payload
+
+    def _encode(self, frame):
+        raise NotImplementedError
+
+    def encode_batch(self, payloads):
+        """
+        Combine already encoded frames into one batch message
+        :param payloads:  list with encoded frames
+        :return:  str for text encodings, bytes for binary encodings
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Measured size and encode time
+        :return:  dictionary with the number of frames, mean bytes per frame and mean encode time in microseconds
+        """
+        frames = max(self.frames, 1)
+        return {
+            'frames': self.frames,
+            'bytes_per_frame': self.bytes / frames,
+            'encode_us_per_frame': self.encode_ns / frames / 1000,
+        }
+
+
+class JsonEncoder(FrameEncoder):
+    """
+    Default encoding, the JSON messages the clients have always received, with the sequence number and timestamp of
+    the frame
+    """
+
+    name = 'json'
+
+    def _encode(self, frame):
+        data = frame.data
+        if frame.stream == 'presence':
+            data = {"presence": data['presence'],
+                    "score": "{:.2f}".format(data['score']),
+                    "distance": "{:.1f}".format(data['distance'])}
+        else:
+            data = {'result_info': data['result_info'], 'samples': data['samples'].tolist()}
+        return json.dumps({'stream': frame.stream, 'sensor': frame.sensor, 'seq': frame.seq,
+                           'timestamp': frame.timestamp, 'data': data})
+
+    def encode_batch(self, payloads):
+        # {"batch": [frame, frame, ...]}
+        return '{"batch": [' + ', '.join(payloads) + ']}'
+
+
+class StructEncoder(FrameEncoder):
+    """
+    Fixed layout binary frames, all little endian:
+    header: version (uint8), stream id (uint8), sensor index (uint8), sequence number (uint32), timestamp in seconds
+    (float64)
+    presence: presence (uint8), score (float32), distance (float32)
+    services: sweeps (uint16), samples per sweep (uint16), samples (uint16 each)
+    batch: version (uint8), stream id 0 (uint8), frame count (uint16), then every frame prefixed with its length
+    (uint32)
+    """
+
+    name = 'struct'
+    binary = True
+
+    VERSION = 2
+    STREAM_IDS = {'presence': 1, 'power_bins': 2, 'envelope': 3, 'sparse': 4}
+    HEADER = struct.Struct('<BBBId')
+    PRESENCE = struct.Struct('<Bff')
+    SHAPE = struct.Struct('<HH')
+    BATCH_HEADER = struct.Struct('<BBH')
+    BATCH_LENGTH = struct.Struct('<I')
+
+    def _encode(self, frame):
+        header = self.HEADER.pack(self.VERSION, self.STREAM_IDS[frame.stream], frame.sensor_index,
+                                  frame.seq & 0xFFFFFFFF, frame.timestamp)
+        data = frame.data
+        if frame.stream == 'presence':
+            return header + self.PRESENCE.pack(data['presence'], data['score'], data['distance'])
+        samples = data['samples']
+        sweeps, length = samples.shape if samples.ndim == 2 else (1, samples.size)
+        return header + self.SHAPE.pack(sweeps, length) + samples.tobytes()
+
+    def encode_batch(self, payloads):
+        parts = [self.BATCH_HEADER.pack(self.VERSION, 0, len(payloads))]
+        for payload in payloads:
+            parts.append(self.BATCH_LENGTH.pack(len(payload)))
+            parts.append(payload)
+        return b''.join(parts)
+
+
+class MsgpackEncoder(FrameEncoder):
+    """
+    MessagePack maps with the raw values, service samples as little endian uint16 bytes
+    """
+
+    name = 'msgpack'
+    binary = True
+
+    def _encode(self, frame):
+        data = frame.data
+        if frame.stream != 'presence':
+            samples = data['samples']
+            data = {'result_info': data['result_info'], 'shape': list(samples.shape), 'samples': samples.tobytes()}
+        return msgpack.packb({'stream': frame.stream, 'sensor': frame.sensor, 'seq': frame.seq, 'ts': frame.timestamp,
+                              'data': data})
+
+    def encode_batch(self, payloads):
+        # a MessagePack array is its header followed by the packed elements
+        count = len(payloads)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b'\xdc' + count.to_bytes(2, byteorder='big')
+        else:
+            header = b'\xdd' + count.to_bytes(4, byteorder='big')
+        return header + b''.join(payloads)
+
+
+def make_encoders():
+    """
+    Create one encoder per available wire format, msgpack is only available when the package is installed
+    :return:  dictionary with the encoding name as key and the encoder as value
+    """
+    encoders = [JsonEncoder(), StructEncoder()]
+    if msgpack is not None:
+        encoders.append(MsgpackEncoder())
+    return {encoder.name: encoder for encoder in encoders}